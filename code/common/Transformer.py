@@ -3,6 +3,7 @@
     Refs:   Attention is All you Need
             https://github.com/SamLynnEvans/Transformer
 """
+import os
 import math
 import copy
 import numpy as np
@@ -12,6 +13,9 @@ import torch.nn.functional as F
 from torch.autograd import Variable
 from timm.models.layers import trunc_normal_
 
+# 'sdpa': fused torch.nn.functional.scaled_dot_product_attention, 'math': explicit matmul/softmax (attention())
+ATTENTION_BACKEND = os.environ.get('SARSSL_ATTENTION_BACKEND', 'sdpa')
+
 def clones(module, N):
     "Produce N identical layers."
     return nn.ModuleList([copy.deepcopy(module) for _ in range(N)])
@@ -50,7 +54,13 @@ class MultiHeadAttention(nn.Module):
             [l(x).view(nbatches, -1, self.h, self.d_k).transpose(1, 2)
              for l, x in zip(self.linears, (query, key, value))]
 
-        x, self.attn = attention(query, key, value, mask=mask, dropout=self.dropout)
+        if ATTENTION_BACKEND == 'sdpa':
+            # attention weights are not materialized
+            attn_bias = None if mask is None else torch.zeros(mask.shape, dtype=query.dtype, device=query.device).masked_fill(mask == 0, -1e9)
+            x = F.scaled_dot_product_attention(query, key, value, attn_mask=attn_bias, dropout_p=self.dropout.p if self.training else 0.0)
+            self.attn = None
+        else:
+            x, self.attn = attention(query, key, value, mask=mask, dropout=self.dropout)
 
         x = x.transpose(1, 2).contiguous().view(nbatches, -1, self.h * self.d_k)
         return self.linears[-1](x)  # FC processes the last dimension
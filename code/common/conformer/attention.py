@@ -12,6 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
 import math
 import torch
 import torch.nn as nn
@@ -22,6 +23,10 @@ from typing import Optional
 from .embedding import PositionalEncoding
 from .modules import Linear
 
+# 'sdpa': fused torch.nn.functional.scaled_dot_product_attention with the relative-position score as additive bias
+# 'math': explicit matmul/softmax as in the reference implementation
+ATTENTION_BACKEND = os.environ.get('SARSSL_ATTENTION_BACKEND', 'sdpa')
+
 
 class RelativeMultiHeadAttention(nn.Module):
     """
@@ -37,7 +42,7 @@ class RelativeMultiHeadAttention(nn.Module):
         - **query** (batch, time, dim): Tensor containing query vector
         - **key** (batch, time, dim): Tensor containing key vector
         - **value** (batch, time, dim): Tensor containing value vector
-        - **pos_embedding** (batch, time, dim): Positional embedding tensor
+        - **pos_embedding** (batch, time, dim) or (1, time, dim): Positional embedding tensor
         - **mask** (batch, 1, time2) or (batch, time1, time2): Tensor containing indices to be masked
 
     Returns:
@@ -69,6 +74,8 @@ class RelativeMultiHeadAttention(nn.Module):
 
         self.out_proj = Linear(d_model, d_model)
 
+        self._pos_cache = None  # (key, projected positional embedding), only kept without autograd
+
     def forward(
             self,
             query: Tensor,
@@ -77,12 +84,15 @@ class RelativeMultiHeadAttention(nn.Module):
             pos_embedding: Tensor,
             mask: Optional[Tensor] = None,
     ) -> Tensor:
+        if ATTENTION_BACKEND == 'sdpa':
+            return self._forward_sdpa(query, key, value, pos_embedding, mask)
+
         batch_size = value.size(0)
 
         query = self.query_proj(query).view(batch_size, -1, self.num_heads, self.d_head)
         key = self.key_proj(key).view(batch_size, -1, self.num_heads, self.d_head).permute(0, 2, 1, 3)
         value = self.value_proj(value).view(batch_size, -1, self.num_heads, self.d_head).permute(0, 2, 1, 3)
-        pos_embedding = self.pos_proj(pos_embedding).view(batch_size, -1, self.num_heads, self.d_head)
+        pos_embedding = self.pos_proj(pos_embedding).view(pos_embedding.size(0), -1, self.num_heads, self.d_head)
 
         content_score = torch.matmul((query + self.u_bias).transpose(1, 2), key.transpose(2, 3))
         pos_score = torch.matmul((query + self.v_bias).transpose(1, 2), pos_embedding.permute(0, 2, 3, 1))
@@ -112,6 +122,44 @@ class RelativeMultiHeadAttention(nn.Module):
 
         return pos_score
 
+    def _forward_sdpa(self, query: Tensor, key: Tensor, value: Tensor, pos_embedding: Tensor, mask: Optional[Tensor] = None) -> Tensor:
+        """ Same as forward, with the content score, softmax, dropout and weighted sum fused in scaled_dot_product_attention
+        """
+        batch_size = value.size(0)
+
+        query = self.query_proj(query).view(batch_size, -1, self.num_heads, self.d_head).transpose(1, 2)
+        key = self.key_proj(key).view(batch_size, -1, self.num_heads, self.d_head).transpose(1, 2)
+        value = self.value_proj(value).view(batch_size, -1, self.num_heads, self.d_head).transpose(1, 2)
+
+        pos_score = torch.matmul((query + self.v_bias.unsqueeze(1)) / self.sqrt_dim, self._projected_pos(pos_embedding))
+        pos_bias = self._relative_shift(pos_score)
+        if mask is not None:
+            pos_bias = pos_bias.masked_fill(mask.unsqueeze(1), -1e9)
+
+        context = F.scaled_dot_product_attention(
+            query + self.u_bias.unsqueeze(1), key, value, attn_mask=pos_bias,
+            dropout_p=self.dropout.p if self.training else 0.0, scale=1 / self.sqrt_dim,
+        )
+        context = context.transpose(1, 2).reshape(batch_size, -1, self.d_model)
+
+        return self.out_proj(context)
+
+    def _projected_pos(self, pos_embedding: Tensor) -> Tensor:
+        """ Project the positional embedding of a sequence once for the batch, (num_heads, d_head, time), reused
+            across calls while the projection is unchanged and no gradient is recorded (e.g. evaluation)
+        """
+        weight = self.pos_proj.linear.weight
+        cache_key = (pos_embedding.shape, pos_embedding.device, pos_embedding.dtype, weight._version, weight.data_ptr())
+        if (not torch.is_grad_enabled()) and (self._pos_cache is not None) and (self._pos_cache[0] == cache_key):
+            return self._pos_cache[1]
+
+        pos = self.pos_proj(pos_embedding[:1]).view(-1, self.num_heads, self.d_head).permute(1, 2, 0)
+        if not torch.is_grad_enabled():
+            self._pos_cache = (cache_key, pos)
+        else:
+            self._pos_cache = None
+        return pos
+
 
 class MultiHeadedSelfAttentionModule(nn.Module):
     """
@@ -142,8 +190,7 @@ class MultiHeadedSelfAttentionModule(nn.Module):
 
     def forward(self, inputs: Tensor, mask: Optional[Tensor] = None):
         batch_size, seq_length, _ = inputs.size()
-        pos_embedding = self.positional_encoding(seq_length)
-        pos_embedding = pos_embedding.repeat(batch_size, 1, 1)
+        pos_embedding = self.positional_encoding(seq_length)  # (1, time, dim), broadcast over the batch
 
         inputs = self.layer_norm(inputs)
         outputs = self.attention(inputs, inputs, inputs, pos_embedding=pos_embedding, mask=mask)
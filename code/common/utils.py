@@ -3,9 +3,14 @@
 """
 
 import os
+import traceback
+import multiprocessing
+import multiprocessing.connection
+import scipy.io
 import scipy.signal
 import numpy as np
 import torch
+import torch.distributed as dist
 import random
 import json
 import pickle
@@ -16,6 +21,7 @@ from torch.utils.flop_counter import FlopCounterMode
 from sklearn.manifold import TSNE
 from sklearn.datasets import load_iris
 from sklearn.decomposition import PCA
+from common.utils_module import seed_patch_masks, set_patch_mask_rank, PatchMask
 
 
 def detect_infnan(data, mode='torch', info=''):
@@ -44,16 +50,142 @@ def set_seed(seed):
     torch.manual_seed(seed) # CPU
     torch.cuda.manual_seed_all(seed) # multi-GPU
     torch.cuda.manual_seed(seed)    # current GPU
+    seed_patch_masks(seed) # mask generators
     torch.backends.cudnn.deterministic = True
     torch.backends.cudnn.benchmark = False
 
 
-def set_random_seed(seed):
+def set_random_seed(seed, rank=0):
+    """ Fix random seeds of data drawing
+        Args:       rank    - process rank of distributed training, offsetting the seeds so that processes draw different data
+    """
+    seed = seed + rank
     np.random.seed(seed)
     random.seed(seed)
     torch.manual_seed(seed)
     torch.cuda.manual_seed_all(seed)
     torch.cuda.manual_seed(seed)
+    seed_patch_masks(seed)
+
+
+def init_distributed(backend='gloo'):
+    """ Initialize the default process group from the environment variables set by torchrun (RANK, WORLD_SIZE, LOCAL_RANK,
+        MASTER_ADDR, MASTER_PORT), e.g. torchrun --nnodes 2 --nproc-per-node 4 ... on each node
+        Args:       backend     - 'nccl' for one process per GPU, 'gloo' for processes on CPUs
+        Returns:    rank, world_size, local_rank - (0, 1, 0) when not launched for distributed training
+    """
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size == 1:
+        return 0, 1, 0
+    rank = int(os.environ['RANK'])
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    if backend == 'nccl':
+        torch.cuda.set_device(local_rank)
+    if not dist.is_initialized():
+        dist.init_process_group(backend=backend, rank=rank, world_size=world_size)
+    set_patch_mask_rank(rank)
+    return rank, world_size, local_rank
+
+
+class NullWriter():
+    """ Stand-in of tensorboardX SummaryWriter ignoring all logging calls, for the processes other than rank 0
+    """
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+def run_forked_jobs(fn, jobs, nslot, on_result, prepare=None):
+    """ Run jobs concurrently in forked processes, at most nslot at a time, and hand their results back to the calling process
+        A forked process inherits the memory of the calling process (e.g. datasets built by prepare) without pickling
+        Args:       fn          - function called as fn(*args, slot=slot) in a job process, returning a picklable result
+                    jobs        - list of job keys, taken from the front
+                    nslot       - number of concurrent processes, slot in [0, nslot) is the index of the process slot
+                    on_result   - function called as on_result(job, result) in the calling process when a job finishes,
+                                  returning new jobs to run before the remaining ones (or None)
+                    prepare     - function called as prepare(job) in the calling process before the job is forked, returning args
+                                  of fn (default: (job, ))
+        Returns:    failed      - jobs whose process raised an error or exited without a result
+    """
+    ctx = multiprocessing.get_context('fork')
+    running = {}
+    free_slots = list(range(nslot))
+    failed = []
+    while (len(jobs) > 0) | (len(running) > 0):
+        while (len(jobs) > 0) & (len(free_slots) > 0):
+            job = jobs.pop(0)
+            slot = free_slots.pop(0)
+            args = (job, ) if prepare is None else prepare(job)
+            recv_conn, send_conn = ctx.Pipe(duplex=False)
+            process = ctx.Process(target=_forked_job, args=(fn, args, slot, send_conn))
+            process.start()
+            send_conn.close()
+            running[process.sentinel] = (process, recv_conn, job, slot)
+        for sentinel in multiprocessing.connection.wait(list(running.keys())):
+            process, recv_conn, job, slot = running.pop(sentinel)
+            status, result = recv_conn.recv() if recv_conn.poll() else ('error', f'exit code {process.exitcode}')
+            process.join()
+            recv_conn.close()
+            free_slots += [slot]
+            if status == 'ok':
+                new_jobs = on_result(job, result)
+                if new_jobs is not None:
+                    jobs[:0] = new_jobs
+            else:
+                print(f'Job {job} failed: {result}')
+                failed += [job]
+    return failed
+
+
+def _forked_job(fn, args, slot, conn):
+    try:
+        conn.send(('ok', fn(*args, slot=slot)))
+    except BaseException:
+        conn.send(('error', traceback.format_exc()))
+    conn.close()
+
+
+def savemat_atomic(path, mdict):
+    """ Save a .mat file through a temporary file, so that readers (or a resumed run) never see a partially written file
+    """
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        scipy.io.savemat(f, mdict)
+    os.replace(tmp_path, path)
+
+
+def get_rng_state(model=None):
+    """ Get the states of the random number generators of the current process, stored as tensors and python types
+        Args:       model   - model whose PatchMask generators are included
+        Returns:    state   - dict to be restored by set_rng_state
+    """
+    np_state = np.random.get_state()
+    state = {
+        'python': random.getstate(),
+        'numpy': (np_state[0], torch.from_numpy(np_state[1].astype(np.int64)), np_state[2], np_state[3], np_state[4]),
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+        }
+    if model is not None:
+        state['patch_mask'] = [module.generator.get_state() for module in model.modules() if isinstance(module, PatchMask)]
+    return state
+
+
+def set_rng_state(state, model=None):
+    """ Restore the states of the random number generators got by get_rng_state
+    """
+    random.setstate(state['python'])
+    np_state = state['numpy']
+    np.random.set_state((np_state[0], np_state[1].numpy().astype(np.uint32), np_state[2], np_state[3], np_state[4]))
+    torch.set_rng_state(state['torch'])
+    if torch.cuda.is_available() & (len(state['cuda']) > 0):
+        torch.cuda.set_rng_state_all(state['cuda'])
+    if (model is not None) & ('patch_mask' in state):
+        patch_masks = [module for module in model.modules() if isinstance(module, PatchMask)]
+        for module, generator_state in zip(patch_masks, state['patch_mask']):
+            module.generator.set_state(generator_state)
 
 
 def get_nparams(model, param_key_list=[]):
@@ -72,11 +204,11 @@ def get_nparams(model, param_key_list=[]):
     return nparam, nparam_sum
 
 
-def get_FLOPs(model, input_shape, duration):
+def get_FLOPs(model, input_shape, duration, device='cuda'):
     """ Get floating point operations (FLOPs) (G/s)
     """ 
-    model.cuda()
-    x = torch.randn((input_shape)).cuda()
+    model.to(device)
+    x = torch.randn((input_shape)).to(device)
     with FlopCounterMode(model, display=False) as fcm:
         y = model(x)
         flops_forward_eval = fcm.get_total_flops()/duration/1e9
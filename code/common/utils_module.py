@@ -2,13 +2,14 @@
     Define some basic modules
 """
 
-import random
 import numpy as np
 from copy import deepcopy
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import math
+import weakref
+from collections import namedtuple
 
 
 def complex_multiplication(x, y):
@@ -25,8 +26,25 @@ def complex_conjugate_multiplication(x, y):
 #     return torch.stack((mod, phase), dim=-1)
 
 
+def cached_window(windows, win, win_len, device, dtype):
+    """ Get a window from a dict cache keyed by device and dtype, creating it on the first use
+        Args:       windows - dict cache of windows
+                    win     - window type, 'boxcar' or 'hann'
+    """
+    key = (device, dtype)
+    if key not in windows:
+        if win == 'hann':
+            windows[key] = torch.hann_window(window_length=win_len, device=device, dtype=dtype)
+        elif win == 'boxcar':
+            windows[key] = torch.ones(win_len, device=device, dtype=dtype)
+        else:
+            raise Exception('Unknown window type: ' + win)
+    return windows[key]
+
+
 class STFT(nn.Module):
     """ Get STFT coefficients of microphone signals (batch processing by pytorch)
+        Channels are folded into the batch dimension, so that all channels are transformed by one torch.stft call
         Args:       win_len         - the length of frame / window
                     win_shift_ratio - the ratio between frame shift and frame length
                     nfft            - the number of fft points
@@ -34,6 +52,7 @@ class STFT(nn.Module):
                                       'boxcar': a rectangular window (equivalent to no window at all)
                                       'hann': a Hann window
 					signal          - the microphone signals in time domain (nbatch, nsample, nch)
+					out             - optional output buffer (nbatch, nf, nt, nch), complex
         Returns:    stft            - STFT coefficients (nbatch, nf, nt, nch)
     """
 
@@ -45,76 +64,170 @@ class STFT(nn.Module):
         self.nfft = nfft
         self.win = win
         self.inv = inv
+        self.windows = {} # (device, dtype) -> window
 
-    def forward(self, signal):
+    def forward(self, signal, out=None):
 
-        nsample = signal.shape[-2]
-        nch = signal.shape[-1]
+        nb, nsample, nch = signal.shape
         win_shift = int(self.win_len * self.win_shift_ratio)
-        nf = int(self.nfft / 2) + 1
 
-        nb = signal.shape[0]
+        signal = signal.to(torch.float32).permute(0, 2, 1).reshape(nb * nch, nsample)
+        window = cached_window(self.windows, self.win, self.win_len, signal.device, signal.dtype)
         if self.inv:
-            nt = int((nsample) / win_shift) + 1  # for iSTFT
-        else:
-            nt = np.floor((nsample - self.win_len) / win_shift + 1).astype(int)
-        stft = torch.zeros((nb, nf, nt, nch), dtype=torch.complex64).to(signal.device)
-
-        if self.win == 'hann':
-            window = torch.hann_window(window_length=self.win_len, device=signal.device)
-        for ch_idx in range(0, nch, 1):
-            if self.inv:
-                stft[:, :, :, ch_idx] = torch.stft(signal[:, :, ch_idx], n_fft = self.nfft, hop_length = win_shift, win_length = self.win_len,
+            stft = torch.stft(signal, n_fft = self.nfft, hop_length = win_shift, win_length = self.win_len,
                 window = window, center = True, normalized = False, return_complex = True)  # for iSTFT
-            else:
-                stft[:, :, :, ch_idx] = torch.stft(signal[:, :, ch_idx], n_fft=self.nfft, hop_length=win_shift, win_length=self.win_len,
-                    window=window, center=False, normalized=False, return_complex=True)
+        else:
+            stft = torch.stft(signal, n_fft=self.nfft, hop_length=win_shift, win_length=self.win_len,
+                window=window, center=False, normalized=False, return_complex=True)
+        stft = stft.reshape(nb, nch, stft.shape[-2], stft.shape[-1]).permute(0, 2, 3, 1)
+
+        if out is not None:
+            return out.copy_(stft)
         return stft
 
 
 class ISTFT(nn.Module):
     """ Get inverse STFT (batch processing by pytorch) 
+        Channels are folded into the batch dimension, so that all channels are transformed by one torch.istft call
 		Args:		stft            - STFT coefficients (nbatch, nf, nt, nch)
 					win_len         - the length of frame / window
 					win_shift_ratio - the ratio between frame shift and frame length
 					nfft            - the number of fft points
+					win             - window type, 'boxcar' or 'hann'
+					out             - optional output buffer (nbatch, nsample, nch)
 		Returns:	signal          - time-domain microphone signals (nbatch, nsample, nch)
 	"""
-    def __init__(self, win_len, win_shift_ratio, nfft, inv=False):
+    def __init__(self, win_len, win_shift_ratio, nfft, win='boxcar', inv=False):
         super(ISTFT, self).__init__()
 
         self.win_len = win_len
         self.win_shift_ratio = win_shift_ratio
         self.nfft = nfft
+        self.win = win
         self.inv = inv
+        self.windows = {} # (device, dtype) -> window
 
-    def forward(self, stft):
+    def forward(self, stft, out=None):
         # stft: nb, nf, nt, nch
-        nf = stft.shape[-3]
-        nt = stft.shape[-2]
-        nch = stft.shape[-1]
-        nb = stft.shape[0]
+        nb, nf, nt, nch = stft.shape
         win_shift = int(self.win_len * self.win_shift_ratio)
         if self.inv:
             nsample = (nt - 1) * win_shift
         else:
             nsample = (nt + 1) * win_shift #-1
-        signal = torch.zeros((nb, nsample, nch)).to(stft.device)
-        win_shift = int(self.win_len * self.win_shift_ratio)
-        for ch_idx in range(0, nch, 1):
-            if self.inv:
-                signal_temp = torch.istft(stft[:, :, :, ch_idx], n_fft=self.nfft, hop_length=win_shift, win_length=self.win_len,
-                                                    center=True, normalized=False, return_complex=False)
-                signal[:, :, ch_idx] = signal_temp[:, 0:nsample] # for STFT
-            else:
-                signal_temp = torch.istft(stft[:, :, :, ch_idx], n_fft=self.nfft, hop_length=win_shift, win_length=self.win_len,
-                                                    center=False, normalized=False, return_complex=False)
-                signal[:, :, ch_idx] = signal_temp
+
+        stft = stft.to(torch.complex64).permute(0, 3, 1, 2).reshape(nb * nch, nf, nt)
+        window = cached_window(self.windows, self.win, self.win_len, stft.device, stft.real.dtype)
+        if self.inv:
+            signal = torch.istft(stft, n_fft=self.nfft, hop_length=win_shift, win_length=self.win_len,
+                                    window=window, center=True, normalized=False, return_complex=False)
+            signal = signal[:, 0:nsample] # for STFT
+        else:
+            signal = torch.istft(stft, n_fft=self.nfft, hop_length=win_shift, win_length=self.win_len,
+                                    window=window, center=False, normalized=False, return_complex=False)
+        signal = signal.reshape(nb, nch, nsample).permute(0, 2, 1)
+
+        if out is not None:
+            return out.copy_(signal)
         return signal
 
 
+class STFTStream():
+    """ Streaming STFT of a long signal pushed block by block, cut into sliding windows of frames
+        Each frame is computed once and shared by all windows overlapping it, and only the samples of the last incomplete
+        frame and the frames of the pending windows are kept, so memory does not grow with the signal length
+        Args:       stft        - STFT module (inv=False, i.e., frames without centering)
+                    nt          - number of frames of a window
+                    nt_hop      - number of frames between the starts of adjacent windows (0 < nt_hop <= nt)
+    """
+    def __init__(self, stft, nt, nt_hop):
+        assert not stft.inv, 'STFTStream requires frames without centering (inv=False)'
+        assert 0 < nt_hop <= nt, f'nt_hop={nt_hop} is not in (0, nt={nt}]'
+        self.stft = stft
+        self.nt = nt
+        self.nt_hop = nt_hop
+        self.win_len = stft.win_len
+        self.win_shift = int(stft.win_len * stft.win_shift_ratio)
+        self.reset()
+
+    def reset(self):
+        self._sig = None        # samples from the start of the next frame, (1, nsample, nch)
+        self._frames = None     # buffered frames, (1, nf, nframe, nch)
+        self._frame_st = 0      # index of the first buffered frame
+        self._win_st = 0        # first frame of the next window
+        self._win_ed = 0        # last frame (exclusive) of the emitted windows
+
+    def _emit(self, win_sts):
+        if len(win_sts) == 0:
+            return None, np.zeros(0, dtype=np.int64)
+        windows = torch.cat([self._frames[:, :, st-self._frame_st:st-self._frame_st+self.nt, :] for st in win_sts], dim=0)
+        self._win_ed = win_sts[-1] + self.nt
+        # Keep the frames of the next window, and the last nt frames for the window at the end of the signal
+        nframe_end = self._frame_st + self._frames.shape[2]
+        keep_st = max(min(self._win_st, nframe_end - self.nt), self._frame_st)
+        self._frames = self._frames[:, :, keep_st-self._frame_st:, :].clone()
+        self._frame_st = keep_st
+        return windows, np.array(win_sts, dtype=np.int64)
+
+    def push(self, sig_block):
+        """ Args:       sig_block   - the next block of the signal (nsample, nch)
+            Returns:    windows     - STFT coefficients of the completed windows (nwin, nf, nt, nch), None if nwin=0
+                        win_sts     - indexes of the first frames of the completed windows (nwin, )
+        """
+        sig = sig_block[np.newaxis, ...]
+        if self._sig is not None:
+            sig = torch.cat((self._sig, sig.to(self._sig.device)), dim=1)
+        nframe = (sig.shape[1] - self.win_len) // self.win_shift + 1
+        if nframe <= 0:
+            self._sig = sig
+            return self._emit([])
+        frames = self.stft(sig[:, :(nframe-1)*self.win_shift+self.win_len, :]) # (1, nf, nframe, nch)
+        self._sig = sig[:, nframe*self.win_shift:, :].clone()
+        self._frames = frames if self._frames is None else torch.cat((self._frames, frames), dim=2)
+
+        nframe_end = self._frame_st + self._frames.shape[2]
+        win_sts = []
+        while self._win_st + self.nt <= nframe_end:
+            win_sts += [self._win_st]
+            self._win_st += self.nt_hop
+        return self._emit(win_sts)
+
+    def flush(self):
+        """ Emit a last window aligned to the end of the signal, if the frames at the end are not covered by any window
+            Returns:    windows     - (1, nf, nt, nch), None if there is no such window
+                        win_sts     - (1, ) or (0, )
+        """
+        if self._frames is None:
+            return self._emit([])
+        nframe_end = self._frame_st + self._frames.shape[2]
+        if (nframe_end > self._win_ed) & (nframe_end >= self.nt):
+            return self._emit([nframe_end - self.nt])
+        return self._emit([])
+
+
+_pair_idxes = {} # (nch, ch_mode, device) -> pair index table
+
+def channel_pair_index(nch, ch_mode, device):
+    """ Get the (cached) index table of microphone pairs
+        Args:       nch         - the number of channels
+                    ch_mode     - 'M': pairs of the reference channel and the others, (0,1), (0,2), ..., (0,nch-1)
+                                  'MM': all pairs in row-major order, (0,1), ..., (0,nch-1), (1,2), ..., (nch-2,nch-1)
+        Returns:    pair_idx    - channel indexes of pairs (2, npair)
+    """
+    key = (nch, ch_mode, device)
+    if key not in _pair_idxes:
+        if ch_mode == 'M':
+            pair_idx = torch.stack((torch.zeros(nch-1, dtype=torch.long), torch.arange(1, nch)), dim=0)
+        elif ch_mode == 'MM':
+            pair_idx = torch.triu_indices(nch, nch, offset=1)
+        else:
+            raise Exception('Microphone channel mode unrecognised')
+        _pair_idxes[key] = pair_idx.to(device)
+    return _pair_idxes[key]
+
+
 class AddChToBatch(nn.Module):
-    """ Change dimension from  (nb, nch, ...) to (nb*(nch-1), ...) 
+    """ Change dimension from  (nb, nch, ...) to (nb*(nch-1), 2, ...) / (nb*(nch-1)*nch/2, 2, ...)
 	"""
     def __init__(self, ch_mode):
         super(AddChToBatch, self).__init__()
@@ -125,23 +238,13 @@ class AddChToBatch(nn.Module):
         nb = data.shape[0]
         nch = data.shape[1]
 
-        if self.ch_mode == 'M':
-            data_adjust = torch.zeros((nb*(nch-1),2)+data.shape[2:], dtype=torch.complex64).to(data.device) # (nb*(nch-1),2,nf,nt)
-            for b_idx in range(nb):
-                st = b_idx*(nch-1)
-                ed = (b_idx+1)*(nch-1)
-                data_adjust[st:ed, 0, ...] = data[b_idx, 0 : 1, ...].expand((nch-1,)+data.shape[2:])
-                data_adjust[st:ed, 1, ...] = data[b_idx, 1 : nch, ...]
+        if (self.ch_mode == 'M') | (self.ch_mode == 'MM'):
+            pair_idx = channel_pair_index(nch, self.ch_mode, data.device)
+            npair = pair_idx.shape[1]
+            data_adjust = torch.index_select(data.to(torch.complex64), 1, pair_idx.reshape(-1)) # (nb,2*npair,nf,nt)
+            data_adjust = data_adjust.reshape((nb, 2, npair)+data.shape[2:]).transpose(1, 2)
+            data_adjust = data_adjust.reshape((nb*npair, 2)+data.shape[2:]) # (nb*(nch-1),2,nf,nt)/(nb*(nch-1)*nch/2,2,nf,nt)
 
-        elif self.ch_mode == 'MM':
-            data_adjust = torch.zeros((nb*int((nch-1)*nch/2),2)+data.shape[2:], dtype=torch.complex64).to(data.device) # (nb*(nch-1)*nch/2,2,nf,nt)
-            for b_idx in range(nb):
-                for ch_idx in range(nch-1):
-                    st = b_idx*int((nch-1)*nch/2) + int((2*nch-2-ch_idx+1)*ch_idx/2)
-                    ed = b_idx*int((nch-1)*nch/2) + int((2*nch-2-ch_idx)*(ch_idx+1)/2)
-                    data_adjust[st:ed, 0, ...] = data[b_idx, ch_idx:ch_idx+1, ...].expand((nch-ch_idx-1,)+data.shape[2:])
-                    data_adjust[st:ed, 1, ...] = data[b_idx, ch_idx+1:, ...]
-                    
         else:
             data_adjust = deepcopy(data)       
 
@@ -158,11 +261,7 @@ class RemoveChFromBatch(nn.Module):
 	def forward(self, data, nb):
 		if (self.ch_mode == 'MM') | (self.ch_mode == 'M'):
 			nmic = int(data.shape[0]/nb)
-			data_adjust = torch.zeros((nb, nmic)+data.shape[1:], dtype=torch.float32).to(data.device)
-			for b_idx in range(nb):
-				st = b_idx * nmic
-				ed = (b_idx + 1) * nmic
-				data_adjust[b_idx, ...] = data[st:ed, ...]
+			data_adjust = data.reshape((nb, nmic)+data.shape[1:]).to(torch.float32)
 		else:
 			data_adjust = deepcopy(data)
 
@@ -244,131 +343,152 @@ class PatchRecover(nn.Module):
         return vec  # (nbatch, nf, nt, nmic) / (nbatch, nf, nt, nreim, nmic)
 
 
+_patch_masks = weakref.WeakSet() # PatchMask modules, re-seeded by seed_patch_masks
+_patch_mask_rank = 0 # process rank in distributed training, offsetting the seeds of mask generators
+
+def seed_patch_masks(seed):
+    """ Re-seed the mask generators of all PatchMask modules of the current process
+    """
+    for patch_mask in list(_patch_masks):
+        patch_mask.manual_seed(seed)
+
+def set_patch_mask_rank(rank):
+    """ Offset the seeds of all mask generators of the current process (and its DataLoader workers) by the process rank,
+        so that the processes of distributed training, seeded alike, draw different masks
+    """
+    global _patch_mask_rank
+    _patch_mask_rank = rank
+
+
 class PatchMask(nn.Module):
-    def __init__(self, patch_mode, nmasked_patch, npatch_shape, device):
+    """ Generate random patch masks for a batch at once, drawn from the module's own torch.Generator
+        Cluster modes mask patches in the order in which their first covering cluster is drawn: each possible cluster
+        start gets a random rank, the rank of a patch is the minimum rank of the clusters covering it (a min-pooling
+        dilation of the start ranks), and the nmasked_patch patches of the lowest ranks are masked.
+        Args:       patch_mode      - 'T', 'TF', 'T_cluster', 'T_cluster2', 'T_cluster_inverse' or 'T_1s'
+                    nmasked_patch   - number of masked patches
+                    npatch_shape    - [npatch along frequency, npatch along time]
+                    seed            - seed of the mask generator (default: the seed of the global torch RNG)
+    """
+    def __init__(self, patch_mode, nmasked_patch, npatch_shape, device, seed=None):
         super(PatchMask, self).__init__()
         self.patch_mode = patch_mode
         self.nmasked_patch = nmasked_patch
         self.npatch_shape = npatch_shape
         self.device = device
+        assert self.patch_mode in ['T', 'TF', 'T_cluster', 'T_cluster2', 'T_cluster_inverse', 'T_1s'], 'Patch mode is unrecognized'
+        self.generator = torch.Generator()
+        self.manual_seed(torch.initial_seed() if seed is None else seed)
+        _patch_masks.add(self)
+
+    def manual_seed(self, seed):
+        # the CPU generator keeps the lower 32 bits of a seed, which are offset by a large odd stride for each rank
+        self.generator.manual_seed((int(seed) + _patch_mask_rank * 0x9E3779B9) % 2**32)
 
     def forward(self, data_shape):
+        """ Args:       data_shape      - (nbatch, npatch, dpatch, nreim, nmic)
+            Returns:    mask_patch      - masked patches (nbatch, npatch), bool
+                        mask_ch         - masked channel (nbatch, nmic), bool
+                        mask_patch_idx  - indexes of masked patches in ascending order (nbatch, nmasked_patch)
+                        mask_ch_idx     - index of masked channel (nbatch, 1)
+        """
         nbatch, npatch, dpatch, _, nmic = data_shape
-
-        mask_dense = torch.ones((nbatch, npatch, dpatch, nmic), device=self.device)  # (nbatch, npatch, dpatch, nmic)
-        mask_patch_dense = torch.ones((nbatch, npatch, dpatch, nmic), device=self.device)  # (nbatch, npatch, dpatch, nmic)
-        mask_ch_dense = torch.ones((nbatch, npatch, dpatch, nmic), device=self.device)  # (nbatch, npatch, dpatch, nmic)
-        mask_patch_idx = torch.empty((nbatch, self.nmasked_patch), device=self.device, requires_grad=False).long()  # (nbatch, nmasked_patch)
-        mask_ch_idx = torch.empty((nbatch, 1), device=self.device, requires_grad=False).long() # (nbatch, 1)
-        for b_idx in range(nbatch):
-            # randomly generate # nmasked_patch mask indexes without duplicate
-            mask_patch_idx[b_idx, :] = self.gen_mask_idx(npatch_shape=self.npatch_shape, nmasked_patch=self.nmasked_patch, patch_mode=self.patch_mode)
-            # mask_ch_idx[b_idx, :] = random.randrange(nmic)
-            mask_ch_idx[b_idx, :] = random.randint(0, nmic-1)
-            mask_dense[b_idx, mask_patch_idx[b_idx], :, mask_ch_idx[b_idx, :]] = 0
-            mask_patch_dense[b_idx, mask_patch_idx[b_idx], :, :] = 0
-            mask_ch_dense[b_idx, :, :, mask_ch_idx[b_idx, :]] = 0
-
-        return mask_dense, mask_patch_dense, mask_ch_dense, mask_patch_idx, mask_ch_idx
-        # mask_dense/mask_patch_dense/mask_ch_dense: (nbatch, npatch, dpatch, nmic), mask_patch_idx: (nbatch, nmasked_patch), mask_ch_idx: (nbatch, 1)
-
-    def gen_mask_idx(self, npatch_shape=[16, 16], nmasked_patch=10, cluster=1, patch_mode='TF'):
-        npatch = npatch_shape[0] * npatch_shape[1]
-
-        if nmasked_patch > npatch:
+        masks = self.gen_masks(nbatch=nbatch, npatch=npatch, nmic=nmic)
+
+        return tuple(mask.to(self.device) for mask in masks)
+
+    def gen_masks(self, nbatch, npatch, nmic):
+        """ Generate the masks of a batch on the CPU
+            Returns:    mask_patch, mask_ch, mask_patch_idx, mask_ch_idx - as forward
+        """
+        mask_patch = self.gen_mask(nbatch=nbatch, npatch=npatch) # (nbatch, npatch)
+        nmasked_patch = int(mask_patch[0].sum())
+        mask_patch_idx = torch.argsort((~mask_patch).float(), dim=1, stable=True)[:, :nmasked_patch] # (nbatch, nmasked_patch)
+        mask_ch_idx = torch.randint(0, nmic, (nbatch, 1), generator=self.generator) # (nbatch, 1)
+        mask_ch = torch.zeros((nbatch, nmic), dtype=torch.bool).scatter_(1, mask_ch_idx, True) # (nbatch, nmic)
+
+        return mask_patch, mask_ch, mask_patch_idx, mask_ch_idx
+
+    def gen_mask(self, nbatch, npatch):
+        """ Returns:    mask_patch  - masked patches (nbatch, npatch), bool
+        """
+        if self.nmasked_patch > npatch:
             raise Exception('Number of masked patches is out of range')
 
-        if patch_mode == 'TF':
-            """ 
-				generate mask for patches with a dimension of 16*16 (time frames*frequency bins)
-				Process: find one block of patches, and then another .... until the number of patches reaches nmasked_patch 
-
-			"""
-            mask_id = []
-
-            # randomize clutering factor in [3,6)
-            cur_clus = random.randrange(cluster) + 3
-
-            while len(list(set(mask_id))) <= nmasked_patch:
-                start_id = random.randrange(npatch)
-
-                cur_mask = []
-                for i in range(0, cur_clus):
-                    for j in range(0, cur_clus):
-                        mask_cand = start_id + npatch_shape[1] * i + j
-                        if mask_cand > 0 and mask_cand < npatch:
-                            cur_mask.append(mask_cand)
-                mask_id = mask_id + cur_mask
-            mask_id = list(set(mask_id))[:nmasked_patch]
-            return torch.tensor(mask_id)
-
-        elif patch_mode == 'T':
-
-            mask_id = random.sample(range(0, npatch), nmasked_patch)
-            return torch.tensor(mask_id)
-        
-        elif patch_mode == 'T_cluster':
-            mask_id = []
-
-            # randomize clutering factor in [0,5)
-            cur_clus = random.randrange(cluster) + 5
-
-            while len(list(set(mask_id))) <= nmasked_patch:
-                start_id = random.randrange(npatch)
+        mask_patch = torch.zeros((nbatch, npatch), dtype=torch.bool)
+        if self.patch_mode == 'T_1s':
+            mask_patch[:, 192:256] = True # 1s masked
+            return mask_patch
 
-                cur_mask = []
-                for i in range(0, cur_clus):
-                        mask_cand = start_id + i
-                        if mask_cand > 0 and mask_cand < npatch:
-                            cur_mask.append(mask_cand)
-                mask_id = mask_id + cur_mask
-            mask_id = list(set(mask_id))[:nmasked_patch]
-
-            return torch.tensor(mask_id)
-        
-        elif patch_mode == 'T_cluster_inverse':
-            mask_id = []
-            mask_id_set = list(range(npatch))
+        if self.patch_mode == 'T':
+            rank = torch.rand((nbatch, npatch), generator=self.generator)
 
-            # randomize clutering factor in [0,5)
-            cur_clus = random.randrange(cluster) + 5
+        elif self.patch_mode == 'TF':
+            # clusters of 3*3 patches (time frames*frequency bins)
+            clu_size = 3
+            start_rank = torch.rand((nbatch, 1, self.npatch_shape[0], self.npatch_shape[1]), generator=self.generator)
+            start_rank = F.pad(-start_rank, (clu_size-1, 0, clu_size-1, 0), value=-math.inf)
+            rank = -F.max_pool2d(start_rank, kernel_size=clu_size, stride=1).reshape(nbatch, npatch)
 
-            while len(list(set(mask_id))) <= nmasked_patch:
-                start_id = random.randrange(npatch)
-
-                cur_mask = []
-                for i in range(0, cur_clus):
-                        mask_cand = start_id + i
-                        if mask_cand > 0 and mask_cand < npatch:
-                            cur_mask.append(mask_cand)
-                mask_id = mask_id + cur_mask
-            mask_id = list(set(mask_id))[:nmasked_patch]
-
-            for id in mask_id:
-                mask_id_set.remove(id)
+        elif (self.patch_mode == 'T_cluster') | (self.patch_mode == 'T_cluster_inverse'):
+            # clusters of 5 consecutive patches
+            clu_size = 5
+            start_rank = torch.rand((nbatch, 1, npatch), generator=self.generator)
+            start_rank = F.pad(-start_rank, (clu_size-1, 0), value=-math.inf)
+            rank = -F.max_pool1d(start_rank, kernel_size=clu_size, stride=1)[:, 0, :]
 
-            return torch.tensor(mask_id_set)
-        
-        elif patch_mode == 'T_cluster2':
+        elif self.patch_mode == 'T_cluster2':
+            # clusters of 5 consecutive patches aligned to multiples of 5
             clu_size = 5
-            clu_start_id = random.sample(range(0, npatch, clu_size), math.ceil(nmasked_patch/clu_size)+1)
-            mask_id = []
-            for clu_idx in range(len(clu_start_id)):
-                for idx in range(clu_size):
-                    mask_cand = clu_start_id[clu_idx] + idx
-                    if mask_cand > 0 and mask_cand < npatch:
-                        mask_id = mask_id + [mask_cand]
-            mask_id = list(set(mask_id))[:nmasked_patch]
-
-            return torch.tensor(mask_id)
-        
-        elif patch_mode == 'T_1s':
+            rank = torch.rand((nbatch, math.ceil(npatch/clu_size)), generator=self.generator)
+            rank = torch.repeat_interleave(rank, clu_size, dim=1)[:, :npatch].contiguous()
+
+        if self.patch_mode != 'T':
+            rank[:, 0] = math.inf # the first patch is never masked by clusters
+
+        # patches of the same cluster share a rank and are taken in ascending order
+        mask_patch_idx = torch.argsort(rank, dim=1, stable=True)[:, :self.nmasked_patch]
+        mask_patch.scatter_(1, mask_patch_idx, True)
+        if self.patch_mode == 'T_cluster_inverse':
+            mask_patch = ~mask_patch
+
+        return mask_patch
+
+
+# patch masks attached to a batch by PatchMaskCollate, told apart from the other items of a batch by their type
+PatchMasks = namedtuple('PatchMasks', ['mask_patch', 'mask_ch', 'mask_patch_idx', 'mask_ch_idx'])
+
+class PatchMaskCollate():
+    """ Collate a batch of microphone signals and attach its patch masks, so that masks are generated on the CPU by
+        DataLoader workers and overlap with the training step. A worker seeds its copy of the mask generator with the
+        worker seed, which the DataLoader draws from the main-process RNG, so the mask stream of an epoch is replayed
+        after set_random_seed. Without workers, the masks are drawn from the generator of the model itself.
+        Args:       patch_mask  - PatchMask of the model
+                    npatch      - number of patches of a sample
+                    ch_mode     - microphone channel mode of the learner ('M' or 'MM'), giving the number of microphone pairs of a sample
+                    nmic        - number of microphones of a pair
+        Returns:    batch       - collated batch followed by the masks of its microphone pairs, (mic_sig_batch, ..., PatchMasks)
+    """
+    def __init__(self, patch_mask, npatch, ch_mode='M', nmic=2):
+        assert ch_mode in ['M', 'MM'], 'Unrecognized microphone channel mode~'
+        self.patch_mask = patch_mask
+        self.npatch = npatch
+        self.ch_mode = ch_mode
+        self.nmic = nmic
+        self.worker_seed = None
 
-            mask_id = list(range(192, 256)) # 1s masked
-            return torch.tensor(mask_id)
+    def __call__(self, samples):
+        worker_info = torch.utils.data.get_worker_info()
+        if (worker_info is not None) and (worker_info.seed != self.worker_seed):
+            self.patch_mask.manual_seed(worker_info.seed)
+            self.worker_seed = worker_info.seed
 
-        else:
-            raise Exception('Patch mode is unrecognized')
+        batch = torch.utils.data.default_collate(samples)
+        nb, _, nch = batch[0].shape
+        npair = nch - 1 if self.ch_mode == 'M' else nch * (nch - 1) // 2
+        masks = self.patch_mask.gen_masks(nbatch=nb*npair, npatch=self.npatch, nmic=self.nmic)
+
+        return tuple(batch) + (PatchMasks(*masks), )
 
 
 class DPIPD(nn.Module):
@@ -452,11 +572,8 @@ class DPIPD(nn.Module):
             data_adjust = data[..., 0, 1:] # (..., nmic-1)
         elif self.ch_mode == 'MM':
             nmic = data.shape[-1]
-            data_adjust = torch.empty(data.shape[:-2] + (int(nmic*(nmic-1)/2),), dtype=torch.complex64)
-            for mic_idx in range(nmic - 1):
-                st = int((2 * nmic - 2 - mic_idx + 1) * mic_idx / 2)
-                ed = int((2 * nmic - 2 - mic_idx) * (mic_idx + 1) / 2)
-                data_adjust[..., st:ed] = data[..., mic_idx, (mic_idx+1):] # (..., nmic*(nmic-1)/2)
+            pair_idx = channel_pair_index(nmic, self.ch_mode, data.device)
+            data_adjust = data[..., pair_idx[0], pair_idx[1]].to(torch.complex64) # (..., nmic*(nmic-1)/2)
         else:
             raise Exception('Microphone channel mode unrecognised')
 
@@ -4,6 +4,7 @@
     Example: python gen_LOCATA.py --stage train --save-to../../data/MicSig/real_ds_locata
             python gen_LOCATA.py --stage val --save-to../../data/MicSig/real_ds_locata
             python gen_LOCATA.py --stage test --save-to../../data/MicSig/real_ds_locata
+            python gen_LOCATA.py --stage train --save-format shard --save-to../../data/MicSig/real_ds_locata_shard
 """
 
 import os
@@ -22,13 +23,16 @@ import tqdm
 import soundfile
 from torch.utils.data import DataLoader
 from utils_LOCATA import *
+from utils_shard import *
 
 parser = argparse.ArgumentParser(description='Generating multi-channel audio signals or RIRs')
 parser.add_argument('--stage', type=str, nargs='+', default=['train'], metavar='Stage', help='stage that generated data used for (default: train)')  
 parser.add_argument('--workers', type=int, default=32, metavar='Worker', help='number of workers (default: 32)')
 parser.add_argument('--fs', type=int, default=16000, metavar='SamplingRate', help='sampling rate (default: 16000)')
 parser.add_argument('--save-to', type=str, default='../../data/MicSig/real_ds_locata', metavar='SaveTo', help='save directory')
+parser.add_argument('--save-format', type=str, default='wav', metavar='SaveFormat', help='wav files or packed shards (default: wav)') # ['wav', 'shard']
 args = parser.parse_args()
+assert args.save_format in ['wav', 'shard'], args.save_format
  
 data_num = {'train': 80000, 'val': 1000, 'test': 4000}
 seeds = {'train':6000, 'val':6100, 'test':6200}
@@ -64,10 +68,18 @@ for stage in args.stage:
         if msg == '':
             print('Regenerating signals')
     
+    if args.save_format == 'shard':
+        shard_writer = MicSigShardWriter(save_dir=save_to, data_num=data_num[stage], nsample=int(realdataset.T*fs), nch=realdataset.nmic_selected, fs=fs)
+
     pbar = tqdm.tqdm(range(0, data_num[stage]), desc='generating signals')
     for idx, (mic_sig, anno) in enumerate(dataloader):
         pbar.update(1)
+        if args.save_format == 'shard':
+            shard_writer.write(idx, mic_sig.numpy(), annos={key: value.numpy() for key, value in anno.items()})
+            continue
         save_to_file = os.path.join(save_to, str(idx) + f'.wav')
         soundfile.write(save_to_file, mic_sig, fs)
         save_to_file = os.path.join(save_to, str(idx) + f'_info.npz')
-        np.savez(save_to_file, **anno)
\ No newline at end of file
+        np.savez(save_to_file, **anno)
+    if args.save_format == 'shard':
+        shard_writer.close()
\ No newline at end of file
@@ -4,9 +4,11 @@
     Examples:
         python gen_sig_from_real_rir.py --stage pretrain --dataset Mesh MIR DCASE dEchorate BUTReverb ACE --src_dir ../../../data/SrcSig/wsj0 --rir_dir ../../../data/RIR/real --save_dir ../../data/MicSig/real 
         python gen_sig_from_real_rir.py --stage preval --dataset DCASE BUTReverb --src_dir ../../../data/SrcSig/wsj0 --rir_dir ../../../data/RIR/real --save_dir ../../data/MicSig/real  
+        python gen_sig_from_real_rir.py --stage pretrain --dataset Mesh MIR DCASE dEchorate BUTReverb ACE --save_format shard --src_dir ../../../data/SrcSig/wsj0 --rir_dir ../../../data/RIR/real --save_dir ../../data/MicSig/real_shard 
 """
    
 import os
+import fnmatch
 cpu_num = 8*5
 os.environ["OMP_NUM_THREADS"] = str(cpu_num) 
 os.environ['OPENBLAS_NUM_THREADS'] = str(cpu_num)
@@ -27,8 +29,16 @@ from functools import lru_cache, cache
 from torch.utils.data import Dataset
 try:
     from utils_src import *
+    from utils_shard import *
+    from utils_resample import *
+    from utils_rirbank import *
+    from utils_manifest import *
 except:
     from data_generation.utils_src import *
+    from data_generation.utils_shard import *
+    from data_generation.utils_resample import *
+    from data_generation.utils_rirbank import *
+    from data_generation.utils_manifest import *
 
 
 # @cache
@@ -75,7 +85,8 @@ class RIRDataset(Dataset):
         dataset_sz=None, 
         load_info=False, 
         load_noise=True, 
-        load_noise_duration=None):
+        load_noise_duration=None,
+        rir_bank=False):
 
         self.fs = fs
         if isinstance(rir_dir_list, list):
@@ -88,37 +99,68 @@ class RIRDataset(Dataset):
         self.load_info = load_info
         self.load_noise = load_noise
         self.load_noise_duration = load_noise_duration
+        self.rir_bank = RIRBank(type(self).__name__, self.rir_files, fs, self.load_rir) if rir_bank else None
+        self.noise_items = self.match_noise_files() if load_noise else None
 
     def __len__(self):
         return self.dataset_sz
-    
-    def __getitem__(self, idx):
-        # idx = np.random.randint(0, self.dataset_sz)
+
+    def load_rir(self, idx):
+        """ Load the idx-th RIR (resampled to fs) and its annotations from files
+        """
         rir_file = self.rir_files[idx] 
-        rir = np.load(rir_file)
+        rir = np.load(resampled_path(rir_file, self.fs))
         rir = rir.astype(np.float32)
         info_file = str(rir_file).replace('.npy', '_info.npz')
         info = np.load(info_file)
-        if self.fs!= info['fs']:
-            rir = scipy.signal.resample_poly(rir, self.fs, info['fs'])
-        return_data = [rir]
-        
-        if self.load_noise:
-            noise_file = str(rir_file).replace('.npy', '_noise.wav')
+        rir_fs = self.fs if is_resampled(rir_file, self.fs) else info['fs']
+        if self.fs!= rir_fs:
+            rir = scipy.signal.resample_poly(rir, self.fs, rir_fs)
+        return [rir], info
+
+    def match_noise_files(self):
+        """ Match each RIR with the noise files recorded by the same microphones, using one catalog per noise directory
+            Returns:    noise_items - list of (noise file resolved by resampled_path, sampling rate, number of samples) lists for each RIR
+        """
+        catalogs = {}
+        matches = {} # (noise directory, microphone attribute) -> noise items
+        noise_items = []
+        for rir_file in self.rir_files:
             rir_attrs = str(rir_file).split('/')
             mic_attr_match = rir_attrs[-1].split('_')[1].split('.')[0]
             noise_dir = str(rir_file.parent).replace(rir_attrs[-4], rir_attrs[-4]+'_noise')
-            # noise_files = _match(noise_dir, mic_attr_match)
-            noise_files = list(Path(noise_dir).rglob(f"*_{mic_attr_match}*.wav"))
-            if noise_files == []:
+            if (noise_dir, mic_attr_match) not in matches:
+                if noise_dir not in catalogs:
+                    catalogs[noise_dir] = catalog_audio_files(noise_dir)
+                catalog = catalogs[noise_dir]
+                items = []
+                for noise_idx, noise_file in enumerate(catalog['path']):
+                    if fnmatch.fnmatch(os.path.basename(noise_file), f'*_{mic_attr_match}*.wav'):
+                        if is_resampled(noise_file, self.fs):
+                            noise_file = resampled_path(noise_file, self.fs)
+                            items += [(noise_file, self.fs, probe_audio(noise_file).frames)]
+                        else:
+                            items += [(str(noise_file), int(catalog['samplerate'][noise_idx]), int(catalog['frames'][noise_idx]))]
+                matches[(noise_dir, mic_attr_match)] = items
+            noise_items += [matches[(noise_dir, mic_attr_match)]]
+        return noise_items
+    
+    def __getitem__(self, idx):
+        # idx = np.random.randint(0, self.dataset_sz)
+        if self.rir_bank is not None:
+            (rir, ), info = self.rir_bank.get(idx)
+        else:
+            (rir, ), info = self.load_rir(idx)
+        return_data = [rir]
+        
+        if self.load_noise:
+            noise_items = self.noise_items[idx]
+            if noise_items == []:
                 nmic = rir.shape[1]
                 nsample = int(self.load_noise_duration * self.fs)
                 noise_signal = np.zeros((nsample, nmic))
             else:
-                noise_file = np.random.choice(noise_files, 1, replace=False)[0]
-                noise_fs = soundfile.info(noise_file).samplerate
-                noise_duration = soundfile.info(noise_file).duration
-                nsample_noise = int(noise_duration * noise_fs)
+                noise_file, noise_fs, nsample_noise = noise_items[np.random.randint(0, len(noise_items))]
                 nsample_desired = int(self.load_noise_duration * noise_fs)
                 assert nsample_noise>=nsample_desired, 'the sample number of noise signal is smaller than desired duration~'
                 st = np.random.randint(0, nsample_noise - nsample_desired+1)
@@ -194,6 +236,7 @@ class MicSigFromRIRDataset(Dataset):
         load_info,
         save_anno,
         save_to=None,
+        shard_writer=None,
         ):
 
         self.rirdataset = rirnoidataset
@@ -204,6 +247,7 @@ class MicSigFromRIRDataset(Dataset):
         self.load_info = load_info
         self.save_anno = save_anno
         self.save_to = save_to
+        self.shard_writer = shard_writer
         if dataset_sz is None:
             self.dataset_sz = int(1e8)
         else:
@@ -247,7 +291,9 @@ class MicSigFromRIRDataset(Dataset):
         mic_sig_srcs_dp = mic_sig_srcs_dp / value *0.9
 
         # Save data
-        if self.save_to:
+        if self.shard_writer is not None:
+            self.shard_writer.write(idx, mic_sig, annos={'SNR': snr})
+        elif self.save_to:
             Path(self.save_to).mkdir(parents=True, exist_ok=True)
             save_to_file = os.path.join(self.save_to, str(idx) + f'.wav')
             soundfile.write(save_to_file, mic_sig, self.fs)
@@ -315,7 +361,9 @@ if __name__ == '__main__':
     parser.add_argument('--rir_dir', type=str, default='', metavar='RIRDir', help='RIR directory')
     parser.add_argument('--save_dir', type=str, default='', metavar='SaveDir', help='save directory')
     parser.add_argument('--workers', type=int, default=32, metavar='Worker', help='number of workers (default: 32)')
+    parser.add_argument('--save_format', type=str, default='wav', metavar='SaveFormat', help='wav files or packed shards (default: wav)') # ['wav', 'shard']
     args = parser.parse_args()
+    assert args.save_format in ['wav', 'shard'], args.save_format
 
     if args.stage == 'pretrain':
         seed = 1
@@ -411,6 +459,18 @@ if __name__ == '__main__':
             load_noise_duration=args.T
             )
         
+        # Packed shards (one memory-mapped array for all samples) or one wav per sample
+        if args.save_format == 'shard':
+            shard_writer = MicSigShardWriter(
+                save_dir=save_dir,
+                data_num=sig_num,
+                nsample=int(args.T*args.fs),
+                nch=rirnoidataset[0][0].shape[1],
+                fs=args.fs,
+                )
+        else:
+            shard_writer = None
+
         # Microphone signal dataset
         micdataset = MicSigFromRIRDataset(
             rirnoidataset,
@@ -422,9 +482,12 @@ if __name__ == '__main__':
             load_info=False,
             save_anno=False,
             save_to=save_dir,
+            shard_writer=shard_writer,
             )
         
         dataloader = DataLoader(micdataset, batch_size=None, shuffle=False, num_workers=args.workers) # collate_fn=at_dataset.pad_collate_fn)
         pbar = tqdm.tqdm(range(0, sig_num), desc='generating signals')
         for mic_sig in (dataloader):
             pbar.update(1)
+        if shard_writer is not None:
+            shard_writer.close()
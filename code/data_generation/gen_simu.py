@@ -6,6 +6,7 @@
         python gen_simu.py --mode sig --stage preval --data_num 4000 --src_dir ../../../data/SrcSig/wsj0 --save_to ../../data/MicSig/simu --gpus [0]
         python gen_simu.py --mode sig --stage pretest --data_num 4000 --src_dir ../../../data/SrcSig/wsj0 --save_to ../../data/MicSig/simu --gpus [0]
         python gen_simu.py --mode sig --stage pretest_ins_T1000 --data_num 10 --save_dp True --room_sz_range [[5,10],[3,6],[2.5,3]] --T60_range [1.0,1.0] --snr_range [20,20] --src_dir ../../../data/SrcSig/wsj0 --save_to ../../data/MicSig/simu --gpus [0]
+        python gen_simu.py --mode sig --stage pretrain --data_num 512000 --save_format shard --src_dir ../../../data/SrcSig/wsj0 --save_to ../../data/MicSig/simu_shard --gpus [0,1]
 
         # python gen_simu.py --mode rir --stage train --data_num 1000 --save_to ../../data/RIR/simu --gpus [0,1]
         # python gen_simu.py --mode rir --stage val --data_num 20 --save_to ../../data/RIR/simu --gpus [0,1]
@@ -34,6 +35,7 @@ from utils_simu_rir_sig import *
 from utils_src import *
 from utils_noise import * 
 from utils_array import *
+from utils_shard import *
 
 def GenerateRandomRIR(
     room_sz_range: Union[List[Tuple[float, float]], np.ndarray]=[(3,15), (3,10), (2.5,6)], 
@@ -199,6 +201,7 @@ def GenerateRandomMicSig(
     data_num: int=1,
     save_to: str='',
     save_dp: bool=False,
+    save_format: str='wav',
     gpu_conv: bool=False,
     gpus: List[int]=[0,0,1,1],
     use_gpu: bool=True,
@@ -302,6 +305,20 @@ def GenerateRandomMicSig(
         c = c
     )
 
+    # Packed shards (one memory-mapped array for all samples) or one wav + npz per sample
+    assert save_format in ['wav', 'shard'], save_format
+    if save_format == 'shard':
+        shard_writer = MicSigShardWriter(
+            save_dir = os.path.join(save_to, stage),
+            data_num = data_num,
+            nsample = int(T*fs),
+            nch = mic_array_cfg['mic_pos_relative'].shape[0],
+            fs = fs,
+            save_dp = save_dp
+        )
+    else:
+        shard_writer = None
+
     # Generate microphone signals 
     pbar = tqdm.tqdm(total=data_num)
     pbar.set_description('generating rirs|microphone signals')
@@ -333,6 +350,7 @@ def GenerateRandomMicSig(
                 save_dp=save_dp,
                 gpu_conv=gpu_conv,
                 seed=seed,
+                shard_writer=shard_writer,
             ),
             range(data_num),
             chunksize=100,
@@ -357,7 +375,10 @@ def GenerateRandomMicSig(
                 save_dp=save_dp,
                 gpu_conv=gpu_conv,
                 seed=seed,
+                shard_writer=shard_writer,
                 )
+    if shard_writer is not None:
+        shard_writer.close()
 
 
 if __name__ == '__main__':
@@ -10,6 +10,14 @@ from typing import *
 from torch.utils.data import Dataset
 from abc import ABC, abstractmethod
 from functools import lru_cache, cache
+try:
+    from utils_manifest import *
+    from utils_resample import *
+    from utils_sampler import *
+except:
+    from data_generation.utils_manifest import *
+    from data_generation.utils_resample import *
+    from data_generation.utils_sampler import *
 
 def pad_cut_sig_sameutt(sig, nsample_desired):
     """ Pad (by repeating the same utterance) and cut signal to desired length
@@ -53,7 +61,8 @@ class LOCATADataset(Dataset):
         self.room_sz = np.array([7.1, 9.8, 3])
 
         self.mic_idxes_selected, self.mic_pos_selected = self.select_micpairs(arrays, nmic_selected, mic_dist_range)
-        self.data_items, self.data_probs_cumsum = self.get_items_probs(
+        self.data_items, self.data_probs_cumsum = cached_items_probs(
+            self, 
             data_dir, 
             tasks, 
             arrays, 
@@ -62,6 +71,7 @@ class LOCATADataset(Dataset):
             T, 
             stage, 
             prob_mode)
+        self.data_sampler = AliasTable(probs_from_cumsum(self.data_probs_cumsum))
 
         self.dataset_sz = len(self.data_items) if dataset_sz is None else dataset_sz
         self.T = T
@@ -78,9 +88,10 @@ class LOCATADataset(Dataset):
         return self.dataset_sz
 
     def __getitem__(self, idx=None, min_dura=1.1):
-        idx = np.searchsorted(self.data_probs_cumsum, np.random.uniform())
+        idx = self.data_sampler.sample()
         assert idx < len(self.data_items), [idx, len(self.data_items),self.data_items[0],len(self.data_probs_cumsum)]
         wav_path, time_path, array_pos_path, src_pos_path, vad_path, mic_idxes, mic_pos, st_ed_ratio, sil_duration = self.data_items[idx]
+        wav_path = resampled_path(wav_path, self.fs)
 
         duration = soundfile.info(wav_path).duration - sil_duration
         fs = soundfile.info(wav_path).samplerate
@@ -148,7 +159,7 @@ class LOCATADataset(Dataset):
                             file_dir = os.path.join(task_path, recording, array)
                             wav_path = os.path.join(file_dir, 'audio_array_' + array + '.wav')
                             sil_duration = self._calculate_silence_beginning(wav_path)
-                            audio_duration = soundfile.info(wav_path).duration
+                            audio_duration = probe_audio(wav_path).duration
                             time_path = os.path.join(file_dir, 'required_time.txt')
                             src_pos_path = [] 
                             vad_path = []
@@ -183,7 +194,7 @@ class LOCATADataset(Dataset):
         if len(data_probs)>0:
             data_probs_sum = sum(data_probs)
             data_probs = [prob/data_probs_sum for prob in data_probs]
-            data_probs_cumsum=np.cumsum(data_probs, dtype=np.float32)
+            data_probs_cumsum=np.cumsum(data_probs, dtype=np.float64)
             data_probs_cumsum[-1] = 1
 
         return data_items, data_probs_cumsum
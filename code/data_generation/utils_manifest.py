@@ -0,0 +1,304 @@
+"""
+    Persistent manifests of the (item, probability) indexes of real-recorded corpora
+
+    The first construction of a dataset walks the corpus, probes every audio file (soundfile.info) and parses
+    every transcription (TextGrid), then saves the result to an npz manifest. Later constructions only stat the
+    directories and files recorded in the manifest and load it directly. When the manifest is stale (e.g. a session
+    is added, or a file is re-recorded in place, which changes its modification time and size but not those of its
+    directory), the probes of unchanged files are reused so that only changed files are re-read.
+    The same manifests hold the file catalogs of presaved microphone signals (catalog_micsig_files) and of audio
+    files such as measured noise recordings (catalog_audio_files).
+"""
+
+import os
+import time
+import hashlib
+import numpy as np
+import soundfile
+from collections import namedtuple
+from pathlib import Path
+
+MANIFEST_VERSION = 3
+MANIFEST_DIR = os.environ.get('SARSSL_MANIFEST_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'sarssl', 'manifest'))
+
+AudioInfo = namedtuple('AudioInfo', ['samplerate', 'frames', 'channels', 'duration'])
+
+_probe_cache = {}       # path -> ((mtime_ns, size), AudioInfo)
+_textgrid_cache = {}    # path -> ((mtime_ns, size), TextGrid)
+_touched_paths = set()  # paths probed during the current manifest build
+
+
+def _file_stamp(path):
+    st = os.stat(path)
+    return (st.st_mtime_ns, st.st_size)
+
+def probe_audio(path):
+    """ Get the header information of an audio file, reusing the probe of an unchanged file
+        Args:       path    - audio file path
+        Returns:    info    - AudioInfo(samplerate, frames, channels, duration)
+    """
+    key = str(path)
+    stamp = _file_stamp(key)
+    _touched_paths.add(key)
+    cached = _probe_cache.get(key)
+    if (cached is not None) and (cached[0] == stamp):
+        return cached[1]
+    sf_info = soundfile.info(key)
+    info = AudioInfo(sf_info.samplerate, sf_info.frames, sf_info.channels, sf_info.duration)
+    _probe_cache[key] = (stamp, info)
+    return info
+
+def cached_audio_info(path):
+    """ Get the header information of an audio file from the probes of a fresh manifest, whose file stamps are already
+        validated, without checking the file again; a file without probe is probed
+        Args:       path    - audio file path
+        Returns:    info    - AudioInfo(samplerate, frames, channels, duration)
+    """
+    cached = _probe_cache.get(str(path))
+    if cached is not None:
+        return cached[1]
+    return probe_audio(path)
+
+def load_textgrid(path):
+    """ Parse a TextGrid transcription file, reusing the parse of an unchanged file
+        Args:       path    - TextGrid file path
+        Returns:    tg      - textgrid.TextGrid
+    """
+    import textgrid
+    key = str(path)
+    stamp = _file_stamp(key)
+    _touched_paths.add(key)
+    cached = _textgrid_cache.get(key)
+    if (cached is not None) and (cached[0] == stamp):
+        return cached[1]
+    tg = textgrid.TextGrid.fromFile(key)
+    _textgrid_cache[key] = (stamp, tg)
+    return tg
+
+def _watch_dirs(data_dir, paths):
+    """ Directories whose modification times reveal added, removed or renamed files of the corpus
+    """
+    root = os.path.abspath(str(data_dir))
+    dirs = {root}
+    for path in paths:
+        dir = os.path.dirname(os.path.abspath(path))
+        while (dir not in dirs):
+            dirs.add(dir)
+            if (not dir.startswith(root + os.sep)):
+                break
+            dir = os.path.dirname(dir)
+    return sorted(dirs)
+
+def _dir_mtimes(dirs):
+    mtimes = np.zeros(len(dirs), dtype=np.int64)
+    for idx, dir in enumerate(dirs):
+        try:
+            mtimes[idx] = os.stat(dir).st_mtime_ns
+        except FileNotFoundError:
+            mtimes[idx] = -1
+    return mtimes
+
+def _file_stamps(paths):
+    stamps = np.full((len(paths), 2), -1, dtype=np.int64)
+    for idx, path in enumerate(paths):
+        try:
+            stamps[idx] = _file_stamp(str(path))
+        except FileNotFoundError:
+            pass
+    return stamps
+
+def _seed_probe_cache(manifest):
+    for path, stamp, info in zip(manifest['probe_paths'], manifest['probe_stamps'], manifest['probe_infos']):
+        _probe_cache.setdefault(str(path), (tuple(stamp), AudioInfo(int(info[0]), int(info[1]), int(info[2]), float(info[3]))))
+
+def _obj_array(values):
+    arr = np.empty(len(values), dtype=object)
+    for idx, value in enumerate(values):
+        arr[idx] = value
+    return arr
+
+
+class ManifestCache():
+    """ An npz manifest identified by a dataset name and a hashable description of its configuration
+    """
+    def __init__(self, name, key, manifest_dir=None):
+        self.manifest_dir = MANIFEST_DIR if manifest_dir is None else manifest_dir
+        key_hash = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()[:16]
+        self.path = os.path.join(self.manifest_dir, f'{name}_{key_hash}.npz')
+
+    def load(self):
+        """ Returns:    manifest    - dict of arrays, None if the manifest does not exist or cannot be read
+        """
+        if not os.path.exists(self.path):
+            return None
+        try:
+            with np.load(self.path, allow_pickle=True) as data:
+                manifest = {key: data[key] for key in data.files}
+        except Exception:
+            return None
+        if int(manifest.get('version', -1)) != MANIFEST_VERSION:
+            return None
+        return manifest
+
+    def is_fresh(self, manifest):
+        """ Fresh when no file is added, removed or renamed (modification times of directories) and no recorded file is
+            rewritten (modification times and sizes of files)
+        """
+        dirs = [str(dir) for dir in manifest['watch_dirs']]
+        if not np.array_equal(_dir_mtimes(dirs), manifest['watch_mtimes']):
+            return False
+        for paths_key, stamps_key in [('probe_paths', 'probe_stamps'), ('textgrid_paths', 'textgrid_stamps'), ('path', 'stamp')]:
+            if (paths_key in manifest) and (stamps_key in manifest):
+                if not np.array_equal(_file_stamps(manifest[paths_key]).reshape(-1, 2), manifest[stamps_key].reshape(-1, 2)):
+                    return False
+        return True
+
+    def save(self, **arrays):
+        """ Write atomically, so that concurrent readers never observe a partial file
+        """
+        Path(self.manifest_dir).mkdir(parents=True, exist_ok=True)
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, version=MANIFEST_VERSION, **arrays)
+        os.replace(tmp_path, self.path)
+
+
+def cached_items_probs(dataset, data_dir, *args, manifest_dir=None, use_manifest=True):
+    """ Load `dataset.get_items_probs(data_dir, *args)` from its persistent manifest, (re)building it when needed
+        Args:       dataset         - dataset whose `get_items_probs` builds the (item, probability) indexes
+                    data_dir        - corpus root
+                    args            - remaining arguments of `get_items_probs` (tasks, arrays, mic pairs, T, stage, prob_mode, ...)
+                    manifest_dir    - directory of manifests (default: MANIFEST_DIR)
+                    use_manifest    - False to always rebuild from the corpus without touching the manifest
+        Returns:    data_items, data_probs_cumsum
+    """
+    if not use_manifest:
+        return dataset.get_items_probs(data_dir, *args)
+
+    name = type(dataset).__name__
+    key = (name, os.path.abspath(str(data_dir)), args, getattr(dataset, 'remove_spkoverlap', None))
+    cache = ManifestCache(name, key, manifest_dir=manifest_dir)
+    manifest = cache.load()
+    if (manifest is not None) and cache.is_fresh(manifest):
+        # crops are planned from these probes (cached_audio_info), without reading audio headers on the data path
+        _seed_probe_cache(manifest)
+        return list(manifest['data_items']), manifest['data_probs_cumsum']
+
+    # Reuse the probes of the previous manifest, so that only changed files are read again
+    if manifest is not None:
+        _seed_probe_cache(manifest)
+        for path, stamp, tg in zip(manifest['textgrid_paths'], manifest['textgrid_stamps'], manifest['textgrids']):
+            _textgrid_cache.setdefault(str(path), (tuple(stamp), tg))
+        print(f'Manifest of {name} is stale, rebuilding: {cache.path}')
+    else:
+        print(f'Building manifest of {name}: {cache.path}')
+
+    ts = time.time()
+    _touched_paths.clear()
+    data_items, data_probs_cumsum = dataset.get_items_probs(data_dir, *args)
+    touched_paths = sorted(_touched_paths)
+    _touched_paths.clear()
+
+    probe_paths = [path for path in touched_paths if path in _probe_cache]
+    textgrid_paths = [path for path in touched_paths if path in _textgrid_cache]
+    watch_dirs = _watch_dirs(data_dir, touched_paths)
+    cache.save(
+        data_items = _obj_array(data_items),
+        data_probs_cumsum = np.asarray(data_probs_cumsum, dtype=np.float64),
+        watch_dirs = np.array(watch_dirs, dtype=str),
+        watch_mtimes = _dir_mtimes(watch_dirs),
+        probe_paths = np.array(probe_paths, dtype=str),
+        probe_stamps = np.array([_probe_cache[path][0] for path in probe_paths], dtype=np.int64).reshape(-1, 2),
+        probe_infos = np.array([tuple(_probe_cache[path][1]) for path in probe_paths], dtype=np.float64).reshape(-1, 4),
+        textgrid_paths = np.array(textgrid_paths, dtype=str),
+        textgrid_stamps = np.array([_textgrid_cache[path][0] for path in textgrid_paths], dtype=np.int64).reshape(-1, 2),
+        textgrids = _obj_array([_textgrid_cache[path][1] for path in textgrid_paths]),
+        )
+    print(f'Manifest of {name} saved ({len(data_items)} items, {time.time()-ts:.1f} s)')
+
+    return data_items, data_probs_cumsum
+
+
+def catalog_micsig_files(data_dir, manifest_dir=None, use_manifest=True):
+    """ Pair each presaved microphone signal (*.wav) with its direct-path signal (*_dp.wav) and annotation (*_info.npz)
+        in a single directory walk, and keep the catalog in a persistent manifest
+        Args:       data_dir        - directory of presaved microphone signals
+                    manifest_dir    - directory of manifests (default: MANIFEST_DIR)
+                    use_manifest    - False to always walk the directory without touching the manifest
+        Returns:    catalog         - dict of aligned path arrays 'sig', 'dp' and 'info' ('' for a missing companion)
+    """
+    cache = ManifestCache('MicSigCatalog', ('MicSigCatalog', os.path.abspath(str(data_dir))), manifest_dir=manifest_dir)
+    if use_manifest:
+        manifest = cache.load()
+        if (manifest is not None) and cache.is_fresh(manifest):
+            return {key: manifest[key] for key in ['sig', 'dp', 'info']}
+
+    sig_paths, dp_paths, info_paths, walk_dirs = [], [], [], []
+    for dir, dir_names, file_names in os.walk(str(data_dir)):
+        dir_names.sort()
+        walk_dirs.append(os.path.abspath(dir))
+        names = set(file_names)
+        for name in sorted(file_names):
+            if (not name.endswith('.wav')) | name.endswith('_dp.wav'):
+                continue
+            stem = name[:-len('.wav')]
+            sig_paths.append(os.path.join(dir, name))
+            dp_paths.append(os.path.join(dir, stem + '_dp.wav') if (stem + '_dp.wav') in names else '')
+            info_paths.append(os.path.join(dir, stem + '_info.npz') if (stem + '_info.npz') in names else '')
+
+    catalog = {
+        'sig': np.array(sig_paths, dtype=str),
+        'dp': np.array(dp_paths, dtype=str),
+        'info': np.array(info_paths, dtype=str),
+        }
+    if use_manifest:
+        cache.save(watch_dirs=np.array(walk_dirs, dtype=str), watch_mtimes=_dir_mtimes(walk_dirs), **catalog)
+
+    return catalog
+
+
+def catalog_audio_files(data_dir, ext='wav', manifest_dir=None, use_manifest=True):
+    """ List the audio files under a directory with their sampling rates and lengths in a single directory walk,
+        and keep the catalog in a persistent manifest
+        Args:       data_dir        - root directory (may not exist)
+                    ext             - file extension
+                    manifest_dir    - directory of manifests (default: MANIFEST_DIR)
+                    use_manifest    - False to always walk the directory without touching the manifest
+        Returns:    catalog         - dict of aligned arrays 'path', 'samplerate', 'frames', 'channels' and 'stamp' (modification time and size), sorted by path
+    """
+    root = os.path.abspath(str(data_dir))
+    cache = ManifestCache('AudioCatalog', ('AudioCatalog', root, ext), manifest_dir=manifest_dir)
+    if use_manifest:
+        manifest = cache.load()
+        if (manifest is not None) and cache.is_fresh(manifest):
+            return {key: manifest[key] for key in ['path', 'samplerate', 'frames', 'channels', 'stamp']}
+        # Reuse the probes of the previous catalog, so that only changed files are read again
+        if manifest is not None:
+            for path, stamp, samplerate, frames, channels in zip(manifest['path'], manifest['stamp'], manifest['samplerate'], manifest['frames'], manifest['channels']):
+                _probe_cache.setdefault(str(path), (tuple(stamp), AudioInfo(int(samplerate), int(frames), int(channels), float(frames) / samplerate)))
+
+    paths, walk_dirs = [], [root]
+    for dir, dir_names, file_names in os.walk(root):
+        dir_names.sort()
+        if dir != root:
+            walk_dirs.append(dir)
+        for name in sorted(file_names):
+            if name.endswith('.' + ext):
+                paths.append(os.path.join(dir, name))
+    infos = [probe_audio(path) for path in paths]
+
+    catalog = {
+        'path': np.array(paths, dtype=str),
+        'samplerate': np.array([info.samplerate for info in infos], dtype=np.int64),
+        'frames': np.array([info.frames for info in infos], dtype=np.int64),
+        'channels': np.array([info.channels for info in infos], dtype=np.int64),
+        'stamp': np.array([_probe_cache[path][0] for path in paths], dtype=np.int64).reshape(-1, 2),
+        }
+    if use_manifest:
+        cache.save(watch_dirs=np.array(walk_dirs, dtype=str), watch_mtimes=_dir_mtimes(walk_dirs), **catalog)
+
+    return catalog
+
+
+if __name__ == '__main__':
+    pass
@@ -6,7 +6,14 @@ import scipy.io
 import scipy.signal
 import soundfile
 import matplotlib.pyplot as plt
+from collections import OrderedDict
 from torch.utils.data import Dataset
+try:
+    from utils_resample import *
+    from utils_speechpool import *
+except:
+    from data_generation.utils_resample import *
+    from data_generation.utils_speechpool import *
 
 def explore_corpus(path, file_extension):
         directory_tree = {}
@@ -37,7 +44,9 @@ def pad_cut_sig_sameutt(sig, nsample_desired):
     return sig_pad_cut
 
 class NoiseSignal(Dataset):
-    def __init__(self, T, fs, nmic, noise_type, noise_path=None, c=343.0, size=None):
+    """ pool_dtype: None to read wav files for each babble noise, or the storage dtype ('float32', 'float16', 'int16') of a SpeechPool holding all babble utterances
+    """
+    def __init__(self, T, fs, nmic, noise_type, noise_path=None, c=343.0, size=None, mix_cache_size=256, dist_quant=1e-5, pool_dtype=None):
         self.T = T
         self.fs= fs
         self.nmic = nmic
@@ -52,6 +61,12 @@ class NoiseSignal(Dataset):
         else:
             self.sz = 1 if size is None else size
         self.c = c 
+        self.speech_pool = None
+        if (pool_dtype is not None) & (noise_type == 'diffuse_babble'):
+            self.speech_pool = SpeechPool(type(self).__name__, [self.path_set], fs, dtype=pool_dtype)
+        self.mix_cache = OrderedDict() # quantized microphone distances -> mix matrix, in LRU order
+        self.mix_cache_size = mix_cache_size
+        self.dist_quant = dist_quant
 
     def __len__(self):
         return self.sz
@@ -59,16 +74,19 @@ class NoiseSignal(Dataset):
     def __getitem__(self, idx):
         pass
 
-    def generate_random_noise(self, mic_pos=None, eps=1e-8):
+    def generate_random_noise(self, mic_pos=None, eps=1e-8, nbatch=None):
         # mic_pos is valid for 'diffuse'
+        # nbatch is valid for 'diffuse_white', generating (nbatch, nsample, nmic) noise realizations in one pass
+        assert (nbatch is None) | (self.noise_type == 'diffuse_white'), 'Batched noise generation is only supported for diffuse white noise'
 
         if self.noise_type == 'spatial_white':
             noise_signal = self.generate_Gaussian_noise(self.T, self.fs, self.nmic)
 
         elif self.noise_type == 'diffuse_white':
-            noise = np.random.standard_normal((int(self.T * self.fs), self.nmic))
+            noise_shape = (int(self.T * self.fs), self.nmic) if nbatch is None else (nbatch, int(self.T * self.fs), self.nmic)
+            noise = np.random.standard_normal(noise_shape)
             noise_signal = self.generate_diffuse_noise(noise, mic_pos, c=self.c)
-            noise_signal = noise_signal/(np.max(noise_signal)+eps)
+            noise_signal = noise_signal/(np.max(noise_signal, axis=(-2, -1), keepdims=True)+eps)
 
         elif self.noise_type == 'diffuse_babble': # from single-speaker speech dataset
             # Generate M mutually 'independent' input signals
@@ -80,10 +98,13 @@ class NoiseSignal(Dataset):
                 noise = np.zeros((nsample_desired))
                 for speech_idx in range(nspeech_babble):
                     idx = np.random.randint(0, len(self.path_set))
-                    speech, fs = soundfile.read(self.path_set[idx], dtype='float32')
-                    if fs != self.fs:
-                        speech = scipy.signal.resample_poly(speech, up=self.fs, down=fs)
-                    speech = pad_cut_sig_sameutt(speech, nsample_desired)
+                    if self.speech_pool is not None:
+                        speech = self.speech_pool.pad_cut_sameutt(idx, nsample_desired)
+                    else:
+                        speech, fs = soundfile.read(resampled_path(self.path_set[idx], self.fs), dtype='float32')
+                        if fs != self.fs:
+                            speech = scipy.signal.resample_poly(speech, up=self.fs, down=fs)
+                        speech = pad_cut_sig_sameutt(speech, nsample_desired)
                     speech = speech - np.mean(speech)
                     noise += speech
                 noise_M[:, m] = noise 
@@ -94,7 +115,7 @@ class NoiseSignal(Dataset):
 
         elif self.noise_type == 'diffuse_xsrc':
             idx = np.random.randint(0, len(self.path_set))
-            noise, fs = soundfile.read(self.path_set[idx], dtype='float32')
+            noise, fs = soundfile.read(resampled_path(self.path_set[idx], self.fs), dtype='float32')
 
             nsample_desired = int(self.T * fs * self.nmic)
             noise = pad_cut_sig_sameutt(noise, nsample_desired)
@@ -115,7 +136,7 @@ class NoiseSignal(Dataset):
 
         elif self.noise_type == 'real_world': # The array topology should be consistent
             idx = np.random.randint(0, len(self.path_set))
-            noise, fs = soundfile.read(self.path_set[idx], dtype='float32')
+            noise, fs = soundfile.read(resampled_path(self.path_set[idx], self.fs), dtype='float32')
             nmic = noise.shape[-1]
             if nmic != self.nmic:
                 raise Exception('Unexpected number of microphone channels')
@@ -140,13 +161,10 @@ class NoiseSignal(Dataset):
 
     def generate_diffuse_noise(self, noise_M, mic_pos, nfft=256, c=343.0, type_nf='spherical'):
         """ Reference:  E. A. P. Habets, “Arbitrary noise field generator.” https://github.com/ehabets/ANF-Generator
-            Args: noise_M - M mutually 'independent' input signals (sample, M)
+            Args: noise_M - M mutually 'independent' input signals (sample, M), or a batch of them (nbatch, sample, M)
         """
-        # Generate matrix with desired spatial coherence
-        w_rad = 2*math.pi*self.fs*np.array([i for i in range(nfft//2+1)])/nfft
-        DC = self._desired_spatial_coherence(mic_pos, type_nf, c, w_rad)
-
-        C = self._mix_matrix(DC)
+        # Get mix matrix with desired spatial coherence, which only depends on the microphone geometry
+        C = self._cached_mix_matrix(mic_pos, nfft, c, type_nf)
         noise_signal = self._diffuse_noise(noise_M, C)
 
         # Plot desired and generated spatial coherence
@@ -175,39 +193,48 @@ class NoiseSignal(Dataset):
         
         return mic_sig
 
-    def _desired_spatial_coherence(self, mic_pos, type_nf, c, w_rad):
+    def _cached_mix_matrix(self, mic_pos, nfft, c, type_nf):
+        """ Mix matrix of a microphone geometry, memoized on the microphone distances quantized by dist_quant (LRU bounded by mix_cache_size)
+			C: mix matrix (nf, nch, nch)
+		"""
+        dist_idx = np.round(self._mic_distance(mic_pos) / self.dist_quant).astype(np.int64)
+        key = (dist_idx.shape[0], dist_idx.tobytes(), nfft, float(c), type_nf, self.fs)
+        C = self.mix_cache.pop(key, None)
+        if C is None:
+            w_rad = 2*math.pi*self.fs*np.arange(nfft//2+1)/nfft
+            DC = self._desired_spatial_coherence(None, type_nf, c, w_rad, dist=dist_idx*self.dist_quant)
+            C = self._mix_matrix(DC)
+            while len(self.mix_cache) >= self.mix_cache_size:
+                self.mix_cache.popitem(last=False)
+        self.mix_cache[key] = C
+
+        return C
+
+    def _mic_distance(self, mic_pos):
+        """ Distances between all microphone pairs (nmic, nmic)
+        """
+        return np.linalg.norm(mic_pos[:, np.newaxis, :] - mic_pos[np.newaxis, :, :], axis=-1)
+
+    def _desired_spatial_coherence(self, mic_pos, type_nf, c, w_rad, dist=None):
         """
 			mic_pos: relative positions of mirophones  (nmic, 3)
 			type_nf: type of noise field, 'spherical' or 'cylindrical'
 			c: speed of sound
 			w_rad: angular frequency in radians
+			dist: distances between microphones (nmic, nmic), replacing mic_pos if given
+			DC: desired spatial coherence (nmic, nmic, nf)
 		"""
-        M = mic_pos.shape[0]
-
-        # Generate matrix with desired spatial coherence
-        nf = len(w_rad)
-        DC = np.zeros([M, M, nf])
-
-        for p in range(0,M):
-            for q in range(0,M):
-                if p == q:
-                    DC[p, q, :] = np.ones([1, 1, nf])
-                else:
-                    dist = np.linalg.norm(mic_pos[p, :] - mic_pos[q, :])
-                    if type_nf == 'spherical':
-                        DC[p, q, :] = np.sinc(w_rad*dist/(c*math.pi))
-                    elif type_nf == 'cylindrical':
-                        DC[p, q, :] = scipy.special.jn(0, w_rad*dist/c)
-                    else:
-                        raise Exception('Unknown noise field')
-        # Alternative
-        # dist = np.linalg.norm(mic_pos[:, np.newaxis, :] - mic_pos[np.newaxis, :, :], axis=-1, keepdims=True)
-        # if type_nf == 'spherical':
-        # 	DC = np.sinc(w_rad * dist / (c * math.pi))
-        # elif type_nf == 'cylindrical':
-        # 	DC = scipy.special.jn(0, w_rad * dist / c)
-        # else:
-        # 	raise Exception('Unknown noise field')
+        if dist is None:
+            dist = self._mic_distance(mic_pos)
+        dist = dist[:, :, np.newaxis]
+
+        # Generate matrix with desired spatial coherence (ones on the diagonal, where dist is 0)
+        if type_nf == 'spherical':
+            DC = np.sinc(w_rad * dist / (c * math.pi))
+        elif type_nf == 'cylindrical':
+            DC = scipy.special.jn(0, w_rad * dist / c)
+        else:
+            raise Exception('Unknown noise field')
 
         return DC
 
@@ -220,35 +247,36 @@ class NoiseSignal(Dataset):
         M = DC.shape[0]
         num_freqs = DC.shape[2] 
         C = np.zeros((num_freqs, M, M), dtype=complex)
-        for k in range(1, num_freqs):
-            if method == 'cholesky':
-                C[k, ...] = scipy.linalg.cholesky(DC[:,:,k])
-            elif method == 'eigen': # Generated cohernce and noise signal are slightly different from MATLAB version
-                D, V = np.linalg.eig(DC[:,:,k])
-                C[k, ...] = V.T * np.sqrt(D)[:, np .newaxis]
-            else:
-                raise Exception('Unknown method specified')
+        DC = DC.transpose(2, 0, 1)[1:, ...]
+        if method == 'cholesky': # upper triangular factor as scipy.linalg.cholesky, for all frequencies at once
+            C[1:, ...] = np.conj(np.linalg.cholesky(DC)).swapaxes(-1, -2)
+        elif method == 'eigen': # Generated cohernce and noise signal are slightly different from MATLAB version
+            D, V = np.linalg.eig(DC)
+            C[1:, ...] = V.swapaxes(-1, -2) * np.sqrt(D)[..., np.newaxis]
+        else:
+            raise Exception('Unknown method specified')
 
         return C
     
     def _diffuse_noise(self, noise, C):
         """ 
 			C: mix matrix (nf, nch, nch)
-			x: diffuse noise (nsample, nch)
+			noise: M mutually 'independent' input signals (nsample, nch), or a batch of them (nbatch, nsample, nch)
+			x: diffuse noise (nsample, nch) or (nbatch, nsample, nch)
 		"""
 
         K = (C.shape[0]-1)*2 # Number of frequency bins
 
         # Compute short-time Fourier transform (STFT) of all input signals
-        noise = noise.transpose()
+        noise = noise.swapaxes(-1, -2)
         f, t, N = scipy.signal.stft(noise, window='hann', nperseg=K, noverlap=0.75*K, nfft=K)
 
         # Generate output in the STFT domain for each frequency bin k
-        X = np.einsum('fmn,mft->nft', np.conj(C), N)
+        X = np.einsum('fmn,...mft->...nft', np.conj(C), N)
 
         # Compute inverse STFT
         F, df_noise = scipy.signal.istft(X,window='hann', nperseg=K, noverlap=0.75*K, nfft=K)
-        df_noise = df_noise.transpose()
+        df_noise = df_noise.swapaxes(-1, -2)
 
         return df_noise
 
@@ -0,0 +1,125 @@
+"""
+    Batched reading of random crops of real-recorded microphone signals
+
+    A crop plan tells which files, channels and sample range make up one training sample, so it can be drawn in the
+    main process without touching any audio. The reads of a batch of crop plans are issued together, grouped by file
+    and ordered by start sample, through a bounded LRU pool of open soundfile.SoundFile handles. Crops of the same long
+    session (e.g. AISHELL4, M2MeT, AMI) thus reuse one open handle and its header instead of reopening the file for
+    every sample and channel. Each process (e.g. DataLoader worker) keeps its own pool, whose size is set by the
+    environment variable SARSSL_MAX_OPEN_FILES.
+
+    Examples:
+        plans = [dataset.crop_plan() for _ in range(batch_size)]
+        sigs = read_crop_plans(plans, SOUNDFILE_POOL)
+"""
+
+import os
+import numpy as np
+import soundfile
+from collections import OrderedDict, namedtuple
+
+CropPlan = namedtuple('CropPlan', ['files', 'start', 'stop', 'fs', 'nsample'])
+CropPlan.__doc__ = """ Crop of one sample
+        files       - list of (file path, channel indexes in the file), whose channels are concatenated in order
+        start, stop - sample range of the crop, None to read whole files
+        fs          - sampling rate of the files
+        nsample     - desired number of samples at fs (a shorter crop is padded by the dataset)
+    """
+
+
+class SoundFilePool():
+    """ Bounded LRU pool of open soundfile.SoundFile handles
+        Handles are never pickled nor shared with forked processes, since a forked handle shares its file offset with the parent.
+        Args:       max_open    - maximum number of open handles
+    """
+    def __init__(self, max_open=64):
+        self.max_open = max_open
+        self._files = OrderedDict()
+        self._pid = os.getpid()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_files'] = OrderedDict()
+        return state
+
+    def __len__(self):
+        return len(self._files)
+
+    def open(self, path):
+        """ Returns:    f   - open soundfile.SoundFile, moved to the most recently used end of the pool
+        """
+        if self._pid != os.getpid():
+            self._files = OrderedDict()
+            self._pid = os.getpid()
+        key = str(path)
+        f = self._files.pop(key, None)
+        if f is None:
+            f = soundfile.SoundFile(key)
+            while len(self._files) >= self.max_open:
+                _, f_lru = self._files.popitem(last=False)
+                f_lru.close()
+        self._files[key] = f
+        return f
+
+    def read(self, path, start=None, stop=None, channels=None):
+        """ Read a sample range of a file
+            Args:       path        - audio file path
+                        start, stop - sample range, None for the whole file
+                        channels    - channel indexes, None for all channels
+            Returns:    sig         - (nsample, nch) float32
+        """
+        f = self.open(path)
+        start = 0 if start is None else start
+        stop = f.frames if stop is None else stop
+        try:
+            f.seek(start)
+            sig = f.read(stop - start, dtype='float32', always_2d=True)
+        except RuntimeError:
+            # some compressed formats cannot seek
+            import librosa
+            fs = f.samplerate
+            self._files.pop(str(path)).close()
+            sig, _ = librosa.load(str(path), sr=fs, offset=start/fs, duration=(stop-start)/fs, mono=False)
+            sig = np.atleast_2d(sig).transpose(1, 0)
+        if channels is not None:
+            sig = sig[:, channels]
+
+        return sig
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._files = OrderedDict()
+
+
+SOUNDFILE_POOL = SoundFilePool(max_open=int(os.environ.get('SARSSL_MAX_OPEN_FILES', 64)))
+
+
+def read_crop_plans(plans, pool=None):
+    """ Read the crops of a batch together, grouping the reads by file and ordering them by start sample
+        Args:       plans   - list of CropPlan
+                    pool    - SoundFilePool (default: SOUNDFILE_POOL of the current process)
+        Returns:    sigs    - list of microphone signals (nsample, nch), float32
+    """
+    pool = SOUNDFILE_POOL if pool is None else pool
+    reads = []
+    for plan_idx, plan in enumerate(plans):
+        for file_idx, (path, _) in enumerate(plan.files):
+            reads += [(str(path), -1 if plan.start is None else plan.start, plan_idx, file_idx)]
+    reads.sort()
+
+    parts = [[None] * len(plan.files) for plan in plans]
+    for path, _, plan_idx, file_idx in reads:
+        plan = plans[plan_idx]
+        parts[plan_idx][file_idx] = pool.read(path, plan.start, plan.stop, plan.files[file_idx][1])
+
+    sigs = []
+    for part in parts:
+        nsample = min([p.shape[0] for p in part])
+        sigs += [np.concatenate([p[:nsample] for p in part], axis=1)]
+
+    return sigs
+
+
+if __name__ == '__main__':
+    pass
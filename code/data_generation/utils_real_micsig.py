@@ -15,6 +15,16 @@ from pathlib import Path
 from numpy.linalg import norm
 from torch.utils.data import Dataset
 from abc import ABC, abstractmethod
+try:
+    from utils_manifest import *
+    from utils_resample import *
+    from utils_sampler import *
+    from utils_reader import *
+except:
+    from data_generation.utils_manifest import *
+    from data_generation.utils_resample import *
+    from data_generation.utils_sampler import *
+    from data_generation.utils_reader import *
 
 def pad_cut_sig_sameutt(sig, nsample_desired):
     """ Pad (by repeating the same utterance) and cut signal to desired length
@@ -52,6 +62,15 @@ def select_microphone_pairs(mic_poss, nmic_selected, mic_dist_range):
     assert (not mic_pair_idxes_selected)==False, f'No microphone pairs satisfy the microphone distance range {mic_dist_range}'
     return mic_pair_idxes_selected, mic_pos_selected
 
+def crop_start(nsample_range, offset=None):
+    """ Start sample of a random crop in [0, nsample_range)
+        Args:       nsample_range   - number of valid start samples
+                    offset          - crop offset ratio in [0, 1) drawn beforehand, None to draw from the global numpy RNG
+    """
+    if offset is None:
+        return np.random.randint(0, nsample_range)
+    return min(int(offset * nsample_range), nsample_range - 1)
+
 class RealMicSigDataset(Dataset):
     def __init__(self,  
                  data_dir: str, 
@@ -68,7 +87,8 @@ class RealMicSigDataset(Dataset):
         super().__init__()
         
         self.mic_idxes_selected = self.select_micpairs(arrays, nmic_selected, mic_dist_range)
-        self.data_items, self.data_probs_cumsum = self.get_items_probs(data_dir, arrays, self.mic_idxes_selected, T, stage, prob_mode)
+        self.data_items, self.data_probs_cumsum = cached_items_probs(self, data_dir, arrays, self.mic_idxes_selected, T, stage, prob_mode)
+        self.data_sampler = AliasTable(probs_from_cumsum(self.data_probs_cumsum))
         assert (self.data_probs_cumsum[-1] == 1), self.data_probs_cumsum[-1]
         assert len(self.data_items) == len(self.data_probs_cumsum), [len(self.data_items), len(self.data_probs_cumsum)]
 
@@ -120,51 +140,83 @@ class RealMicSigDataset(Dataset):
 
         return durations, np.sum(np.array(durations))/3600
 
-    def __getitem__(self, idx=None):
-        idx = np.searchsorted(self.data_probs_cumsum, np.random.uniform())
+    def channel_files(self, data_path, mic_idxes_selected):
+        """ Files holding the selected microphones
+            Returns:    files   - list of (file path, channel indexes in the file), whose channels are concatenated in order
+        """
+        return [(data_path, list(mic_idxes_selected))]
+
+    def crop_plan(self, idx=None, offset=None):
+        """ Plan the random crop of one item from the cached audio headers, without reading any audio
+            Args:       idx     - item index, None to draw it here
+                        offset  - crop offset ratio in [0, 1), None to draw it here
+            Returns:    plan    - CropPlan
+        """
+        if idx is None:
+            idx = self.data_sampler.sample()
         assert idx < len(self.data_items), [idx, len(self.data_items),self.data_items[0],len(self.data_probs_cumsum)]
         data_return = self.data_items[idx]
         if len(data_return) == 3:
             data_path, steds, mic_idxes = data_return
+            data_path = resampled_path(data_path, self.fs)
     
-            duration = steds[-1] # soundfile.info(data_path).duration
-            fs = soundfile.info(data_path).samplerate
+            info = cached_audio_info(data_path)
+            duration = steds[-1]
+            fs = info.samplerate
             nsample = int(duration * fs)
             nsample_desired = int(self.T * fs)
             if nsample>nsample_desired:
-                st = np.random.randint(0, nsample - nsample_desired) + int(fs*steds[0])
+                st = crop_start(nsample - nsample_desired, offset) + int(fs*steds[0])
                 ed = st + nsample_desired
-                assert ed <= fs*soundfile.info(data_path).duration, 'error'
+                assert ed <= fs*info.duration, 'error'
             elif nsample==nsample_desired:
                 st = int(fs*steds[0])
                 ed = st + nsample_desired
             else:
                 raise Exception('error')
-            mic_signals = self.read_micsig(data_path, st=st, ed=ed, mic_idxes_selected=mic_idxes)
         
         elif len(data_return) == 2:
             data_path, mic_idxes = data_return
+            data_path = resampled_path(data_path, self.fs)
     
-            duration = soundfile.info(data_path).duration
-            fs = soundfile.info(data_path).samplerate
-            nsample = int(duration * fs)
+            info = cached_audio_info(data_path)
+            fs = info.samplerate
+            nsample = int(info.duration * fs)
             nsample_desired = int(self.T * fs)
             if nsample<nsample_desired:
-                mic_signals = self.read_micsig(data_path, mic_idxes_selected=mic_idxes)
-                mic_signals = pad_cut_sig_sameutt(mic_signals, nsample_desired)
-                print('smaller number of samples')
+                st, ed = None, None
             elif nsample==nsample_desired:
-                mic_signals = self.read_micsig(data_path, st=0, ed=nsample, mic_idxes_selected=mic_idxes)
+                st, ed = 0, nsample
             else:    
-                st = np.random.randint(0, nsample - nsample_desired)
+                st = crop_start(nsample - nsample_desired, offset)
                 ed = st + nsample_desired
-                mic_signals = self.read_micsig(data_path, st=st, ed=ed, mic_idxes_selected=mic_idxes)
 
-        if self.fs != fs:
-            mic_signals = scipy.signal.resample_poly(mic_signals, self.fs, fs)
+        return CropPlan(self.channel_files(data_path, mic_idxes), st, ed, fs, nsample_desired)
+
+    def finish_crop(self, mic_signals, plan):
+        """ Pad a short crop and resample it to the sampling rate of the dataset
+        """
+        if mic_signals.shape[0] < plan.nsample:
+            mic_signals = pad_cut_sig_sameutt(mic_signals, plan.nsample)
+            print('smaller number of samples')
+        if self.fs != plan.fs:
+            mic_signals = scipy.signal.resample_poly(mic_signals, self.fs, plan.fs)
 
         return [mic_signals]
 
+    def __getitem__(self, idx=None):
+        """ Args:   idx - CropPlan, or (item index, crop offset ratio) drawn by CorpusItemSampler; otherwise the item and crop are drawn here
+        """
+        if isinstance(idx, CropPlan):
+            plan = idx
+        elif isinstance(idx, tuple):
+            plan = self.crop_plan(*idx)
+        else:
+            plan = self.crop_plan()
+        mic_signals = read_crop_plans([plan])[0]
+
+        return self.finish_crop(mic_signals, plan)
+
 
 class RealMANDataset(RealMicSigDataset):
     """ Refs: RealMAN: A Real-Recorded and Annotated Microphone Array Dataset for Dynamic Speech Enhancement and Localization
@@ -185,7 +237,8 @@ class RealMANDataset(RealMicSigDataset):
                  sound_speed: float = 343.0):
 
         self.mic_idxes_selected = self.select_micpairs(arrays, nmic_selected, mic_dist_range)
-        self.data_items, self.data_probs_cumsum = self.get_items_probs(data_dir, tasks, arrays, self.mic_idxes_selected, T, stage, prob_mode)
+        self.data_items, self.data_probs_cumsum = cached_items_probs(self, data_dir, tasks, arrays, self.mic_idxes_selected, T, stage, prob_mode)
+        self.data_sampler = AliasTable(probs_from_cumsum(self.data_probs_cumsum))
 
         self.dataset_sz = len(self.data_items) if dataset_sz is None else dataset_sz
         self.T = T
@@ -243,7 +296,7 @@ class RealMANDataset(RealMicSigDataset):
                     wavs = Path(data_dir).rglob('*/ma_speech/' + scene + '/' + task + '/*/*CH0.flac')
                                 
                     for wav_path in wavs:
-                        audio_duration = soundfile.info(wav_path).duration
+                        audio_duration = probe_audio(wav_path).duration
                         if audio_duration >= duration_min_limit:
                             data_prob = 1
 
@@ -264,7 +317,7 @@ class RealMANDataset(RealMicSigDataset):
         if len(data_probs)>0:
             data_probs_sum = sum(data_probs)
             data_probs = [prob/data_probs_sum for prob in data_probs]
-            data_probs_cumsum=np.cumsum(data_probs, dtype=np.float32)
+            data_probs_cumsum=np.cumsum(data_probs, dtype=np.float64)
             data_probs_cumsum[-1] = 1
 
         return data_items, data_probs_cumsum
@@ -282,6 +335,9 @@ class RealMANDataset(RealMicSigDataset):
             
         return np.array(mic_signals).transpose(1, 0)
     
+    def channel_files(self, data_path, mic_idxes_selected):
+        return [(data_path.parent / data_path.name.replace('.CH0.wav', f'.CH{mic_idx}.wav'), [0]) for mic_idx in mic_idxes_selected]
+    
     def select_micpairs(self, arrays, nmic_selected, mic_dist_range):
         mic_idxes_selected = {}
 
@@ -375,7 +431,8 @@ class RealMANOriDataset(RealMicSigDataset):
                  sound_speed: float = 343.0):
 
         self.mic_idxes_selected = self.select_micpairs(arrays, nmic_selected, mic_dist_range)
-        self.data_items, self.data_probs_cumsum = self.get_items_probs(data_dir, tasks, arrays, self.mic_idxes_selected, T, stage, prob_mode)
+        self.data_items, self.data_probs_cumsum = cached_items_probs(self, data_dir, tasks, arrays, self.mic_idxes_selected, T, stage, prob_mode)
+        self.data_sampler = AliasTable(probs_from_cumsum(self.data_probs_cumsum))
 
         self.dataset_sz = len(self.data_items) if dataset_sz is None else dataset_sz
         self.T = T
@@ -431,7 +488,7 @@ class RealMANOriDataset(RealMicSigDataset):
                         recoring_dir = task_dir + '/' + spk + '/' + array + '/' + 'record'
                         for uttr in os.listdir( recoring_dir ):
                             uttr_path = recoring_dir + '/' + uttr
-                            audio_duration = soundfile.info(uttr_path).duration
+                            audio_duration = probe_audio(uttr_path).duration
                             if audio_duration >= duration_min_limit:
                                 data_prob = 1
 
@@ -451,7 +508,7 @@ class RealMANOriDataset(RealMicSigDataset):
         if len(data_probs)>0:
             data_probs_sum = sum(data_probs)
             data_probs = [prob/data_probs_sum for prob in data_probs]
-            data_probs_cumsum=np.cumsum(data_probs, dtype=np.float32)
+            data_probs_cumsum=np.cumsum(data_probs, dtype=np.float64)
             data_probs_cumsum[-1] = 1
 
         return data_items, data_probs_cumsum
@@ -562,7 +619,8 @@ class LOCATADataset(RealMicSigDataset):
         self.room_sz = np.array([7.1, 9.8, 3])
 
         self.mic_idxes_selected = self.select_micpairs(arrays, nmic_selected, mic_dist_range)
-        self.data_items, self.data_probs_cumsum = self.get_items_probs(data_dir, tasks, arrays, self.mic_idxes_selected, T, stage, prob_mode)
+        self.data_items, self.data_probs_cumsum = cached_items_probs(self, data_dir, tasks, arrays, self.mic_idxes_selected, T, stage, prob_mode)
+        self.data_sampler = AliasTable(probs_from_cumsum(self.data_probs_cumsum))
 
         self.dataset_sz = len(self.data_items) if dataset_sz is None else dataset_sz
         self.T = T
@@ -586,7 +644,7 @@ class LOCATADataset(RealMicSigDataset):
                     for array in arrays:
                         if array in arrays_list:
                             data_path = os.path.join(task_path, recording, array, 'audio_array_' + array + '.wav')
-                            audio_duration = soundfile.info(data_path).duration
+                            audio_duration = probe_audio(data_path).duration
                             if audio_duration >= duration_min_limit:
                                 # according to room
                                 # according to utterance number
@@ -608,7 +666,7 @@ class LOCATADataset(RealMicSigDataset):
         if len(data_probs)>0:
             data_probs_sum = sum(data_probs)
             data_probs = [prob/data_probs_sum for prob in data_probs]
-            data_probs_cumsum=np.cumsum(data_probs, dtype=np.float32)
+            data_probs_cumsum=np.cumsum(data_probs, dtype=np.float64)
             data_probs_cumsum[-1] = 1
 
         return data_items, data_probs_cumsum
@@ -724,7 +782,8 @@ class MCWSJDataset(RealMicSigDataset):
                  sound_speed: float = 343.0):
         
         self.mic_idxes_selected = self.select_micpairs(arrays, nmic_selected, mic_dist_range)
-        self.data_items, self.data_probs_cumsum = self.get_items_probs(data_dir, tasks, arrays, self.mic_idxes_selected, T, stage, prob_mode)
+        self.data_items, self.data_probs_cumsum = cached_items_probs(self, data_dir, tasks, arrays, self.mic_idxes_selected, T, stage, prob_mode)
+        self.data_sampler = AliasTable(probs_from_cumsum(self.data_probs_cumsum))
 
         self.dataset_sz = len(self.data_items) if dataset_sz is None else dataset_sz
         self.T = T
@@ -755,13 +814,13 @@ class MCWSJDataset(RealMicSigDataset):
                             uttrs = uttrs[int(len(uttrs)*dataset_split_ratio[stage][0]):int(len(uttrs)*dataset_split_ratio[stage][1])]
 
                             if 'duration' in prob_mode:
-                                probs_uttr = [soundfile.info(wp).duration for wp in uttrs] 
+                                probs_uttr = [probe_audio(wp).duration for wp in uttrs] 
                             else:
                                 probs_uttr = [1 for wp in uttrs]
 
                             nmicpair = len(mic_idxes_selected[array])
                             for idx in range(len(uttrs)):
-                                if soundfile.info(uttrs[idx]).duration >= duration_min_limit:
+                                if probe_audio(uttrs[idx]).duration >= duration_min_limit:
                                     for micpair_idx in range(nmicpair):
                                         data_items.append((uttrs[idx], mic_idxes_selected[array][micpair_idx]))
                                         if 'micpair' in prob_mode:
@@ -772,7 +831,7 @@ class MCWSJDataset(RealMicSigDataset):
         if len(data_probs)>0:
             data_probs_sum = sum(data_probs)
             data_probs = [prob/data_probs_sum for prob in data_probs]
-            data_probs_cumsum = np.cumsum(data_probs, dtype=np.float32)
+            data_probs_cumsum = np.cumsum(data_probs, dtype=np.float64)
             data_probs_cumsum[-1] = 1
 
         return data_items, data_probs_cumsum
@@ -790,6 +849,9 @@ class MCWSJDataset(RealMicSigDataset):
             
         return np.array(mic_signals).transpose(1, 0)
     
+    def channel_files(self, data_path, mic_idxes_selected):
+        return [(data_path.parent / data_path.name.replace('-1_T.wav', f'-{mic_idx+1}_T.wav'), [0]) for mic_idx in mic_idxes_selected]
+    
     def select_micpairs(self, arrays, nmic_selected, mic_dist_range):
         mic_idxes_selected = {}
         mic_poss = {'array1': np.array((
@@ -837,7 +899,8 @@ class LibriCSSDataset(RealMicSigDataset):
             sound_speed: float = 343.0):
 
         self.mic_idxes_selected = self.select_micpairs(arrays, nmic_selected, mic_dist_range)
-        self.data_items, self.data_probs_cumsum = self.get_items_probs(data_dir, tasks, arrays, self.mic_idxes_selected, T, stage, prob_mode)
+        self.data_items, self.data_probs_cumsum = cached_items_probs(self, data_dir, tasks, arrays, self.mic_idxes_selected, T, stage, prob_mode)
+        self.data_sampler = AliasTable(probs_from_cumsum(self.data_probs_cumsum))
 
         self.dataset_sz = len(self.data_items) if dataset_sz is None else dataset_sz
         self.T = T
@@ -869,7 +932,7 @@ class LibriCSSDataset(RealMicSigDataset):
         data_probs = []
         for ds_uttrs in dataset_split[stage]:
             if 'duration' in prob_mode:
-                probs_uttr = [soundfile.info(wp).duration for wp in ds_uttrs]  
+                probs_uttr = [probe_audio(wp).duration for wp in ds_uttrs]  
             else:
                 probs_uttr = [1 for wp in ds_uttrs]
 
@@ -878,7 +941,7 @@ class LibriCSSDataset(RealMicSigDataset):
             #     probs_uttr = [prob / sum_probs_uttr for prob in probs_uttr]
             
             for idx in range(len(ds_uttrs)):
-                if soundfile.info(ds_uttrs[idx]).duration >= duration_min_limit:
+                if probe_audio(ds_uttrs[idx]).duration >= duration_min_limit:
                     for array in arrays:
                         nmicpair = len(mic_idxes_selected[array])
                         for micpair_idx in range(nmicpair):
@@ -891,7 +954,7 @@ class LibriCSSDataset(RealMicSigDataset):
         if len(data_probs)>0:
             data_probs_sum = sum(data_probs)
             data_probs = [prob / data_probs_sum for prob in data_probs]
-            data_probs_cumsum = np.cumsum(data_probs, dtype=np.float32)
+            data_probs_cumsum = np.cumsum(data_probs, dtype=np.float64)
             data_probs_cumsum[-1] = 1
 
         return data_items, data_probs_cumsum
@@ -951,7 +1014,8 @@ class AMIDataset(RealMicSigDataset):
         
         self.remove_spkoverlap = remove_spkoverlap      
         self.mic_idxes_selected = self.select_micpairs(arrays, nmic_selected, mic_dist_range)
-        self.data_items, self.data_probs_cumsum = self.get_items_probs(data_dir, tasks, arrays, self.mic_idxes_selected, T, stage, prob_mode)
+        self.data_items, self.data_probs_cumsum = cached_items_probs(self, data_dir, tasks, arrays, self.mic_idxes_selected, T, stage, prob_mode)
+        self.data_sampler = AliasTable(probs_from_cumsum(self.data_probs_cumsum))
 
         self.dataset_sz = len(self.data_items) if dataset_sz is None else dataset_sz
         self.T = T
@@ -975,13 +1039,13 @@ class AMIDataset(RealMicSigDataset):
                         uttrs += list(wav_dir.rglob(session[0:2]+'*.'+array+'-01.wav'))
 
                     if 'duration' in prob_mode:
-                        probs_uttr = [soundfile.info(wp).duration for wp in uttrs] 
+                        probs_uttr = [probe_audio(wp).duration for wp in uttrs] 
                     else:
                         probs_uttr = [1 for wp in uttrs]
 
                     nmicpair = len(mic_idxes_selected[array])
                     for idx in range(len(uttrs)):
-                        if soundfile.info(uttrs[idx]).duration >= duration_min_limit:
+                        if probe_audio(uttrs[idx]).duration >= duration_min_limit:
                             for micpair_idx in range(nmicpair):
                                 data_items.append((uttrs[idx], mic_idxes_selected[array][micpair_idx]))
                                 if 'micpair' in prob_mode:
@@ -992,7 +1056,7 @@ class AMIDataset(RealMicSigDataset):
         if len(data_probs)>0:
             data_probs_sum = sum(data_probs)
             data_probs = [prob/data_probs_sum for prob in data_probs]
-            data_probs_cumsum = np.cumsum(data_probs, dtype=np.float32)
+            data_probs_cumsum = np.cumsum(data_probs, dtype=np.float64)
             data_probs_cumsum[-1] = 1
 
         return data_items, data_probs_cumsum
@@ -1012,6 +1076,9 @@ class AMIDataset(RealMicSigDataset):
 
         return np.array(mic_signals).transpose(1, 0)
     
+    def channel_files(self, data_path, mic_idxes_selected):
+        return [(data_path.parent / data_path.name.replace('-01.wav', f'-0{mic_idx+1}.wav'), [0]) for mic_idx in mic_idxes_selected]
+    
     def select_micpairs(self, arrays, nmic_selected, mic_dist_range):
         nmic = 8
         mic_idxes_selected = {}
@@ -1056,7 +1123,8 @@ class AISHELL4Dataset(RealMicSigDataset):
         
         self.remove_spkoverlap = remove_spkoverlap
         self.mic_idxes_selected = self.select_micpairs(arrays, nmic_selected, mic_dist_range)
-        self.data_items, self.data_probs_cumsum = self.get_items_probs(data_dir, tasks, arrays, self.mic_idxes_selected, T, stage, prob_mode)
+        self.data_items, self.data_probs_cumsum = cached_items_probs(self, data_dir, tasks, arrays, self.mic_idxes_selected, T, stage, prob_mode)
+        self.data_sampler = AliasTable(probs_from_cumsum(self.data_probs_cumsum))
 
         self.dataset_sz = len(self.data_items) if dataset_sz is None else dataset_sz
         self.T = T
@@ -1097,7 +1165,7 @@ class AISHELL4Dataset(RealMicSigDataset):
 
             for sess_tran_file in session_trans_files:
                 if sess_tran_file.name not in ['20200622_M_R002S07C01.TextGrid', '20200710_M_R002S06C01.TextGrid']:
-                    tg_spks = textgrid.TextGrid.fromFile(sess_tran_file)
+                    tg_spks = load_textgrid(sess_tran_file)
                     sentence_infos = []
                     for tg_spk in tg_spks:
                         tgs = list(tg_spk)
@@ -1105,7 +1173,7 @@ class AISHELL4Dataset(RealMicSigDataset):
                             if tg.mark != '':
                                 sentence_infos += [tg]
                     sentence_infos.sort(key=lambda x: x.minTime)
-                    audio_duration = soundfile.info(list(sess_tran_file.parent.parent.rglob(sess_tran_file.name.replace('.TextGrid', '.flac')))[0]).duration
+                    audio_duration = probe_audio(list(sess_tran_file.parent.parent.rglob(sess_tran_file.name.replace('.TextGrid', '.flac')))[0]).duration
 
                     # the latest end time of the previous sentence
                     etbts, etbt = [], 0.0
@@ -1163,7 +1231,7 @@ class AISHELL4Dataset(RealMicSigDataset):
             data_items = []
             data_probs = []
             for wav_path in dataset_split[stage]: 
-                audio_duration = soundfile.info(wav_path).duration
+                audio_duration = probe_audio(wav_path).duration
                 if audio_duration >= duration_min_limit:
                     # according to room
                     # according to utterance number
@@ -1186,7 +1254,7 @@ class AISHELL4Dataset(RealMicSigDataset):
         if len(data_probs)>0:    
             data_probs_sum = sum(data_probs)
             data_probs = [prob/data_probs_sum for prob in data_probs]
-            data_probs_cumsum=np.cumsum(data_probs, dtype=np.float32)
+            data_probs_cumsum=np.cumsum(data_probs, dtype=np.float64)
             data_probs_cumsum[-1] = 1
 
         return data_items, data_probs_cumsum
@@ -1246,7 +1314,8 @@ class M2MeTDataset(RealMicSigDataset):
 
         self.remove_spkoverlap = remove_spkoverlap
         self.mic_idxes_selected = self.select_micpairs(arrays, nmic_selected, mic_dist_range)
-        self.data_items, self.data_probs_cumsum = self.get_items_probs(data_dir, tasks, arrays, self.mic_idxes_selected, T, stage, prob_mode)
+        self.data_items, self.data_probs_cumsum = cached_items_probs(self, data_dir, tasks, arrays, self.mic_idxes_selected, T, stage, prob_mode)
+        self.data_sampler = AliasTable(probs_from_cumsum(self.data_probs_cumsum))
 
         self.dataset_sz = len(self.data_items) if dataset_sz is None else dataset_sz
         self.T = T
@@ -1283,13 +1352,13 @@ class M2MeTDataset(RealMicSigDataset):
                     session_trans_files +=list((data_dir / f'{ds}/textgrid_dir').glob(room+'*.TextGrid'))
             
             for sess_tran_file in session_trans_files:
-                tg_spks = textgrid.TextGrid.fromFile(sess_tran_file)
+                tg_spks = load_textgrid(sess_tran_file)
                 sentence_infos = []
                 for tg in tg_spks:
                     sentence_infos += list(tg)
                 sentence_infos.sort(key=lambda x: x.maxTime)
                 wav_dir = sess_tran_file.parent.parent / 'audio_dir'
-                audio_duration = soundfile.info(list(wav_dir.glob(sess_tran_file.name.replace('.TextGrid', '*.wav')))[0]).duration
+                audio_duration = probe_audio(list(wav_dir.glob(sess_tran_file.name.replace('.TextGrid', '*.wav')))[0]).duration
 
                 # print(sentence_infos[-1], audio_duration)
                 # assert sentence_infos[-1].maxTime <= audio_duration, 'error'
@@ -1348,7 +1417,7 @@ class M2MeTDataset(RealMicSigDataset):
             # for wav_name in os.listdir(wav_dir): 
             #     wav_path = wav_dir / wav_name
             for wav_path in wav_paths:
-                audio_duration = soundfile.info(wav_path).duration
+                audio_duration = probe_audio(wav_path).duration
                 if audio_duration >= duration_min_limit:
                     # according to room
                     # according to utterance number
@@ -1371,7 +1440,7 @@ class M2MeTDataset(RealMicSigDataset):
         if len(data_probs)>0:
             data_probs_sum = sum(data_probs)
             data_probs = [prob / data_probs_sum for prob in data_probs]
-            data_probs_cumsum = np.cumsum(data_probs, dtype=np.float32)
+            data_probs_cumsum = np.cumsum(data_probs, dtype=np.float64)
             data_probs_cumsum[-1] = 1
 
         return data_items, data_probs_cumsum
@@ -1422,7 +1491,8 @@ class CHiME3Dataset(RealMicSigDataset):
                  sound_speed: float = 343.0):
         
         self.mic_idxes_selected = self.select_micpairs(arrays, nmic_selected, mic_dist_range)
-        self.data_items, self.data_probs_cumsum = self.get_items_probs(data_dir, tasks, arrays, self.mic_idxes_selected, T, stage, prob_mode)
+        self.data_items, self.data_probs_cumsum = cached_items_probs(self, data_dir, tasks, arrays, self.mic_idxes_selected, T, stage, prob_mode)
+        self.data_sampler = AliasTable(probs_from_cumsum(self.data_probs_cumsum))
 
         self.dataset_sz = len(self.data_items) if dataset_sz is None else dataset_sz
         self.T = T
@@ -1443,7 +1513,7 @@ class CHiME3Dataset(RealMicSigDataset):
 
                 uttrs = list(dir_sub.rglob('*.CH0.wav'))
                 if 'duration' in prob_mode:
-                    probs_uttr = [soundfile.info(wp).duration for wp in uttrs]  # 每个wav的权重为其duration
+                    probs_uttr = [probe_audio(wp).duration for wp in uttrs]  # 每个wav的权重为其duration
                 else:
                     probs_uttr = [1 for wp in uttrs]
 
@@ -1454,7 +1524,7 @@ class CHiME3Dataset(RealMicSigDataset):
                 for array in arrays:
                     nmicpair = len(mic_idxes_selected[array])
                     for idx in range(len(uttrs)):
-                        if soundfile.info(uttrs[idx]).duration >= duration_min_limit:
+                        if probe_audio(uttrs[idx]).duration >= duration_min_limit:
                             for micpair_idx in range(nmicpair):
                                 data_items.append((uttrs[idx], mic_idxes_selected[array][micpair_idx]))
                                 if 'micpair' in prob_mode:
@@ -1465,7 +1535,7 @@ class CHiME3Dataset(RealMicSigDataset):
         if len(data_probs)>0:  
             data_probs_sum = sum(data_probs)
             data_probs = [prob/data_probs_sum for prob in data_probs]
-            data_probs_cumsum = np.cumsum(data_probs, dtype=np.float32)
+            data_probs_cumsum = np.cumsum(data_probs, dtype=np.float64)
             data_probs_cumsum[-1] = 1
 
         return data_items, data_probs_cumsum
@@ -1483,6 +1553,9 @@ class CHiME3Dataset(RealMicSigDataset):
             
         return np.array(mic_signals).transpose(1, 0)
     
+    def channel_files(self, data_path, mic_idxes_selected):
+        return [(data_path.parent / data_path.name.replace('.CH0.wav', f'.CH{mic_idx}.wav'), [0]) for mic_idx in mic_idxes_selected]
+    
     def select_micpairs(self, arrays, nmic_selected, mic_dist_range):
         mic_idxes_selected = {}
         mic_poss = {'array': np.array((
@@ -1599,7 +1672,7 @@ class CHiME3Dataset(RealMicSigDataset):
 #         if len(data_probs)>0:
 #             data_probs_sum = sum(data_probs)
 #             data_probs = [prob / data_probs_sum for prob in data_probs]
-#             data_probs_cumsum = np.cumsum(data_probs, dtype=np.float32)
+#             data_probs_cumsum = np.cumsum(data_probs, dtype=np.float64)
 #             data_probs_cumsum[-1] = 1
 
 #         return data_items, data_probs_cumsum
@@ -0,0 +1,127 @@
+"""
+    Offline resampling cache of audio corpora and RIRs, so that datasets do not call resample_poly for every item
+
+    A file resampled to fs is stored in a mirror of its source directory tree under RESAMPLE_DIR/fs{fs}, with the same
+    file name and the modification time of its source. Datasets resolve each path with `resampled_path` and read the
+    mirror when it is up to date; paths derived from a mirrored path (e.g. other channels of the same recording) point
+    into the mirror as well. A changed source file (different modification time) falls back to the source until the
+    cache is rebuilt. The cache directory is set by the environment variable SARSSL_RESAMPLE_DIR.
+
+    Examples:
+        python utils_resample.py --fs 16000 --workers 32 --dirs ../../../data/MicSig/LOCATA ../../../data/MicSig/RealMAN
+        python utils_resample.py --fs 16000 --workers 32 --ext npy wav --dirs ../../../data/RIR/real
+"""
+
+import os
+import argparse
+import numpy as np
+import scipy
+import scipy.signal
+import soundfile
+import tqdm
+import multiprocessing as mp
+from functools import partial
+from pathlib import Path
+
+RESAMPLE_DIR = os.environ.get('SARSSL_RESAMPLE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'sarssl', 'resample'))
+
+_resolved_paths = {}    # (source path, fs) -> resolved path
+
+
+def _mirror_path(path, fs, resample_dir=None):
+    resample_dir = RESAMPLE_DIR if resample_dir is None else resample_dir
+    return os.path.join(resample_dir, f'fs{fs}', os.path.abspath(str(path)).lstrip(os.sep))
+
+def resampled_path(path, fs):
+    """ Resolve a source file to its resampled copy
+        Args:       path    - source file path (str or Path)
+                    fs      - target sampling rate
+        Returns:    path    - the cached copy at fs if it is up to date, otherwise the source path (same type as input)
+    """
+    key = (str(path), fs)
+    if key not in _resolved_paths:
+        mirror = _mirror_path(path, fs)
+        try:
+            is_cached = os.stat(mirror).st_mtime_ns == os.stat(str(path)).st_mtime_ns
+        except FileNotFoundError:
+            is_cached = False
+        resolved = mirror if is_cached else str(path)
+        _resolved_paths[key] = Path(resolved) if isinstance(path, Path) else resolved
+    return _resolved_paths[key]
+
+def is_resampled(path, fs):
+    """ Check whether `resampled_path(path, fs)` points to a cached copy
+    """
+    return str(resampled_path(path, fs)) != str(path)
+
+def resample_file(path, fs, resample_dir=None):
+    """ Resample one audio file (wav/flac) or RIR file (npy, sampling rate given in the companion _info.npz) into the cache
+        Args:       path    - source file path
+                    fs      - target sampling rate
+        Returns:    state   - 'resampled', 'cached' (already up to date) or 'skipped' (already at fs)
+    """
+    path = str(path)
+    mirror = _mirror_path(path, fs, resample_dir)
+    st = os.stat(path)
+    if os.path.exists(mirror) and (os.stat(mirror).st_mtime_ns == st.st_mtime_ns):
+        return 'cached'
+
+    tmp_path = f'{mirror}.{os.getpid()}.tmp'
+    Path(mirror).parent.mkdir(parents=True, exist_ok=True)
+    if path.endswith('.npy'):
+        fs_ori = int(np.load(path.replace('.npy', '_info.npz').replace('_dp_info.npz', '_info.npz'))['fs'])
+        if fs_ori == fs:
+            return 'skipped'
+        rir = np.load(path)
+        rir = scipy.signal.resample_poly(rir, fs, fs_ori, axis=2 if rir.ndim == 4 else 0) # (npoint, nch, nsample, nsource)
+        with open(tmp_path, 'wb') as f:
+            np.save(f, rir.astype(np.float32))
+    else:
+        info = soundfile.info(path)
+        if info.samplerate == fs:
+            return 'skipped'
+        sig, fs_ori = soundfile.read(path, dtype='float64', always_2d=True)
+        sig = scipy.signal.resample_poly(sig, fs, fs_ori, axis=0)
+        if info.subtype.startswith('PCM'):
+            sig = np.clip(sig, -1, 1)
+        soundfile.write(tmp_path, sig, fs, subtype=info.subtype, format=info.format)
+    os.replace(tmp_path, mirror)
+    os.utime(mirror, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+    return 'resampled'
+
+def build_resample_cache(dirs, fs, exts=['wav', 'flac'], workers=8, resample_dir=None):
+    """ Resample all files with given extensions under the directories into the cache, in parallel
+        Args:       dirs    - list of source directories
+                    fs      - target sampling rate
+                    exts    - file extensions
+                    workers - number of processes
+        Returns:    states  - dict of the number of resampled, cached and skipped files
+    """
+    paths = []
+    for dir in dirs:
+        for path in Path(dir).rglob('*'):
+            if path.suffix[1:] in exts:
+                paths.append(str(path))
+    states = {'resampled': 0, 'cached': 0, 'skipped': 0}
+    pbar = tqdm.tqdm(total=len(paths), desc=f'resampling to {fs} Hz')
+    with mp.Pool(processes=workers) as p:
+        for state in p.imap_unordered(partial(resample_file, fs=fs, resample_dir=resample_dir), paths, chunksize=16):
+            states[state] += 1
+            pbar.update()
+    pbar.close()
+    print(states)
+
+    return states
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Resampling audio corpora into the resampling cache')
+    parser.add_argument('--dirs', type=str, nargs='+', default=[], metavar='Dirs', help='source directories')
+    parser.add_argument('--fs', type=int, default=16000, metavar='SamplingRate', help='target sampling rate (default: 16000)')
+    parser.add_argument('--ext', type=str, nargs='+', default=['wav', 'flac'], metavar='Extensions', help='file extensions (default: wav flac)')
+    parser.add_argument('--workers', type=int, default=8, metavar='Worker', help='number of workers (default: 8)')
+    args = parser.parse_args()
+
+    print('Resampling cache: ' + RESAMPLE_DIR)
+    build_resample_cache(args.dirs, args.fs, exts=args.ext, workers=args.workers)
@@ -0,0 +1,102 @@
+"""
+    Memory-mapped bank of RIRs shared by all DataLoader workers
+
+    All RIRs of a dataset (already resampled to fs) are packed once into one float32 arena file with an offset table
+    and their annotations. The bank is pickled to workers as a path only, and each worker maps the arena lazily, so the
+    RIRs live once in the page cache and RIR access during training becomes a memory slice instead of np.load on a .npy
+    file and its _info.npz. A bank is identified by its RIR files (paths, modification times and sizes) and fs, and is
+    reused across runs until one of them changes. The bank directory is set by the environment variable SARSSL_RIRBANK_DIR.
+
+    Layout of a bank:
+        {name}_{hash}.bin       - float32 arena of all arrays of all RIRs
+        {name}_{hash}.npz       - offsets (nrir, nfield), shapes (nrir, nfield, 4), infos (nrir, ) dicts of annotations
+"""
+
+import os
+import hashlib
+import numpy as np
+import tqdm
+from pathlib import Path
+
+RIRBANK_DIR = os.environ.get('SARSSL_RIRBANK_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'sarssl', 'rirbank'))
+
+
+class RIRBank():
+    """ Memory-mapped bank of RIRs
+        Args:       name        - bank name, e.g. the class name of the RIR dataset
+                    rir_files   - list of RIR files, identifying the bank together with fs
+                    fs          - sampling rate of the RIRs in the bank
+                    load_fn     - function loading the idx-th RIR from files, returning (list of arrays (npoint, nch, nsample, nsource), dict of annotations)
+                    bank_dir    - directory of banks (default: RIRBANK_DIR)
+    """
+    def __init__(self, name, rir_files, fs, load_fn, bank_dir=None):
+        bank_dir = RIRBANK_DIR if bank_dir is None else bank_dir
+        key = [fs]
+        for rir_file in rir_files:
+            st = os.stat(rir_file)
+            key += [(str(rir_file), st.st_mtime_ns, st.st_size)]
+        key_hash = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()[:16]
+        self.arena_path = os.path.join(bank_dir, f'{name}_{key_hash}.bin')
+        self.index_path = os.path.join(bank_dir, f'{name}_{key_hash}.npz')
+        if not os.path.exists(self.index_path):
+            self.build(len(rir_files), load_fn, bank_dir)
+
+        with np.load(self.index_path, allow_pickle=True) as index:
+            self.offsets = index['offsets']
+            self.shapes = index['shapes']
+            self.infos = list(index['infos'])
+        self._arena = None
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_arena'] = None
+        return state
+
+    def build(self, nrir, load_fn, bank_dir):
+        """ Load all RIRs and write the arena sequentially, then the offset table (written last, so a partial bank is never used)
+        """
+        Path(bank_dir).mkdir(parents=True, exist_ok=True)
+        tmp_arena_path = f'{self.arena_path}.{os.getpid()}.tmp'
+        tmp_index_path = f'{self.index_path}.{os.getpid()}.tmp'
+        offsets, shapes, infos = [], [], []
+        offset = 0
+        with open(tmp_arena_path, 'wb') as f:
+            for idx in tqdm.tqdm(range(nrir), desc=f'building RIR bank {os.path.basename(self.index_path)}'):
+                arrays, info = load_fn(idx)
+                offsets += [[]]
+                shapes += [[]]
+                for array in arrays:
+                    assert array.ndim == 4, f'RIR of shape {array.shape} is not (npoint, nch, nsample, nsource)'
+                    array = np.ascontiguousarray(array, dtype=np.float32)
+                    array.tofile(f)
+                    offsets[-1] += [offset]
+                    shapes[-1] += [array.shape]
+                    offset += array.size
+                infos += [{key: np.asarray(value) for key, value in info.items()}]
+        infos_arr = np.empty(len(infos), dtype=object)
+        for idx, info in enumerate(infos):
+            infos_arr[idx] = info
+        with open(tmp_index_path, 'wb') as f:
+            np.savez(f, offsets=np.array(offsets, dtype=np.int64), shapes=np.array(shapes, dtype=np.int64), infos=infos_arr)
+        os.replace(tmp_arena_path, self.arena_path)
+        os.replace(tmp_index_path, self.index_path)
+
+    def get(self, idx):
+        """ Returns:    arrays  - list of read-only float32 views of the idx-th RIR in the arena
+                        info    - dict of annotations
+        """
+        if self._arena is None:
+            self._arena = np.memmap(self.arena_path, dtype=np.float32, mode='r')
+        arrays = []
+        for offset, shape in zip(self.offsets[idx], self.shapes[idx]):
+            size = int(np.prod(shape))
+            arrays += [self._arena[offset:offset+size].reshape(shape)]
+
+        return arrays, self.infos[idx]
+
+
+if __name__ == '__main__':
+    pass
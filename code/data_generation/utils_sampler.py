@@ -0,0 +1,192 @@
+"""
+    Weighted sampling of corpora and items with Walker/Vose alias tables
+
+    An alias table is built once in O(n) from float64 weights and then draws an index in O(1) with a single uniform
+    random number, so neither a cumulative-sum table nor a binary search (np.searchsorted) is needed.
+"""
+
+import numpy as np
+from torch.utils.data import Sampler
+
+
+def probs_from_cumsum(probs_cumsum):
+    """ Recover the probabilities from a cumulative-sum table
+    """
+    probs_cumsum = np.asarray(probs_cumsum, dtype=np.float64)
+    return np.diff(probs_cumsum, prepend=0.0)
+
+
+class AliasTable():
+    """ Walker/Vose alias table for O(1) weighted sampling
+        Args:       weights     - non-negative weights (n, ), need not be normalized
+    """
+    def __init__(self, weights):
+        weights = np.asarray(weights, dtype=np.float64)
+        assert (weights.ndim == 1) & (len(weights) > 0), 'Weights should be a non-empty 1-D array'
+        assert np.all(weights >= 0) & (weights.sum() > 0), 'Weights should be non-negative with a positive sum'
+        n = len(weights)
+        scaled = weights / weights.sum() * n
+        self.prob = np.ones(n, dtype=np.float64)
+        self.alias = np.arange(n, dtype=np.int64)
+
+        # Vose's algorithm, pairing all current small columns with distinct large columns at once
+        small = np.flatnonzero(scaled < 1)
+        large = np.flatnonzero(scaled >= 1)
+        while (len(small) > 0) & (len(large) > 0):
+            k = min(len(small), len(large))
+            s, l = small[:k], large[:k]
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] = scaled[l] - (1 - scaled[s])
+            small = np.concatenate((small[k:], l[scaled[l] < 1]))
+            large = np.concatenate((large[k:], l[scaled[l] >= 1]))
+        # remaining columns are full up to rounding errors
+        self.prob[small] = 1
+        self.prob[large] = 1
+        self.n = n
+
+    def __len__(self):
+        return self.n
+
+    def sample(self, n=None, rng=None):
+        """ Draw indexes, using one uniform random number per index
+            Args:       n       - number of indexes, None for a single index
+                        rng     - np.random.Generator or np.random.RandomState (default: global numpy RNG)
+            Returns:    idx     - int or (n, ) int64 array
+        """
+        rng = np.random if rng is None else rng
+        x = rng.uniform(size=1 if n is None else n) * self.n
+        col = np.minimum(x.astype(np.int64), self.n - 1)
+        idx = np.where((x - col) < self.prob[col], col, self.alias[col])
+        return int(idx[0]) if n is None else idx
+
+
+class CorpusItemSampler(Sampler):
+    """ Draw (dataset index, item index, crop offset ratio) triples for a weighted mixture of datasets, batch by batch in the main process
+        Args:       dataset_weights - weights of datasets (ndataset, )
+                    item_tables     - list of AliasTable of items for each dataset, or the number of items for uniform sampling
+                    num_samples     - number of triples per epoch
+                    seed            - seed of each epoch is seed+epoch; None to seed from the global numpy RNG when iterating
+                    chunk_size      - number of triples drawn at once
+                    num_replicas    - number of processes of distributed training, each drawing the same sequence of triples
+                                      (with the same seed or global numpy RNG state) and keeping every num_replicas-th one
+                    rank            - rank of the process
+    """
+    def __init__(self, dataset_weights, item_tables, num_samples, seed=None, chunk_size=4096, num_replicas=1, rank=0):
+        self.dataset_table = AliasTable(dataset_weights)
+        self.item_tables = item_tables
+        self.num_samples = num_samples
+        self.seed = seed
+        self.chunk_size = chunk_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+
+    def __len__(self):
+        # the same for all processes, so that they run the same number of steps
+        return self.num_samples // self.num_replicas
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def sample(self, n, rng):
+        """ Returns:    dataset_idxes, item_idxes, offsets - (n, ) arrays
+        """
+        dataset_idxes = self.dataset_table.sample(n, rng)
+        item_idxes = np.zeros(n, dtype=np.int64)
+        for dataset_idx in np.unique(dataset_idxes):
+            mask = (dataset_idxes == dataset_idx)
+            table = self.item_tables[dataset_idx]
+            if isinstance(table, AliasTable):
+                item_idxes[mask] = table.sample(int(mask.sum()), rng)
+            else:
+                item_idxes[mask] = rng.integers(0, table, size=int(mask.sum()))
+        offsets = rng.uniform(size=n)
+        return dataset_idxes, item_idxes, offsets
+
+    def __iter__(self):
+        if self.seed is None:
+            rng = np.random.default_rng(np.random.randint(0, 2**31-1))
+        else:
+            rng = np.random.default_rng(self.seed + self.epoch)
+        num_samples = len(self) * self.num_replicas
+        for st in range(0, num_samples, self.chunk_size):
+            n = min(self.chunk_size, num_samples - st)
+            dataset_idxes, item_idxes, offsets = self.sample(n, rng)
+            keep = slice((self.rank - st) % self.num_replicas, None, self.num_replicas)
+            for dataset_idx, item_idx, offset in zip(dataset_idxes[keep].tolist(), item_idxes[keep].tolist(), offsets[keep].tolist()):
+                yield (dataset_idx, item_idx, offset)
+
+
+class CropPlanBatchSampler(Sampler):
+    """ Group the draws of an item sampler into batches and turn each draw into a crop plan in the main process,
+        so that the reads of a whole batch can be issued together by the dataset (`__getitems__`)
+        Args:       item_sampler    - CorpusItemSampler
+                    plan_fn         - function turning a drawn triple into a crop plan
+                    batch_size      - number of crop plans per batch
+                    drop_last       - whether to drop the last incomplete batch
+    """
+    def __init__(self, item_sampler, plan_fn, batch_size, drop_last=False):
+        self.item_sampler = item_sampler
+        self.plan_fn = plan_fn
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.item_sampler) // self.batch_size
+        return (len(self.item_sampler) + self.batch_size - 1) // self.batch_size
+
+    def set_epoch(self, epoch):
+        self.item_sampler.set_epoch(epoch)
+
+    def __iter__(self):
+        batch = []
+        for idx in self.item_sampler:
+            batch += [self.plan_fn(idx)]
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+        if (len(batch) > 0) & (not self.drop_last):
+            yield batch
+
+
+class ResumableBatchSampler(Sampler):
+    """ Batch sampler whose next epoch can start from a given batch, used to resume training from a mid-epoch checkpoint
+        The skipped batches are still drawn (so the remaining batches are the same as without resuming), but not loaded
+        Args:       batch_sampler   - batch sampler, e.g. BatchSampler(RandomSampler(dataset), batch_size, drop_last) or CropPlanBatchSampler
+    """
+    def __init__(self, batch_sampler):
+        self.batch_sampler = batch_sampler
+        self._start_batch = 0
+        self._on_start = None
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+    def set_epoch(self, epoch):
+        if hasattr(self.batch_sampler, 'set_epoch'):
+            self.batch_sampler.set_epoch(epoch)
+        elif hasattr(getattr(self.batch_sampler, 'sampler', None), 'set_epoch'):
+            self.batch_sampler.sampler.set_epoch(epoch) # e.g. BatchSampler(DistributedSampler)
+
+    def skip_next(self, start_batch, on_start=None):
+        """ Skip the first start_batch batches of the next epoch only
+            Args:   on_start    - function called after the skipped batches are drawn, e.g. restoring random states
+        """
+        self._start_batch = start_batch
+        self._on_start = on_start
+
+    def __iter__(self):
+        start_batch, on_start = self._start_batch, self._on_start
+        self._start_batch, self._on_start = 0, None
+        for batch_idx, batch in enumerate(self.batch_sampler):
+            if batch_idx < start_batch:
+                continue
+            if (batch_idx == start_batch) & (on_start is not None):
+                on_start()
+            yield batch
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,197 @@
+"""
+    Packed, memory-mapped shards of fixed-length microphone signals and their annotations
+
+    Layout of a shard directory:
+        shard_info.npz      - fs, nsample, nch, dtype, shard_size, data_num, save_dp
+        sig_{k:04d}.npy     - microphone signals of the k-th shard (shard_size, nsample, nch), int16 or float32
+        sig_dp_{k:04d}.npy  - direct-path microphone signals of the k-th shard (optional)
+        anno.npy            - annotation side table (data_num, ), structured array of ANNO_DTYPE
+
+    Examples:
+        writer = MicSigShardWriter(save_dir, data_num=512000, nsample=int(4.112*16000), nch=2, fs=16000)
+        writer.write(idx, mic_sig, annos)   # can be called from different processes with different idx
+        shards = MicSigShards(save_dir)
+        mic_sig, annos = shards.read_sig(idx), shards.read_anno(idx)
+"""
+
+import os
+import numpy as np
+from pathlib import Path
+
+ANNO_DTYPE = np.dtype([
+    ('TDOA', np.float32),
+    ('T60', np.float32),
+    ('DRR', np.float32),
+    ('C50', np.float32),
+    ('room_sz', np.float32, (3, )),
+    ('SNR', np.float32),
+    ('valid', np.bool_)])
+INT16_SCALE = 32768.0
+
+def is_shard_dir(data_dir):
+    """ Check whether a directory (or all directories of a list) holds packed microphone signal shards
+    """
+    if isinstance(data_dir, list):
+        return (len(data_dir) > 0) and all([is_shard_dir(d) for d in data_dir])
+    return os.path.isfile(os.path.join(str(data_dir), 'shard_info.npz'))
+
+def _anno_value(annos, keys, shape=()):
+    for key in keys:
+        if (key in annos):
+            value = np.asarray(annos[key], dtype=np.float32)
+            assert value.size == int(np.prod(shape)), f'Annotation {key} of shape {value.shape} cannot be packed into shape {shape}'
+            return value.reshape(shape)
+    return np.full(shape, np.nan, dtype=np.float32)
+
+
+class MicSigShardWriter():
+    """ Write fixed-length microphone signals and annotations into preallocated memory-mapped shards.
+        The writer is picklable and opens the shards lazily, so it can be shared by the worker processes of data generation.
+    """
+    def __init__(self, save_dir, data_num, nsample, nch, fs, dtype='int16', shard_size=65536, save_dp=False):
+        assert dtype in ['int16', 'float32'], dtype
+        self.save_dir = str(save_dir)
+        self.data_num = data_num
+        self.nsample = nsample
+        self.nch = nch
+        self.fs = fs
+        self.dtype = dtype
+        self.shard_size = shard_size
+        self.save_dp = save_dp
+        self._maps = {}
+
+        Path(self.save_dir).mkdir(parents=True, exist_ok=True)
+        nshard = (data_num + shard_size - 1) // shard_size
+        for shard_idx in range(nshard):
+            shard_num = min(shard_size, data_num - shard_idx * shard_size)
+            for name in (['sig', 'sig_dp'] if save_dp else ['sig']):
+                np.lib.format.open_memmap(self._shard_path(name, shard_idx), mode='w+', dtype=dtype, shape=(shard_num, nsample, nch))
+        anno = np.lib.format.open_memmap(os.path.join(self.save_dir, 'anno.npy'), mode='w+', dtype=ANNO_DTYPE, shape=(data_num, ))
+        anno['valid'] = False
+        anno.flush()
+        np.savez(os.path.join(self.save_dir, 'shard_info.npz'),
+                 fs=fs, nsample=nsample, nch=nch, dtype=dtype, shard_size=shard_size, data_num=data_num, save_dp=save_dp)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_maps'] = {}
+        return state
+
+    def _shard_path(self, name, shard_idx):
+        return os.path.join(self.save_dir, f'{name}_{shard_idx:04d}.npy')
+
+    def _map(self, name, shard_idx=None):
+        key = (name, shard_idx)
+        if key not in self._maps:
+            path = os.path.join(self.save_dir, 'anno.npy') if shard_idx is None else self._shard_path(name, shard_idx)
+            self._maps[key] = np.load(path, mmap_mode='r+')
+        return self._maps[key]
+
+    def _encode(self, sig):
+        assert sig.shape == (self.nsample, self.nch), f'Signal shape {sig.shape} does not match shard shape {(self.nsample, self.nch)}'
+        if self.dtype == 'int16':
+            return np.clip(np.round(sig * INT16_SCALE), -32768, 32767).astype(np.int16)
+        else:
+            return sig.astype(np.float32)
+
+    def write(self, idx, mic_sig, annos=None, mic_sig_dp=None):
+        """ Write one sample
+            Args:       idx         - sample index in [0, data_num)
+                        mic_sig     - microphone signals (nsample, nch), in the range of [-1, 1]
+                        annos       - dict of annotations (TDOA, T60 or T60_edc, DRR, C50, room_sz, SNR), missing ones are NaN
+                        mic_sig_dp  - direct-path microphone signals (nsample, nch)
+        """
+        shard_idx, row = divmod(idx, self.shard_size)
+        self._map('sig', shard_idx)[row] = self._encode(mic_sig)
+        if self.save_dp:
+            assert mic_sig_dp is not None, 'Direct-path signal is required by this shard'
+            self._map('sig_dp', shard_idx)[row] = self._encode(mic_sig_dp)
+
+        annos = {} if annos is None else annos
+        anno = self._map('anno')
+        anno[idx] = (
+            _anno_value(annos, ['TDOA']),
+            _anno_value(annos, ['T60', 'T60_edc']),
+            _anno_value(annos, ['DRR']),
+            _anno_value(annos, ['C50']),
+            _anno_value(annos, ['room_sz'], shape=(3, )),
+            _anno_value(annos, ['SNR']),
+            True)
+
+    def close(self):
+        for map in self._maps.values():
+            map.flush()
+        self._maps = {}
+
+
+class MicSigShards():
+    """ Read microphone signals and annotations from packed memory-mapped shards (one directory or a list of directories).
+        The shards are opened lazily in each process and never pickled, so the dataset can be sent to DataLoader workers cheaply.
+    """
+    def __init__(self, data_dirs):
+        self.data_dirs = [str(d) for d in data_dirs] if isinstance(data_dirs, list) else [str(data_dirs)]
+        self.infos = []
+        self.items = [] # (directory index, sample index in the directory) of valid samples
+        for dir_idx, data_dir in enumerate(self.data_dirs):
+            info = dict(np.load(os.path.join(data_dir, 'shard_info.npz')))
+            self.infos.append({key: value.item() for key, value in info.items()})
+            valid = np.load(os.path.join(data_dir, 'anno.npy'), mmap_mode='r')['valid']
+            sample_idxes = np.flatnonzero(valid)
+            self.items.append(np.stack((np.full_like(sample_idxes, dir_idx), sample_idxes), axis=-1))
+        self.items = np.concatenate(self.items, axis=0)
+        fss = list(set([info['fs'] for info in self.infos]))
+        assert len(fss) == 1, f'Shards with different sampling rates: {fss}'
+        self.fs = fss[0]
+        self.save_dp = all([info['save_dp'] for info in self.infos])
+        self._maps = {}
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_maps'] = {}
+        return state
+
+    def _map(self, dir_idx, name, shard_idx=None):
+        key = (dir_idx, name, shard_idx)
+        if key not in self._maps:
+            if shard_idx is None:
+                path = os.path.join(self.data_dirs[dir_idx], 'anno.npy')
+            else:
+                path = os.path.join(self.data_dirs[dir_idx], f'{name}_{shard_idx:04d}.npy')
+            self._maps[key] = np.load(path, mmap_mode='r')
+        return self._maps[key]
+
+    def read_sig(self, idx, dp=False):
+        """ Returns:    mic_sig - microphone signals (nsample, nch), float32; a view of the shard if stored as float32
+        """
+        dir_idx, sample_idx = self.items[idx]
+        info = self.infos[dir_idx]
+        shard_idx, row = divmod(int(sample_idx), info['shard_size'])
+        sig = self._map(dir_idx, 'sig_dp' if dp else 'sig', shard_idx)[row]
+        if info['dtype'] == 'int16':
+            return sig.astype(np.float32) / INT16_SCALE
+        else:
+            return sig
+
+    def read_anno(self, idx):
+        """ Returns:    annos   - dict of TDOA, T60, DRR, C50, ABS (NaN when not annotated)
+        """
+        dir_idx, sample_idx = self.items[idx]
+        anno = self._map(dir_idx, 'anno')[int(sample_idx)]
+        room_sz = anno['room_sz']
+        vol = room_sz[0] * room_sz[1] * room_sz[2]
+        sur = room_sz[0] * room_sz[1] + room_sz[0] * room_sz[2] + room_sz[1] * room_sz[2]
+        annos = {
+            'TDOA': np.array(anno['TDOA'], dtype=np.float32),
+            'T60': np.array(anno['T60'], dtype=np.float32),
+            'DRR': np.array(anno['DRR'], dtype=np.float32),
+            'C50': np.array(anno['C50'], dtype=np.float32),
+            'ABS': np.array(0.161*vol/sur/anno['T60'], dtype=np.float32),
+            }
+        return annos
+
+
+if __name__ == '__main__':
+    pass
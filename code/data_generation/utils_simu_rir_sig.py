@@ -13,6 +13,10 @@ from torch.utils.data import Dataset
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
 from scipy.optimize import minimize
+try:
+    from utils_rirbank import *
+except:
+    from data_generation.utils_rirbank import *
 
 class SpatialAcoustics():
     """ Generate random spatial acoustics configurations.
@@ -760,6 +764,7 @@ class MicrophoneSignalOrRIR():
         save_dp=False,
         gpu_conv=False,
         seed=1,
+        shard_writer=None,
         ):
         # print(seed+idx)
         np.random.seed(seed=seed+idx)
@@ -851,6 +856,9 @@ class MicrophoneSignalOrRIR():
             )
 
         # Save data
+        if shard_writer is not None:
+            shard_writer.write(idx, mic_sig, annos={**sa_cfg, **annos}, mic_sig_dp=mic_sig_dp if save_dp else None)
+            return
         Path(save_to).mkdir(parents=True, exist_ok=True)
         save_to_file = os.path.join(save_to, str(idx) + f'.wav')
         soundfile.write(save_to_file, mic_sig, fs)
@@ -1084,7 +1092,8 @@ class RIRDataset(Dataset):
         rir_dir_list,
         load_dp=True,
         load_info=True,
-        dataset_sz=None):
+        dataset_sz=None,
+        rir_bank=False):
 
         if isinstance(rir_dir_list, list):
             self.rir_files = []
@@ -1096,11 +1105,15 @@ class RIRDataset(Dataset):
         self.load_info = load_info
         self.fs = fs
         self.dataset_sz = len(self.rir_files) if dataset_sz is None else dataset_sz
+        bank_name = type(self).__name__ + ('_dp' if load_dp else '')
+        self.rir_bank = RIRBank(bank_name, self.rir_files, fs, self.load_rir) if rir_bank else None
 
     def __len__(self):
         return self.dataset_sz
 
-    def __getitem__(self, idx):
+    def load_rir(self, idx):
+        """ Load the idx-th RIR and direct-path RIR (if load_dp, resampled to fs) and their annotations from files
+        """
         rir_dp_file = str(self.rir_files[idx])
         rir_file = rir_dp_file.replace('_dp.npy', '.npy')
         rir = np.load(rir_file).astype(np.float32)
@@ -1108,12 +1121,20 @@ class RIRDataset(Dataset):
         info = np.load(info_file)
         if self.fs!= info['fs']:
             rir = scipy.signal.resample_poly(rir, self.fs, info['fs'])
-        return_data = [rir]
+        rirs = [rir]
         if self.load_dp:
             rir_dp = np.load(rir_dp_file)
             if self.fs!= info['fs']:
                 rir_dp = scipy.signal.resample_poly(rir_dp, self.fs, info['fs'])
-            return_data.append(rir_dp)
+            rirs.append(rir_dp)
+        return rirs, info
+
+    def __getitem__(self, idx):
+        if self.rir_bank is not None:
+            rirs, info = self.rir_bank.get(idx)
+        else:
+            rirs, info = self.load_rir(idx)
+        return_data = list(rirs)
         if self.load_info:
             return_data.append(info)
 
@@ -0,0 +1,152 @@
+"""
+    Memory-mapped pool of decoded speech utterances shared by all DataLoader workers
+
+    All utterances of a corpus (resampled to fs) are decoded once into one arena file, stored as float32, float16 or
+    int16 to trade precision for memory, with a per-utterance offset table and a per-speaker (group) offset table.
+    The pool is pickled to workers as a path only, and each worker maps the arena lazily, so source and babble signals
+    are made by slicing and concatenating the arena instead of opening and decoding wav files for every sample. A pool
+    is identified by its files (paths, modification times and sizes), fs and storage dtype, and is reused across runs
+    until one of them changes. The pool directory is set by the environment variable SARSSL_SPEECHPOOL_DIR.
+
+    Layout of a pool:
+        {name}_{hash}.bin       - arena of all utterances
+        {name}_{hash}.npz       - offsets (nutt+1, ) in samples, group_offsets (ngroup+1, ) in utterances, dtype
+"""
+
+import os
+import hashlib
+import numpy as np
+import scipy
+import scipy.signal
+import soundfile
+import tqdm
+from pathlib import Path
+try:
+    from utils_resample import *
+except:
+    from data_generation.utils_resample import *
+
+SPEECHPOOL_DIR = os.environ.get('SARSSL_SPEECHPOOL_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'sarssl', 'speechpool'))
+INT16_SCALE = 32768.0
+
+
+class SpeechPool():
+    """ Memory-mapped pool of decoded speech utterances
+        Args:       name        - pool name, e.g. the class name of the dataset
+                    groups      - list of utterance path lists, e.g. one list for each speaker
+                    fs          - sampling rate of the pool
+                    dtype       - storage dtype, 'float32', 'float16' or 'int16'
+                    pool_dir    - directory of pools (default: SPEECHPOOL_DIR)
+    """
+    def __init__(self, name, groups, fs, dtype='int16', pool_dir=None):
+        assert dtype in ['float32', 'float16', 'int16'], dtype
+        pool_dir = SPEECHPOOL_DIR if pool_dir is None else pool_dir
+        files = [str(file) for group in groups for file in group]
+        key = [fs, dtype, [len(group) for group in groups]]
+        for file in files:
+            st = os.stat(file)
+            key += [(file, st.st_mtime_ns, st.st_size)]
+        key_hash = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()[:16]
+        self.arena_path = os.path.join(pool_dir, f'{name}_{key_hash}.bin')
+        self.index_path = os.path.join(pool_dir, f'{name}_{key_hash}.npz')
+        self.dtype = dtype
+        if not os.path.exists(self.index_path):
+            self.build(files, [len(group) for group in groups], fs, pool_dir)
+
+        with np.load(self.index_path) as index:
+            self.offsets = index['offsets']
+            self.group_offsets = index['group_offsets']
+        self._arena = None
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_arena'] = None
+        return state
+
+    def build(self, files, group_sizes, fs, pool_dir):
+        """ Decode all utterances and write the arena sequentially, then the offset tables (written last, so a partial pool is never used)
+        """
+        Path(pool_dir).mkdir(parents=True, exist_ok=True)
+        tmp_arena_path = f'{self.arena_path}.{os.getpid()}.tmp'
+        tmp_index_path = f'{self.index_path}.{os.getpid()}.tmp'
+        offsets = [0]
+        with open(tmp_arena_path, 'wb') as f:
+            for file in tqdm.tqdm(files, desc=f'building speech pool {os.path.basename(self.index_path)}'):
+                s, fs_ori = soundfile.read(resampled_path(file, fs), dtype='float32')
+                assert s.ndim == 1, f'Speech pool only holds single-channel utterances: {file}'
+                if fs_ori != fs:
+                    s = scipy.signal.resample_poly(s, up=fs, down=fs_ori)
+                if self.dtype == 'int16':
+                    s = np.clip(np.round(s * INT16_SCALE), -32768, 32767)
+                s.astype(self.dtype).tofile(f)
+                offsets += [offsets[-1] + len(s)]
+        with open(tmp_index_path, 'wb') as f:
+            np.savez(f, offsets=np.array(offsets, dtype=np.int64), group_offsets=np.cumsum([0] + group_sizes, dtype=np.int64))
+        os.replace(tmp_arena_path, self.arena_path)
+        os.replace(tmp_index_path, self.index_path)
+
+    def _decode(self, s):
+        if self.dtype == 'int16':
+            return s.astype(np.float32) / INT16_SCALE
+        else:
+            return s.astype(np.float32)
+
+    def _map(self):
+        if self._arena is None:
+            self._arena = np.memmap(self.arena_path, dtype=self.dtype, mode='r')
+        return self._arena
+
+    def group_size(self, group_idx):
+        return int(self.group_offsets[group_idx+1] - self.group_offsets[group_idx])
+
+    def utterance(self, utt_idx):
+        """ Returns:    s   - the utt_idx-th utterance of the pool (nsample, ), float32
+        """
+        return self._decode(self._map()[self.offsets[utt_idx]:self.offsets[utt_idx+1]])
+
+    def pad_cut_sameutt(self, utt_idx, nsample_desired):
+        """ Pad (by repeating the same utterance) and cut the utt_idx-th utterance to desired length, as pad_cut_sig_sameutt
+            Returns:    s   - (nsample_desired, ), float32
+        """
+        nsample_utt = int(self.offsets[utt_idx+1] - self.offsets[utt_idx])
+        nsample = nsample_utt
+        while nsample < nsample_desired:
+            nsample = nsample * 2
+        st = np.random.randint(0, nsample - nsample_desired+1)
+        if st + nsample_desired <= nsample_utt:
+            return self._decode(self._map()[self.offsets[utt_idx]+st:self.offsets[utt_idx]+st+nsample_desired])
+        return self.utterance(utt_idx)[(st + np.arange(nsample_desired)) % nsample_utt]
+
+    def pad_cut_samespk(self, group_idx, utt_idx, nsample_desired):
+        """ Pad (by appending the following utterances of the same group) and cut the utt_idx-th utterance of a group to desired length, as pad_cut_sig_samespk
+            Returns:    s   - (nsample_desired, ), float32
+        """
+        group_st = int(self.group_offsets[group_idx])
+        group_sz = self.group_size(group_idx)
+        utt_idxes = []
+        nsample = 0
+        while nsample < nsample_desired:
+            utt_idxes += [group_st + utt_idx]
+            nsample += int(self.offsets[group_st+utt_idx+1] - self.offsets[group_st+utt_idx])
+            utt_idx += 1
+            if utt_idx >= group_sz: utt_idx = 0
+        st = np.random.randint(0, nsample - nsample_desired+1)
+        ed = st + nsample_desired
+
+        arena = self._map()
+        pieces = []
+        utt_st = 0
+        for idx in utt_idxes:
+            utt_ed = utt_st + int(self.offsets[idx+1] - self.offsets[idx])
+            if (utt_ed > st) & (utt_st < ed):
+                pieces += [arena[self.offsets[idx]+max(st-utt_st, 0):self.offsets[idx]+min(ed, utt_ed)-utt_st]]
+            utt_st = utt_ed
+
+        return self._decode(np.concatenate(pieces))
+
+
+if __name__ == '__main__':
+    pass
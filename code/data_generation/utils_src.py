@@ -7,6 +7,10 @@ import scipy.signal
 import soundfile
 import webrtcvad
 from torch.utils.data import Dataset
+try:
+    from utils_speechpool import *
+except:
+    from data_generation.utils_speechpool import *
 
 def explore_corpus(path, file_extension):
         directory_tree = {}
@@ -68,8 +72,9 @@ class WSJ0Dataset(Dataset):
         val: /dt 5h
         test: /et 5h
         spk/wav
+        pool_dtype: None to read wav files for each sample, or the storage dtype ('float32', 'float16', 'int16') of a SpeechPool holding all utterances
     """
-    def __init__(self, path, T, fs, num_source=1, size=None):
+    def __init__(self, path, T, fs, num_source=1, size=None, pool_dtype=None):
 
         self.corpus, self.paths = explore_corpus(path, 'wav')
         self.spkWAVs = []
@@ -84,6 +89,7 @@ class WSJ0Dataset(Dataset):
         self.T = T
         self.sum_source = num_source
         self.sz = len(self.spkIDs) if size is None else size 
+        self.speech_pool = None if pool_dtype is None else SpeechPool(type(self).__name__, [list(spkWAVs.values()) for spkWAVs in self.spkWAVs], fs, dtype=pool_dtype)
 
     def __len__(self):
         return self.sz
@@ -109,11 +115,14 @@ class WSJ0Dataset(Dataset):
             utt_paths = list(spkWAVs.values())
             # Get a random speech utterance from specific speaker
             utt_idx = np.random.randint(0, len(utt_paths))
-            s, fs = soundfile.read(self.paths[utt_idx], dtype='float32')
-            if fs != self.fs:
-                s = scipy.signal.resample_poly(s, up=self.fs, down=fs)
-                raise Warning('WSJ0 is downsampled to requrired frequency~')
-            s = pad_cut_sig_samespk(utt_paths, utt_idx, s_shape_desired, self.fs) # pad by the same spk
+            if self.speech_pool is not None:
+                s = self.speech_pool.pad_cut_samespk(idx_list[source_idx], utt_idx, s_shape_desired) # pad by the same spk
+            else:
+                s, fs = soundfile.read(self.paths[utt_idx], dtype='float32')
+                if fs != self.fs:
+                    s = scipy.signal.resample_poly(s, up=self.fs, down=fs)
+                    raise Warning('WSJ0 is downsampled to requrired frequency~')
+                s = pad_cut_sig_samespk(utt_paths, utt_idx, s_shape_desired, self.fs) # pad by the same spk
             s -= s.mean()
 
             s_sources += [s]
@@ -8,6 +8,11 @@ from torch.utils.data import Dataset
 from data_generation.utils_real_micsig import *
 from data_generation.utils_src import *
 from data_generation.utils_noise import *
+from data_generation.utils_shard import *
+from data_generation.utils_manifest import *
+from data_generation.utils_resample import *
+from data_generation.utils_sampler import *
+from data_generation.utils_reader import *
 import data_generation.gen_sig_from_real_rir as real_dataset
 import data_generation.utils_simu_rir_sig as simu_dataset 
 import data_generation.utils_LOCATA as locata_dataset
@@ -82,26 +87,72 @@ class RandomRealDataset(Dataset):
       
         assert len(self.dataset_list) == len(dataset_probs), [len(self.dataset_list), len(dataset_probs)]
             
-        dataset_probs_sum = sum(dataset_probs)
-        dataset_probs = [prob/dataset_probs_sum for prob in dataset_probs]
-        self.ds_probs_cumsum = np.cumsum(dataset_probs, dtype=np.float32)
-        self.ds_probs_cumsum[-1] = 1
+        self.dataset_probs = dataset_probs
+        self.ds_sampler = AliasTable(dataset_probs)
  
     def __len__(self):
         return self.dataset_sz
 
-    def __getitem__(self, idx):
-
-        dataset_idx = np.searchsorted(self.ds_probs_cumsum, np.random.uniform())
-        ins_idx = np.random.randint(0, len(self.dataset_list[dataset_idx]))
-        # np.random.seed(seed=self.seed+ins_idx)
-        mic_sig = self.dataset_list[dataset_idx].__getitem__(ins_idx)
+    def item_sampler(self, seed=None, num_replicas=1, rank=0):
+        """ Sampler drawing (dataset index, item index, crop offset ratio) triples in the main process, to be given to DataLoader
+            Args:   num_replicas, rank - number of processes and process rank of distributed training, each process drawing a disjoint share
+        """
+        item_tables = []
+        for dataset in self.dataset_list:
+            if isinstance(dataset, RealMicSigDataset):
+                item_tables += [dataset.data_sampler]
+            else:
+                item_tables += [len(dataset)]
+        return CorpusItemSampler(self.dataset_probs, item_tables, num_samples=self.dataset_sz, seed=seed, num_replicas=num_replicas, rank=rank)
+
+    def batch_sampler(self, batch_size, seed=None, drop_last=False, num_replicas=1, rank=0):
+        """ Batch sampler turning the draws of item_sampler() into crop plans in the main process, to be given to DataLoader
+        """
+        return CropPlanBatchSampler(self.item_sampler(seed, num_replicas=num_replicas, rank=rank), self.crop_plan, batch_size, drop_last=drop_last)
+
+    def crop_plan(self, idx):
+        """ Turn a (dataset index, item index, crop offset ratio) triple of a real-recorded dataset into (dataset index, CropPlan)
+        """
+        if len(idx) == 3:
+            dataset_idx, ins_idx, offset = idx
+            dataset = self.dataset_list[dataset_idx]
+            if isinstance(dataset, RealMicSigDataset):
+                return (dataset_idx, dataset.crop_plan(ins_idx, offset))
+        return idx
+
+    def __getitems__(self, idxes):
+        """ Load a batch, reading the crops of all real-recorded items together (grouped by file)
+            Args:   idxes - list of (dataset index, CropPlan) drawn by batch_sampler(), (dataset index, item index, crop offset ratio)
+                            drawn by item_sampler(), or integers (the dataset and item are then drawn here)
+        """
+        idxes = [self.crop_plan(idx) if isinstance(idx, tuple) else idx for idx in idxes]
+        planned = [n for n, idx in enumerate(idxes) if isinstance(idx, tuple) and isinstance(idx[1], CropPlan)]
+        mic_sigs = [None] * len(idxes)
+        for n, sig in zip(planned, read_crop_plans([idxes[n][1] for n in planned])):
+            dataset_idx, plan = idxes[n]
+            mic_sigs[n] = self.dataset_list[dataset_idx].finish_crop(sig, plan)
+
+        for n, idx in enumerate(idxes):
+            if mic_sigs[n] is not None:
+                continue
+            if isinstance(idx, tuple): # drawn by item_sampler()
+                dataset_idx, ins_idx, _ = idx
+            else:
+                dataset_idx = self.ds_sampler.sample()
+                ins_idx = np.random.randint(0, len(self.dataset_list[dataset_idx]))
+                # np.random.seed(seed=self.seed+ins_idx)
+            mic_sigs[n] = self.dataset_list[dataset_idx].__getitem__(ins_idx)
  
         if self.transforms is not None:
-            for t in self.transforms:
-                mic_sig = t(mic_sig)
+            for n in range(len(mic_sigs)):
+                for t in self.transforms:
+                    mic_sigs[n] = t(mic_sigs[n])
+
+        return mic_sigs
+
+    def __getitem__(self, idx):
 
-        return mic_sig 
+        return self.__getitems__([idx])[0]
 
 
 class FixMicSigDataset(Dataset):
@@ -114,18 +165,21 @@ class FixMicSigDataset(Dataset):
 
         self.data_paths = []
         
-        if isinstance(data_dir, list):
-            files = []
-            dp_files = []
-            for d in data_dir:
-                files += list(Path(d).rglob('*.wav'))
-                dp_files += list(Path(d).rglob('*_dp.wav'))
-            np.random.shuffle(files)
+        if is_shard_dir(data_dir):
+            self.shards = MicSigShards(data_dir)
+            assert (not load_dp) | self.shards.save_dp, 'Direct-path signals are not saved in the shards'
+            self.files = np.arange(len(self.shards))
+            if isinstance(data_dir, list):
+                np.random.shuffle(self.files)
         else:
-            files = list(Path(data_dir).rglob('*.wav'))
-            dp_files = list(Path(data_dir).rglob('*_dp.wav'))
-
-        self.files = [item for item in files if item not in dp_files]
+            self.shards = None
+            catalogs = [catalog_micsig_files(d) for d in (data_dir if isinstance(data_dir, list) else [data_dir])]
+            self.files = np.concatenate([catalog['sig'] for catalog in catalogs])
+            self.dp_files = np.concatenate([catalog['dp'] for catalog in catalogs])
+            self.info_files = np.concatenate([catalog['info'] for catalog in catalogs])
+            if isinstance(data_dir, list):
+                order = np.random.permutation(len(self.files))
+                self.files, self.dp_files, self.info_files = self.files[order], self.dp_files[order], self.info_files[order]
 
         if dataset_sz is not None:
             self.dataset_sz = np.min([len(self.files), dataset_sz])
@@ -141,8 +195,11 @@ class FixMicSigDataset(Dataset):
 
     def __getitem__(self, idx):
 
+        if self.shards is not None:
+            return read_from_shards(self.shards, self.files[idx], self.fs, self.load_anno, self.load_dp, self.transforms)
+
         file_name = str(self.files[idx])
-        mic_sig, fs = soundfile.read(file_name)
+        mic_sig, fs = soundfile.read(resampled_path(file_name, self.fs))
 
         if self.fs != fs:
             mic_sig = scipy.signal.resample_poly(mic_sig, self.fs, fs)
@@ -152,7 +209,8 @@ class FixMicSigDataset(Dataset):
 
         return_data = [mic_sig.astype(np.float32)]
         if self.load_anno:
-            info_file_name = file_name.replace('.wav', '_info.npz')
+            info_file_name = str(self.info_files[idx])
+            assert info_file_name != '', f'No annotation file (_info.npz) for {file_name}'
             info = dict(np.load(info_file_name))
             vol = info['room_sz'][0] * info['room_sz'][1] * info['room_sz'][2]
             sur = info['room_sz'][0] * info['room_sz'][1] + info['room_sz'][0] * info['room_sz'][2] + info['room_sz'][1] * info['room_sz'][2]
@@ -166,8 +224,9 @@ class FixMicSigDataset(Dataset):
             return_data += [annos]
 
         if self.load_dp:
-            dp_file_name = file_name.replace('.wav', '_dp.wav')
-            dp_sig, _ = soundfile.read(dp_file_name)
+            dp_file_name = str(self.dp_files[idx])
+            assert dp_file_name != '', f'No direct-path signal file (_dp.wav) for {file_name}'
+            dp_sig, fs = soundfile.read(resampled_path(dp_file_name, self.fs))
             if self.fs != fs:
                 dp_sig = scipy.signal.resample_poly(dp_sig, self.fs, fs)
             if self.transforms is not None:
@@ -184,13 +243,19 @@ class FixMicSigDatasetLOCATA(Dataset):
 
         self.data_paths = []
         
-        if isinstance(data_dir, list):
-            self.files = []
-            for d in data_dir:
-                self.files += list(Path(d).rglob('*.wav'))
-            np.random.shuffle(self.files)
+        self.shards = None
+        if is_shard_dir(data_dir):
+            self.shards = MicSigShards(data_dir)
+            self.files = np.arange(len(self.shards))
+            if isinstance(data_dir, list):
+                np.random.shuffle(self.files)
         else:
-            self.files = list(Path(data_dir).rglob('*.wav'))
+            catalogs = [catalog_micsig_files(d) for d in (data_dir if isinstance(data_dir, list) else [data_dir])]
+            self.files = np.concatenate([catalog['sig'] for catalog in catalogs])
+            self.info_files = np.concatenate([catalog['info'] for catalog in catalogs])
+            if isinstance(data_dir, list):
+                order = np.random.permutation(len(self.files))
+                self.files, self.info_files = self.files[order], self.info_files[order]
 
         if dataset_sz is not None:
             self.dataset_sz = np.min([len(self.files), dataset_sz])
@@ -205,8 +270,11 @@ class FixMicSigDatasetLOCATA(Dataset):
 
     def __getitem__(self, idx):
 
+        if self.shards is not None:
+            return read_from_shards(self.shards, self.files[idx], self.fs, self.load_anno, False, self.transforms)
+
         file_name = str(self.files[idx])
-        mic_sig, fs = soundfile.read(file_name)
+        mic_sig, fs = soundfile.read(resampled_path(file_name, self.fs))
 
         if self.fs != fs:
             mic_sig = scipy.signal.resample_poly(mic_sig, self.fs, fs)
@@ -216,7 +284,8 @@ class FixMicSigDatasetLOCATA(Dataset):
 
         return_data = [mic_sig.astype(np.float32)]
         if self.load_anno:
-            info_file_name = file_name.replace('.wav', '_info.npz')
+            info_file_name = str(self.info_files[idx])
+            assert info_file_name != '', f'No annotation file (_info.npz) for {file_name}'
             info = dict(np.load(info_file_name))
             annos = {
                 'TDOA': info['TDOA'].astype(np.float32), 
@@ -301,13 +370,15 @@ class RandomMicSigFromRIRDataset(Dataset):
         snr_range, 
         real_sim_ratio,
         transforms=None,
-        seed=1
+        seed=1,
+        speech_pool_dtype='int16'
         ):
         
         srcdataset = WSJ0Dataset(
             path = src_dir,
             T = T,
-            fs = fs
+            fs = fs,
+            pool_dtype = speech_pool_dtype
             )
         noidataset = NoiseSignal(
             T = T,
@@ -323,7 +394,8 @@ class RandomMicSigFromRIRDataset(Dataset):
             dataset_sz=None, 
             load_info=True, 
             load_noise=True, 
-            load_noise_duration=T
+            load_noise_duration=T,
+            rir_bank=True
             ) 
         realdataset = real_dataset.MicSigFromRIRDataset(
             rirnoidataset=realrirdataset,
@@ -341,7 +413,8 @@ class RandomMicSigFromRIRDataset(Dataset):
             rir_dir_list=sim_rir_dir_list,
             dataset_sz=None,
             load_dp=True,
-            load_info=True
+            load_info=True,
+            rir_bank=True
             )
         simdataset = simu_dataset.MicSigFromRIRDataset(
             rirdataset=simrirdataset,
@@ -382,6 +455,33 @@ class RandomMicSigFromRIRDataset(Dataset):
         return mic_sig.astype(np.float32), annos
  
 
+def read_from_shards(shards, idx, fs, load_anno, load_dp, transforms):
+    """ Load one item from packed microphone signal shards, with the same item contract as FixMicSigDataset
+        Returns:    [mic_sig, (annos), (dp_sig)]
+    """
+    mic_sig = shards.read_sig(idx)
+    if fs != shards.fs:
+        mic_sig = scipy.signal.resample_poly(mic_sig, fs, shards.fs)
+    if transforms is not None:
+        for t in transforms:
+            mic_sig = t(mic_sig)
+
+    return_data = [mic_sig.astype(np.float32, copy=False)]
+    if load_anno:
+        return_data += [shards.read_anno(idx)]
+
+    if load_dp:
+        dp_sig = shards.read_sig(idx, dp=True)
+        if fs != shards.fs:
+            dp_sig = scipy.signal.resample_poly(dp_sig, fs, shards.fs)
+        if transforms is not None:
+            for t in transforms:
+                dp_sig = t(dp_sig)
+        return_data += [dp_sig.astype(np.float32, copy=False)]
+
+    return return_data
+
+
 ## Transform classes
 class Selecting(object):
     def __init__(self, select_range):
@@ -3,13 +3,84 @@ import copy
 import numpy as np
 import torch
 import torch.optim as optim
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
 import torchaudio as audio
 from abc import ABC, abstractmethod
 from tqdm import tqdm, trange
-from common.utils import detect_infnan
+from common.utils import detect_infnan, get_rng_state, set_rng_state
 import common.utils_module as at_module
 from torchmetrics.functional.audio.pesq import perceptual_evaluation_speech_quality
-		
+def unwrap_state_dict(state_dict):
+	""" Remove the prefixes of parameter names added by DataParallel/DistributedDataParallel ('module.') and torch.compile ('_orig_mod.'),
+		so that checkpoints load regardless of how the model was wrapped when they were saved
+	"""
+	unwrapped = {}
+	for key, value in state_dict.items():
+		for prefix in ['module.', '_orig_mod.']:
+			if key.startswith(prefix):
+				key = key[len(prefix):]
+		unwrapped[key] = value
+	return unwrapped
+
+class MetricAccumulator():
+	""" Running sums of batch metrics weighted by the batch sizes, and an exponential moving average (EMA) of the loss for
+		the progress bar, kept on the device, so that a training or test step does not wait for the device to copy a value
+		to the host. Values are copied when the progress bar is refreshed (every nstep_flush steps) and at the end of an epoch,
+		where the sums of all processes are reduced in distributed training.
+		Args:	ema_beta - smoothing factor of the EMA
+				nstep_flush - number of steps between refreshes of the progress bar
+	"""
+	def __init__(self, ema_beta=0.99, nstep_flush=50):
+		self.ema_beta = ema_beta
+		self.nstep_flush = nstep_flush
+		self.sums = {}
+		self.nsample = 0
+		self.nstep = 0
+		self.ema = 0
+
+	def update(self, nsample, **batch_means):
+		""" Args:	nsample - number of samples of the batch
+					batch_means - mean values of metrics over the samples of the batch, e.g. loss=loss_batch, scalar tensors
+		"""
+		for key, value in batch_means.items():
+			value = value.detach().float()
+			self.sums[key] = self.sums[key] + value * nsample if key in self.sums else value * nsample
+		if 'loss' in batch_means:
+			self.ema = self.ema_beta * self.ema + (1 - self.ema_beta) * batch_means['loss'].detach().float()
+		self.nsample += nsample
+		self.nstep += 1
+
+	def flush_due(self):
+		return (self.nstep % self.nstep_flush == 0)
+
+	def ema_loss(self):
+		""" Returns:	bias-corrected EMA of the loss, copied to the host
+		"""
+		return float(self.ema) / (1 - self.ema_beta ** self.nstep)
+
+	def means(self):
+		""" Returns:	{key: mean value over all samples}, copied to the host
+		"""
+		keys = list(self.sums.keys())
+		if len(keys) == 0:
+			return {}
+		values = torch.stack([self.sums[key] for key in keys] + [torch.tensor(float(self.nsample), device=self.sums[keys[0]].device)])
+		if dist.is_available() and dist.is_initialized():
+			dist.all_reduce(values)
+		values = (values[:-1] / values[-1].clamp(min=1)).tolist() # one copy for all metrics
+		return dict(zip(keys, values))
+
+	def state_dict(self):
+		return {'sums': self.sums, 'nsample': self.nsample, 'nstep': self.nstep, 'ema': self.ema}
+
+	def load_state_dict(self, state_dict):
+		self.sums = state_dict['sums']
+		self.nsample = state_dict['nsample']
+		self.nstep = state_dict['nstep']
+		self.ema = state_dict['ema']
+
+
 class Learner(ABC):
 	""" Abstract class to the routines to train the one model and perform inferences
 	"""
@@ -19,7 +90,15 @@ class Learner(ABC):
 		self.early_stop_counter = 0
 		self.use_amp = False
 		self.start_epoch = 1
+		self.rank = 0 # process rank in distributed training, only rank 0 writes checkpoints and shows progress bars
+		self.start_batch = 0 # batches of start_epoch trained before a mid-epoch checkpoint
+		self.resume_state = None # random states and running statistics of a mid-epoch checkpoint
+		self.hist = None # training history kept by the caller (e.g. validation losses of past epochs), saved with checkpoints
 		#self.device = device
+		# The optimizer lives as long as the learner, so that its moment estimates are kept across epochs and checkpoints
+		self.optimizer = optim.Adam(self.model.parameters(), lr=0.0001, betas=(0.9, 0.999), weight_decay=0) # 5e-7
+		# optimizer = optim.SGD(self.model.parameters(), lr=lr, momentum=0.9)
+		self.scheduler = None
 		super().__init__()
 
 	def mul_gpu(self):
@@ -28,7 +107,29 @@ class Learner(ABC):
 		self.model = torch.nn.DataParallel(self.model) 
 		# loss.mean() is only suitable for the case when batch size is divisible by the number of gpus, and when model output a value (e.g., loss).
 		# When multiple gpus are used, 'module.' is added to the name of model parameters. 
-		# So whether using one gpu or multiple gpus should be consistent for model pretraning and checkpoints loading.
+		# Checkpoints are saved and loaded without the prefix (see unwrap_state_dict), so they are exchangeable between one and multiple gpus.
+
+	def ddp(self, device_ids=None, find_unused_parameters=True):
+		""" Use DistributedDataParallel in the process group initialized by common.utils.init_distributed (nccl on GPUs, gloo on CPUs),
+			one process per GPU or CPU worker. Call it after moving the model to the device.
+			Args:	device_ids - [local rank] on GPUs, None on CPUs
+					find_unused_parameters - whether some parameters may get no gradient in a step (e.g. encoders skipped by the downstream embedding)
+		"""
+		self.rank = dist.get_rank()
+		self.model = DistributedDataParallel(self.model, device_ids=device_ids, find_unused_parameters=find_unused_parameters)
+
+	def unwrapped_model(self):
+		""" The model without the DataParallel/DistributedDataParallel wrapper
+		"""
+		if isinstance(self.model, (torch.nn.DataParallel, DistributedDataParallel)):
+			return self.model.module
+		return self.model
+
+	def barrier(self):
+		""" Wait for all processes, e.g. until rank 0 has written a checkpoint that the others will read
+		"""
+		if dist.is_available() and dist.is_initialized():
+			dist.barrier()
 
 	def cuda(self):
 		""" Move the model to the GPU and perform the training and inference there
@@ -49,6 +150,68 @@ class Learner(ABC):
 		self.use_amp = True
 		self.scaler = torch.cuda.amp.GradScaler(enabled=self.use_amp)
 
+	def set_lr_schedule(self, lr_schedule, lr):
+		""" Update the learning rate after every optimizer step by a schedule (e.g. create_learning_rate_schedule),
+			instead of setting it at each epoch by the lr argument of the epoch functions
+			Args:	lr_schedule - function learning_rate(step), step counted in optimizer steps from 0
+					lr - base learning rate of lr_schedule
+		"""
+		for param_group in self.optimizer.param_groups:
+			param_group['lr'] = lr
+		self.scheduler = optim.lr_scheduler.LambdaLR(self.optimizer, lr_lambda=lambda step: float(lr_schedule(step)) / lr)
+
+	def get_lr(self):
+		return self.optimizer.param_groups[0]['lr']
+
+	def set_lr(self, lr):
+		""" Set the learning rate of an epoch, unless it is scheduled by steps
+		"""
+		if self.scheduler is None:
+			for param_group in self.optimizer.param_groups:
+				param_group['lr'] = lr
+
+	def optimizer_step(self, loss_batch):
+		""" Back-propagate the loss of a batch and update the model parameters (and the learning rate)
+		"""
+		if self.use_amp:
+			self.scaler.scale(loss_batch).backward()
+			self.scaler.step(self.optimizer)
+			self.scaler.update()
+		else:
+			loss_batch.backward()
+			self.optimizer.step()
+
+		self.optimizer.zero_grad()
+		if self.scheduler is not None:
+			self.scheduler.step()
+
+	def resume_batches(self, dataset, epoch):
+		""" Enumerate the batches of an epoch, which start after the batches trained before a mid-epoch checkpoint when resuming
+			its epoch. The data order is kept since the batch sampler is still iterated from the beginning, and the random states
+			of the checkpoint are restored before the first remaining batch. Skipped batches are not loaded when the DataLoader
+			uses a ResumableBatchSampler, otherwise they are loaded and dropped. Random states of DataLoader workers are not restored.
+			Returns:	batches - iterator of (batch_idx, data)
+						stats - running statistics of the epoch saved by the checkpoint, {} when not resuming
+		"""
+		if (epoch != self.start_epoch) | (self.start_batch == 0):
+			return enumerate(dataset), {}
+
+		start_batch, resume_state = self.start_batch, self.resume_state
+		self.start_batch, self.resume_state = 0, None
+		restore = lambda: set_rng_state(resume_state['rng'], model=self.model)
+		if hasattr(dataset.batch_sampler, 'skip_next'):
+			dataset.batch_sampler.skip_next(start_batch, on_start=restore)
+			batches = enumerate(dataset, start_batch)
+		else:
+			iterator = iter(dataset)
+			for _ in range(start_batch):
+				next(iterator)
+			restore()
+			batches = enumerate(iterator, start_batch)
+		print(f"Resume epoch {epoch} from batch {start_batch}")
+
+		return batches, resume_state['stats']
+
 	@abstractmethod
 	def data_preprocess(self, mic_sig_batch=None, gt_batch=None):
 		""" Preprocess microphone signals before trianing
@@ -73,57 +236,55 @@ class Learner(ABC):
 		"""
 		pass
 
-	def pretrain_epoch(self, dataset, lr=0.0001, epoch=None, return_diff=True):
+	def pretrain_epoch(self, dataset, lr=0.0001, epoch=None, return_diff=True, checkpoints_dir=None, checkpoint_every=0):
 		""" Train the model with an epoch of the dataset.
+			Args:	lr - learning rate of the epoch, unused when the learning rate is scheduled by steps (set_lr_schedule)
+					checkpoints_dir, checkpoint_every - save a mid-epoch checkpoint every checkpoint_every batches (0: none)
 		"""
-		avg_loss = 0
-		avg_beta = 0.99
-
 		self.model.train()  
-		optimizer = optim.Adam(self.model.parameters(), lr=lr, betas=(0.9, 0.999), weight_decay=0) # 5e-7
+		self.set_lr(lr)
 		
 		# for param_group in optimizer.param_groups:
 		# 	print(param_group['lr'])
 
-		loss = 0
-		if return_diff:
-			diff = 0
+		self.optimizer.zero_grad()
+		batches, stats = self.resume_batches(dataset, epoch)
+		metrics = MetricAccumulator()
+		if stats:
+			metrics.load_state_dict(stats)
 
-		optimizer.zero_grad()
-		pbar = tqdm(enumerate(dataset), total=len(dataset), leave=False) 
+		pbar = tqdm(batches, total=len(dataset), leave=False, disable=(self.rank != 0)) 
 
-		for batch_idx, (mic_sig_batch,) in pbar:
+		for batch_idx, data in pbar:
 			if epoch is not None: pbar.set_description('Epoch {}'.format(epoch))
 
+			mic_sig_batch = data[0]
+			mask_batch = data[-1] if isinstance(data[-1], at_module.PatchMasks) else None # masks generated by DataLoader workers
 			in_batch, = self.data_preprocess(mic_sig_batch, None)
 
 			with torch.cuda.amp.autocast(enabled=self.use_amp):
-				loss_batch, diff_batch, vis_batch = self.model(in_batch)
+				loss_batch, diff_batch, vis_batch = self.model(in_batch, mask=mask_batch, return_diff=return_diff, return_vis=(batch_idx==len(dataset)-1)) # only visualize the last batch
 			loss_batch = loss_batch.mean() # for multiple gpus
 			diff_batch = diff_batch.mean()
 
-			if self.use_amp:
-				self.scaler.scale(loss_batch).backward()
-				self.scaler.step(optimizer)
-				self.scaler.update()
-			else:
-				loss_batch.backward()
-				optimizer.step()
-
-			optimizer.zero_grad()
+			self.optimizer_step(loss_batch)
 
-			avg_loss = avg_beta * avg_loss + (1 - avg_beta) * loss_batch.item()
-			pbar.set_postfix(loss=avg_loss / (1 - avg_beta ** (batch_idx + 1)))
+			if return_diff: 
+				metrics.update(mic_sig_batch.shape[0], loss=loss_batch, diff=diff_batch)
+			else:
+				metrics.update(mic_sig_batch.shape[0], loss=loss_batch)
+			if metrics.flush_due():
+				pbar.set_postfix(loss=metrics.ema_loss())
 			# pbar.set_postfix(loss=loss.item())
 			pbar.update()
 
-			loss += loss_batch.item()
-			if return_diff: 
-				diff += diff_batch.item()
+			if (checkpoint_every > 0) and ((batch_idx + 1) % checkpoint_every == 0) and (batch_idx + 1 < len(dataset)):
+				self.save_checkpoint(epoch=epoch-1, checkpoints_dir=checkpoints_dir, batch=batch_idx+1, stats=metrics.state_dict())
 
-		loss /= len(pbar)
+		means = metrics.means()
+		loss = means['loss']
 		if return_diff: 
-			diff /= len(pbar)
+			diff = means['diff']
 
 		if return_diff: 
 			return loss, diff, vis_batch
@@ -135,27 +296,28 @@ class Learner(ABC):
 		"""
 		self.model.eval()  
 		with torch.no_grad():
-			loss = 0
-			if return_diff: 
-				diff = 0
+			metrics = MetricAccumulator()
 
-			for data in dataset:
+			for batch_idx, data in enumerate(dataset):
 				mic_sig_batch = data[0]
+				mask_batch = data[-1] if isinstance(data[-1], at_module.PatchMasks) else None # masks generated by DataLoader workers
 				in_batch, = self.data_preprocess(mic_sig_batch, None)
 
 				with torch.cuda.amp.autocast(enabled=self.use_amp):
-					loss_batch, diff_batch, vis_batch = self.model(in_batch) 
+					loss_batch, diff_batch, vis_batch = self.model(in_batch, mask=mask_batch, return_diff=return_diff, return_vis=(batch_idx==len(dataset)-1)) 
 
 				loss_batch = loss_batch.mean() 
 				diff_batch = diff_batch.mean()
 
-				loss += loss_batch.item()
 				if return_diff: 
-					diff += diff_batch.item()
+					metrics.update(mic_sig_batch.shape[0], loss=loss_batch, diff=diff_batch)
+				else:
+					metrics.update(mic_sig_batch.shape[0], loss=loss_batch)
 
-			loss /= len(dataset)
+			means = metrics.means()
+			loss = means['loss']
 			if return_diff: 
-				diff /= len(dataset)
+				diff = means['diff']
 
 			if return_diff: 
 				if return_eval:
@@ -167,23 +329,22 @@ class Learner(ABC):
 				return loss
 
 
-	def train_epoch(self, dataset, lr=0.0001, epoch=None, return_metric=False):
+	def train_epoch(self, dataset, lr=0.0001, epoch=None, return_metric=False, checkpoints_dir=None, checkpoint_every=0):
 		""" Train the model with an epoch of the dataset
+			Args:	lr - learning rate of the epoch, unused when the learning rate is scheduled by steps (set_lr_schedule)
+					checkpoints_dir, checkpoint_every - save a mid-epoch checkpoint every checkpoint_every batches (0: none)
 		"""
 
-		avg_loss = 0
-		avg_beta = 0.99
-
 		self.model.train()  
-		optimizer = optim.Adam(self.model.parameters(), lr=lr, betas=(0.9, 0.999), weight_decay=0)
-		# optimizer = optim.SGD(self.model.parameters(), lr=lr, momentum=0.9)
+		self.set_lr(lr)
 
-		loss = 0
-		if return_metric: 
-			metric = 0
+		self.optimizer.zero_grad()
+		batches, stats = self.resume_batches(dataset, epoch)
+		metrics = MetricAccumulator()
+		if stats:
+			metrics.load_state_dict(stats)
 
-		optimizer.zero_grad()
-		pbar = tqdm(enumerate(dataset), total=len(dataset), leave=False) 
+		pbar = tqdm(batches, total=len(dataset), leave=False, disable=(self.rank != 0)) 
 		for batch_idx, (mic_sig_batch, gt_batch) in pbar:
 			if epoch is not None: pbar.set_description('Epoch {}'.format(epoch))
 
@@ -193,30 +354,25 @@ class Learner(ABC):
 				pred_batch, embed_batch = self.model(in_batch)
 				loss_batch = self.loss(pred_batch = pred_batch, gt_batch = gt_batch)
 
-			if self.use_amp:
-				self.scaler.scale(loss_batch).backward()
-				self.scaler.step(optimizer)
-				self.scaler.update()
-			else:
-				loss_batch.backward()
-				optimizer.step()
-
-			optimizer.zero_grad()
+			self.optimizer_step(loss_batch)
 
-			avg_loss = avg_beta * avg_loss + (1 - avg_beta) * loss_batch.item()
-			pbar.set_postfix(loss=avg_loss / (1 - avg_beta ** (batch_idx + 1)))
+			if return_metric: 
+				metric_batch = self.evaluate(pred_batch=pred_batch, gt_batch=gt_batch)
+				metrics.update(gt_batch.shape[0], loss=loss_batch, metric=metric_batch)
+			else:
+				metrics.update(gt_batch.shape[0], loss=loss_batch)
+			if metrics.flush_due():
+				pbar.set_postfix(loss=metrics.ema_loss())
 			# pbar.set_postfix(loss=loss.item())
 			pbar.update()
 
-			loss += loss_batch.item()
+			if (checkpoint_every > 0) and ((batch_idx + 1) % checkpoint_every == 0) and (batch_idx + 1 < len(dataset)):
+				self.save_checkpoint(epoch=epoch-1, checkpoints_dir=checkpoints_dir, batch=batch_idx+1, stats=metrics.state_dict())
 
-			if return_metric: 
-				metric_batch = self.evaluate(pred_batch=pred_batch, gt_batch=gt_batch)
-				metric += metric_batch 
-
-		loss /= len(pbar)
+		means = metrics.means()
+		loss = means['loss']
 		if return_metric: 
-			metric /= len(pbar)
+			metric = means['metric']
 
 		if return_metric: 
 			return loss, metric
@@ -228,9 +384,7 @@ class Learner(ABC):
 		"""
 		self.model.eval()  
 		with torch.no_grad():
-			loss = 0
-			if return_metric: 
-				metric = 0
+			metrics = MetricAccumulator()
 			if return_vis:
 				embed = []
 				gt = []
@@ -241,18 +395,19 @@ class Learner(ABC):
 					pred_batch, embed_batch = self.model(in_batch)
 					loss_batch = self.loss(pred_batch=pred_batch, gt_batch=gt_batch)
 
-				loss += loss_batch.item()
-
 				if return_metric: 
 					metric_batch = self.evaluate(pred_batch=pred_batch, gt_batch=gt_batch)
-					metric += metric_batch  
+					metrics.update(gt_batch.shape[0], loss=loss_batch, metric=metric_batch)
+				else:
+					metrics.update(gt_batch.shape[0], loss=loss_batch)
 				if return_vis:
 					embed += [embed_batch]
 					gt += [gt_batch]
 
-			loss /= len(dataset)
+			means = metrics.means()
+			loss = means['loss']
 			if return_metric: 
-				metric /= len(dataset)
+				metric = means['metric']
 
 			if return_vis:
 				vis_data = {'embed': torch.cat(embed, dim=0), 'label': torch.cat(gt, dim=0)}
@@ -320,15 +475,17 @@ class Learner(ABC):
 				else:
 					state_dicts[key] += state_dict_one_epoch[key] * 1/nepoch_ave
 
-		self.model.load_state_dict(state_dicts)
+		self.unwrapped_model().load_state_dict(unwrap_state_dict(state_dicts))
 
-		print(f"\t Saving ensembling model checkpoint...")
+		if self.rank == 0:
+			print(f"\t Saving ensembling model checkpoint...")
 
-		state_dict = {
-				"epoch": epochs,
-				"model": self.model.state_dict()
-			}
-		torch.save(state_dict, checkpoints_dir + "/ensemble_model.tar")
+			state_dict = {
+					"epoch": epochs,
+					"model": self.unwrapped_model().state_dict()
+				}
+			torch.save(state_dict, checkpoints_dir + "/ensemble_model.tar")
+		self.barrier()
 
 	def is_best_epoch(self, current_score):
 		""" Check if the current model got the best metric score
@@ -341,37 +498,51 @@ class Learner(ABC):
 
 		return is_best_epoch
 
-	def save_checkpoint(self, epoch, checkpoints_dir, is_best_epoch = False, save_extra_hist=False):
+	def save_checkpoint(self, epoch, checkpoints_dir, is_best_epoch = False, save_extra_hist=False, batch=0, stats=None):
 		""" Save checkpoint to "checkpoints_dir" directory, which consists of:
             - the epoch number
             - the best metric score in history
-            - the optimizer parameters
+            - the optimizer (and learning rate scheduler) parameters
             - the model parameters
+            - the training history of the caller (self.hist), if any
+            - for a mid-epoch checkpoint (only saved as the latest checkpoint), the number of trained batches of the next epoch,
+              the running statistics of the epoch (MetricAccumulator) and the random states
+            Only rank 0 writes in distributed training, and the random states are those of rank 0
         """
 
-		print(f"\t Saving {epoch} epoch model checkpoint...")
+		if self.rank != 0:
+			self.barrier()
+			return
+		if batch == 0:
+			print(f"\t Saving {epoch} epoch model checkpoint...")
+		state_dict = {
+			"epoch": epoch,
+			"max_score": self.max_score,
+			"early_stop_counter": self.early_stop_counter,
+			"optimizer": self.optimizer.state_dict(),
+			"model": self.unwrapped_model().state_dict()
+		}
 		if self.use_amp:
-			state_dict = {
-				"epoch": epoch,
-				"max_score": self.max_score,
-				# "optimizer": self.optimizer.state_dict(),
-				"scaler": self.scaler.state_dict(), 
-				"model": self.model.state_dict()
-			}
-		else:
-			state_dict = {
-				"epoch": epoch,
-				"max_score": self.max_score,
-				# "optimizer": self.optimizer.state_dict(),
-				"model": self.model.state_dict()
-			}
-		torch.save(state_dict, checkpoints_dir + "/latest_model.tar")
-		if save_extra_hist:
-			torch.save(state_dict, checkpoints_dir + "/model"+str(epoch)+".tar")
-
-		if is_best_epoch:
-			print(f"\t Found a max score in the {epoch} epoch, saving...")
-			torch.save(state_dict, checkpoints_dir + "/best_model.tar")
+			state_dict["scaler"] = self.scaler.state_dict()
+		if self.scheduler is not None:
+			state_dict["scheduler"] = self.scheduler.state_dict()
+		if self.hist is not None:
+			state_dict["hist"] = self.hist
+		if batch > 0:
+			state_dict["batch"] = batch
+			state_dict["stats"] = stats
+			state_dict["rng"] = get_rng_state(model=self.model)
+		# Write atomically, so that a job preempted while saving still resumes from the previous checkpoint
+		torch.save(state_dict, checkpoints_dir + "/latest_model.tar.tmp")
+		os.replace(checkpoints_dir + "/latest_model.tar.tmp", checkpoints_dir + "/latest_model.tar")
+		if batch == 0:
+			if save_extra_hist:
+				torch.save(state_dict, checkpoints_dir + "/model"+str(epoch)+".tar")
+
+			if is_best_epoch:
+				print(f"\t Found a max score in the {epoch} epoch, saving...")
+				torch.save(state_dict, checkpoints_dir + "/best_model.tar")
+		self.barrier()
 
 
 	def resume_checkpoint(self, checkpoints_dir, from_latest = True, as_all_state = True, ex_key=''):
@@ -388,14 +559,23 @@ class Learner(ABC):
 		checkpoint = torch.load(model_path, map_location=self.device)
 		self.start_epoch = checkpoint["epoch"] + 1
 		self.max_score = checkpoint["max_score"]
-		# self.optimizer.load_state_dict(checkpoint["optimizer"])
-		if self.use_amp:
+		self.early_stop_counter = checkpoint.get("early_stop_counter", self.early_stop_counter)
+		self.hist = checkpoint.get("hist", None)
+		if self.use_amp and ("scaler" in checkpoint):
 			self.scaler.load_state_dict(checkpoint["scaler"])
 		if as_all_state:
-			self.model.load_state_dict(checkpoint["model"])
+			self.unwrapped_model().load_state_dict(unwrap_state_dict(checkpoint["model"]))
+			# checkpoints saved before the optimizer was kept across epochs have no optimizer state
+			if "optimizer" in checkpoint:
+				self.optimizer.load_state_dict(checkpoint["optimizer"])
+			if (self.scheduler is not None) and ("scheduler" in checkpoint):
+				self.scheduler.load_state_dict(checkpoint["scheduler"])
+			if checkpoint.get("batch", 0) > 0:
+				self.start_batch = checkpoint["batch"]
+				self.resume_state = {'rng': checkpoint["rng"], 'stats': checkpoint["stats"]}
 		else:
-			partial_state_dict = checkpoint["model"]
-			all_state_dict = self.model.state_dict()
+			partial_state_dict = unwrap_state_dict(checkpoint["model"])
+			all_state_dict = self.unwrapped_model().state_dict()
 			match_key_cnt = 0
 			for key in partial_state_dict:
 				if ex_key+key in all_state_dict:
@@ -403,9 +583,12 @@ class Learner(ABC):
 					match_key_cnt += 1
 			print('# matched keys: ', match_key_cnt) 
 			assert match_key_cnt>1, 'loaded model parameters and original parameters unmatched~'
-			self.model.load_state_dict(all_state_dict)
+			self.unwrapped_model().load_state_dict(all_state_dict)
 
-		print(f"Model checkpoint loaded. Training will begin at {self.start_epoch} epoch.")
+		if self.start_batch > 0:
+			print(f"Model checkpoint loaded. Training will begin at {self.start_epoch} epoch, batch {self.start_batch}.")
+		else:
+			print(f"Model checkpoint loaded. Training will begin at {self.start_epoch} epoch.")
 
 		# if ~from_latest:
 		# 	return checkpoint["epoch"]
@@ -425,10 +608,10 @@ class Learner(ABC):
 		# self.optimizer.load_state_dict(checkpoint["optimizer"])
 		# self.scaler.load_state_dict(checkpoint["scaler"])
 		if as_all_state:
-			self.model.load_state_dict(checkpoint["model"])
+			self.unwrapped_model().load_state_dict(unwrap_state_dict(checkpoint["model"]))
 		else:
-			partial_state_dict = checkpoint["model"]
-			all_state_dict = self.model.state_dict()
+			partial_state_dict = unwrap_state_dict(checkpoint["model"])
+			all_state_dict = self.unwrapped_model().state_dict()
 			match_key_cnt = 0
 			for key in partial_state_dict:
 				if ex_key+key in all_state_dict:
@@ -436,11 +619,11 @@ class Learner(ABC):
 					match_key_cnt += 1
 			print('# matched keys: ', match_key_cnt) 
 			assert match_key_cnt>1, 'loaded model parameters and original parameters unmatched~'
-			self.model.load_state_dict(all_state_dict)
+			self.unwrapped_model().load_state_dict(all_state_dict)
 
 		if param_frozen:
-			for key, value in self.model.named_parameters():
-				key.replace(ex_key, '')
+			for key, value in self.unwrapped_model().named_parameters():
+				key = key.replace(ex_key, '')
 				if key in partial_state_dict: # all frozen
 					value.requires_grad = False
 
@@ -460,7 +643,7 @@ class Learner(ABC):
 		checkpoint = torch.load(model_path, map_location=self.device)
 		epoch0 = checkpoint["epoch"]
 		assert epoch==epoch0, 'loaded epoch wrong~'
-		self.model.load_state_dict(checkpoint["model"])
+		self.unwrapped_model().load_state_dict(unwrap_state_dict(checkpoint["model"]))
 	
 		print(f"Model of {epoch} epoch loaded.")
 
@@ -474,16 +657,18 @@ class Learner(ABC):
 
 		checkpoint = torch.load(model_path, map_location=self.device)
 		epoch = checkpoint["epoch"]
-		self.model.load_state_dict(checkpoint["model"])
+		self.unwrapped_model().load_state_dict(unwrap_state_dict(checkpoint["model"]))
 	
 		print(f"Model of {epoch} epoch loaded.")
 
 	def remove_checkpoint_epochs(self, checkpoints_dir, epochs):
 		"""Remove the checkpoints of specific epochs.
 		"""
-		for epoch in epochs:
-			model_path = checkpoints_dir + "/model"+str(epoch)+".tar"
-			os.remove(model_path)
+		if self.rank == 0:
+			for epoch in epochs:
+				model_path = checkpoints_dir + "/model"+str(epoch)+".tar"
+				os.remove(model_path)
+		self.barrier()
 
 class STFTLearner(Learner):
 	""" Learner for models which use STFTs of multi-channel microphone singals as input
@@ -503,6 +688,7 @@ class STFTLearner(Learner):
 			nfft=nfft,
 			inv=False
 			)
+		self.fs = fs
 		self.mel_scale = mel_scale
 		if mel_scale:
 			self.mel_transform = audio.transforms.MelScale(
@@ -532,23 +718,7 @@ class STFTLearner(Learner):
 		if mic_sig_batch is not None:
 			mic_sig_batch = mic_sig_batch.to(self.device)
 			stft = self.stft(signal = mic_sig_batch) 	# (nb,nf,nt,nch)
-			stft = stft.permute(0, 3, 1, 2)  # (nb,nch,nf,nt)
-
-			nor_flag = True
-			if nor_flag:
-				mag = torch.abs(stft[:, 0:1, :, :])
-				mean_value = torch.mean(mag.reshape(mag.shape[0],-1), dim=1)
-				mean_value = mean_value[:, np.newaxis, np.newaxis, np.newaxis].expand(mag.shape)
-				stft = stft/(mean_value+eps) # (nb,nch,nf,nt) 
-
-			# Change batch for multi-channel data (nb,nch,nf,nt)→(nb*(nch-1),2,nf,nt)/(nb*(nch-1)*nch/2,2,nf,nt)
-			stft_rebatch = self.addbatch(stft)
-			reim_rebatch = torch.view_as_real(stft_rebatch) # (nb*(nch-1),nch_pair,nf,nt,2)= (nb,nch,nf,nt,2) when nch=2
-
-			if self.mel_scale:
-				reim_rebatch = self.mel_transform(reim_rebatch.permute(0,1,4,2,3).to('cpu')).permute(0,1,3,4,2).contiguous().to(stft_rebatch.device) # (nb,nch,nmel,nt,2)
-			else:
-				reim_rebatch = reim_rebatch[:, :, self.fre_range_used, :, :]
+			reim_rebatch = self.stft_preprocess(stft, eps=eps)
 
 			data += [reim_rebatch]
 
@@ -570,6 +740,113 @@ class STFTLearner(Learner):
 			# 		data += [gt_batch.to(self.device)]
 
 		return data # [Input, TDOA/T60/DRR/DOA/C50/C80]
+
+	def stft_preprocess(self, stft, eps=1e-6):
+		""" Normalize and rebatch the STFT coefficients of microphone signals into the model input
+			Args: 		stft - (nb,nf,nt,nch)
+			Returns: 	reim_rebatch - (nb*(nch-1),2,nf,nt,2)
+		"""
+		stft = stft.permute(0, 3, 1, 2)  # (nb,nch,nf,nt)
+
+		nor_flag = True
+		if nor_flag:
+			mag = torch.abs(stft[:, 0:1, :, :])
+			mean_value = torch.mean(mag.reshape(mag.shape[0],-1), dim=1)
+			mean_value = mean_value[:, np.newaxis, np.newaxis, np.newaxis].expand(mag.shape)
+			stft = stft/(mean_value+eps) # (nb,nch,nf,nt) 
+
+		# Change batch for multi-channel data (nb,nch,nf,nt)→(nb*(nch-1),2,nf,nt)/(nb*(nch-1)*nch/2,2,nf,nt)
+		stft_rebatch = self.addbatch(stft)
+		reim_rebatch = torch.view_as_real(stft_rebatch) # (nb*(nch-1),nch_pair,nf,nt,2)= (nb,nch,nf,nt,2) when nch=2
+
+		if self.mel_scale:
+			reim_rebatch = self.mel_transform(reim_rebatch.permute(0,1,4,2,3).to('cpu')).permute(0,1,3,4,2).contiguous().to(stft_rebatch.device) # (nb,nch,nmel,nt,2)
+		else:
+			reim_rebatch = reim_rebatch[:, :, self.fre_range_used, :, :]
+
+		return reim_rebatch
+
+	def stream_predict(self, sig_path, nt, nt_hop=None, chs=None, models=None, nwin_batch=8, block_duration=10):
+		""" Estimate acoustic parameters along an arbitrarily long recording, which is read block by block from disk and
+			streamed through the STFT, then cut into sliding windows of nt frames (the input length of the model), where
+			the frames shared by overlapping windows are computed once. The window-level estimates are stitched into a
+			frame-level series by averaging the windows covering each frame.
+			Args: 		sig_path - path of the multi-channel recording (resampled copy used if cached, see utils_resample)
+						nt - number of frames of a window
+						nt_hop - number of frames between adjacent windows (default: nt, i.e., no overlap)
+						chs - channels used, the first one as the reference channel (default: all channels)
+						models - {task: downstream model} sharing the preprocessing of the learner (default: {self.task: self.model})
+						nwin_batch - number of windows in a batch of the models
+						block_duration - duration (s) of the blocks read from disk
+			Returns: 	result - {'win_time': (nwin, 2) start and end time (s) of windows,
+								  'frame_time': (nframe, ) centre time (s) of frames,
+								  task: {'win': (nwin, npred), 'frame': (nframe, npred)}}, predictions in the units of get_tar_batch
+		"""
+		import soundfile
+		from data_generation.utils_resample import resampled_path
+
+		nt_hop = nt if nt_hop is None else nt_hop
+		models = {self.task: self.unwrapped_model()} if models is None else models
+		sig_path = resampled_path(sig_path, self.fs)
+		info = soundfile.info(str(sig_path))
+		assert info.samplerate == self.fs, f'Sampling rate of {sig_path} ({info.samplerate} Hz) does not match {self.fs} Hz, resample it first'
+		win_len = self.stft.win_len
+		win_shift = int(self.stft.win_len * self.stft.win_shift_ratio)
+		nframe = max((info.frames - win_len) // win_shift + 1, 0)
+		assert nframe >= nt, f'{sig_path} is shorter than a window of {nt} frames'
+
+		stream = at_module.STFTStream(self.stft, nt=nt, nt_hop=nt_hop)
+		preds = {task: [] for task in models.keys()}
+		frame_preds = {task: None for task in models.keys()}
+		frame_counts = np.zeros((nframe, 1))
+		win_sts = []
+
+		def predict(windows, sts):
+			in_batch = self.stft_preprocess(windows) # (nwin*npair,2,nf,nt,2)
+			for task, model in models.items():
+				with torch.cuda.amp.autocast(enabled=self.use_amp):
+					pred_batch, _ = model(in_batch)
+				pred_batch = pred_batch.float().reshape(windows.shape[0], -1).cpu().numpy() # (nwin, npred)
+				preds[task] += [pred_batch]
+				if frame_preds[task] is None:
+					frame_preds[task] = np.zeros((nframe, pred_batch.shape[-1]))
+				for st, pred in zip(sts, pred_batch):
+					frame_preds[task][st:st+nt] += pred
+			for st in sts:
+				frame_counts[st:st+nt] += 1
+			win_sts.extend(sts)
+
+		for model in models.values():
+			model.eval()
+		with torch.no_grad():
+			pending, pending_sts = [], []
+			blocks = soundfile.blocks(str(sig_path), blocksize=int(block_duration*self.fs), dtype='float32', always_2d=True)
+			for sig_block in blocks:
+				sig_block = torch.from_numpy(sig_block if chs is None else sig_block[:, chs]).to(self.device)
+				windows, sts = stream.push(sig_block)
+				if windows is not None:
+					pending += [windows]
+					pending_sts += list(sts)
+				while len(pending_sts) >= nwin_batch:
+					windows = torch.cat(pending, dim=0)
+					predict(windows[:nwin_batch], pending_sts[:nwin_batch])
+					pending, pending_sts = [windows[nwin_batch:]], pending_sts[nwin_batch:]
+			windows, sts = stream.flush()
+			if windows is not None:
+				pending += [windows]
+				pending_sts += list(sts)
+			if len(pending_sts) > 0:
+				predict(torch.cat(pending, dim=0), pending_sts)
+
+		win_sts = np.array(win_sts)
+		result = {
+			'win_time': np.stack((win_sts*win_shift, win_sts*win_shift+(nt-1)*win_shift+win_len), axis=-1) / self.fs,
+			'frame_time': (np.arange(nframe)*win_shift + win_len/2) / self.fs,
+			}
+		for task in models.keys():
+			result[task] = {'win': np.concatenate(preds[task], axis=0), 'frame': frame_preds[task] / np.maximum(frame_counts, 1)}
+
+		return result
 	
 	def pretrain_evaluate(self, pred_batch, gt_batch, mask_batch):
 		""" Evaluate the performance of pre-training (namely the signal reconstrution performance of the pretext task)
@@ -370,6 +370,7 @@ class SARSSL(nn.Module):
         self.pretrain = pretrain
         self.pretrain_frozen_encoder = pretrain_frozen_encoder
         self.device = device
+        self.npatch = npatch_shape[0] * npatch_shape[1]
         self.use_cls = use_cls
 
         self.patch_split = at_module.PatchSplit(patch_shape=patch_shape, f_first=f_first)
@@ -516,7 +517,12 @@ class SARSSL(nn.Module):
             self.downstream_dlabel = downstream_dlabel
             self.ds_token = downstream_token
 
-    def forward(self, x):
+    def forward(self, x, mask=None, return_diff=True, return_vis=True):
+        """ Args:   x           - (nbatch, nmic, nf, nt, nreim)
+                    mask        - precomputed masks for pre-training (e.g. by mask_collate), generated here if None
+                    return_diff - whether to calculate the difference between masked and unmasked channels in pre-training (0 if not)
+                    return_vis  - whether to recover the visualized data in pre-training (empty dict if not)
+        """
         nbatch, nmic, nf, nt, nreim = x.shape
         
         if self.pretrain:
@@ -525,20 +531,23 @@ class SARSSL(nn.Module):
             vec_patch = self.patch_split(data)  # (nbatch, npatch, dpatch, nreim, nmic)
 
             ## Mask generation
-            mask_dense, mask_patch_dense, mask_ch_dense, mask_patch_idx, _ = self.patch_mask(data_shape=vec_patch.shape)  
-            # mask_dense/mask_patch_dense/mask_ch_dense: (nbatch, npatch, dpatch, nmic), mask_patch_idx: (nbatch, nmasked_patch)
+            if mask is None:
+                mask = self.patch_mask(data_shape=vec_patch.shape)
+            mask_patch, mask_ch, mask_patch_idx, mask_ch_idx = [m.to(x.device, non_blocking=True) for m in mask]
+            # mask_patch: (nbatch, npatch), mask_ch: (nbatch, nmic), mask_patch_idx: (nbatch, nmasked_patch)
 
-            ## Single-channel masking 
+            ## Single-channel masking (masks of 1 for kept and 0 for masked values, broadcast to (nbatch, npatch, dpatch, 2, nmic))
             npatch = vec_patch.shape[1]
-            mask_dense_expand = mask_dense[:, :, :, np.newaxis, :].expand(-1, -1, -1, 2, -1)
-            mask_patch_dense_expand = mask_patch_dense[:, :, :, np.newaxis, :].expand(-1, -1, -1, 2, -1)
-            mask_ch_dense_expand = mask_ch_dense[:, :, :, np.newaxis, :].expand(-1, -1, -1, 2, -1)
-            vec_patch_mask = vec_patch * mask_dense_expand  # (nbatch, npatch, dpatch, 2, nmic)
+            mask_patch_dense_expand = 1 - mask_patch[:, :, np.newaxis, np.newaxis, np.newaxis].to(vec_patch.dtype)  # (nbatch, npatch, 1, 1, 1)
+            mask_ch_dense_expand = 1 - mask_ch[:, np.newaxis, np.newaxis, np.newaxis, :].to(vec_patch.dtype)  # (nbatch, 1, 1, 1, nmic)
+            mask_dense_expand = 1 - (1 - mask_patch_dense_expand) * (1 - mask_ch_dense_expand)  # (nbatch, npatch, 1, 1, nmic)
 
             ## Embedding encoding
             if self.in_ver=='separate':
                 ## spectral encoder
-                vec_patch_mask_reshape_spec = vec_patch * (1-mask_patch_dense_expand) * mask_ch_dense_expand + vec_patch * mask_patch_dense_expand * (1-mask_ch_dense_expand) # (nbatch, npatch, d_patch, 2, nmic)
+                # vec_patch * (1-mask_patch_dense_expand) * mask_ch_dense_expand + vec_patch * mask_patch_dense_expand * (1-mask_ch_dense_expand), with the masks combined before expanding
+                mask_spec_expand = (1-mask_patch_dense_expand) * mask_ch_dense_expand + mask_patch_dense_expand * (1-mask_ch_dense_expand)  # (nbatch, npatch, 1, 1, nmic)
+                vec_patch_mask_reshape_spec = vec_patch * mask_spec_expand # (nbatch, npatch, d_patch, 2, nmic)
                 vec_patch_mask_reshape_spec = vec_patch_mask_reshape_spec.reshape(nbatch, npatch, -1)  # (nbatch, npatch, dpatch*2*nmic)
                 embed_spec = self.spec_encoder.forward(vec_patch_mask_reshape_spec)  # (nbatch, npatch, dembed)
                 
@@ -565,6 +574,7 @@ class SARSSL(nn.Module):
                 embed_spat = self.spat_encoder.forward(vec_patch_mask_reshape_spat, add_same_one=False)  # (nbatch, npatch, dembed)
                 
             elif self.in_ver == 'single_ch_each_patch': # each patch only has single-channel signal
+                vec_patch_mask = vec_patch * mask_dense_expand  # (nbatch, npatch, dpatch, 2, nmic)
                 vec_patch_mask_reshape = torch.cat([vec_patch_mask[:,:,:,:,0], vec_patch_mask[:,:,:,:,1]], dim=1) # (nbatch, npatch*nmic, dpatch, nreim)
                 vec_patch_mask_reshape = vec_patch_mask_reshape.reshape(nbatch, npatch*nmic, -1)  # (nbatch, npatch*nmic, dpatch*nreim)
                 embed_spec = self.spec_encoder.forward(vec_patch_mask_reshape)  # (nbatch, npatch*nmic, dembed/nmic)
@@ -573,6 +583,7 @@ class SARSSL(nn.Module):
                 embed_spat = torch.cat([embed_spat[:, 0:npatch, :], embed_spat[:, npatch:npatch*2, :]], dim=2) # (nbatch, npatch, dembed)
 
             elif self.in_ver == 'same': # without additional spectral/spatial masking operation 
+                vec_patch_mask = vec_patch * mask_dense_expand  # (nbatch, npatch, dpatch, 2, nmic)
                 vec_patch_mask_reshape = vec_patch_mask.reshape(nbatch, npatch, -1)  # (nbatch, npatch, dpatch*nch)
                 embed_spec = self.spec_encoder.forward(vec_patch_mask_reshape)
                 embed_spat = self.spat_encoder.forward(vec_patch_mask_reshape, add_same_one=False)  # (nbatch, npatch, dembed)
@@ -582,21 +593,27 @@ class SARSSL(nn.Module):
             vec_patch_pred = self.decoder.forward(embed)  # (nbatch, npatch, dpatch*nch+dembed) / (nbatch, npatch, 2*dembed)
 
             ## Loss calculation for masked part
-            tar_ch_patches = torch.sum(vec_patch * (1 - mask_ch_dense_expand), dim=-1).clone().detach()  # (nbatch, npatch, d_patch, 2)
-            tar_anotherch_patches = torch.sum(vec_patch * mask_ch_dense_expand, dim=-1).clone().detach()  # (nbatch, npatch, d_patch, 2)
+            tar_ch_patches = self.select_ch(vec_patch, mask_ch_idx).detach()  # (nbatch, npatch, d_patch, 2)
+            if return_diff:
+                tar_anotherch_patches = torch.sum(vec_patch * mask_ch_dense_expand, dim=-1).detach()  # (nbatch, npatch, d_patch, 2)
             
             dpatch = vec_patch.shape[2]
             vec_patch_pred = vec_patch_pred.reshape(nbatch, npatch, dpatch, 2, nmic)  # (nbatch, npatch, dpatch, 2, nmic)
-            pred_patches = torch.sum(vec_patch_pred * (1 - mask_ch_dense_expand), dim=-1)  # (nbatch, npatch, dpatch, 2)
+            pred_patches = self.select_ch(vec_patch_pred, mask_ch_idx)  # (nbatch, npatch, dpatch, 2)
        
-            loss, diff = self.gen_loss(pred_patches=pred_patches, tar_patches=tar_ch_patches, mask_idx=mask_patch_idx, tar_unmaskch_patches=tar_anotherch_patches)
+            if return_diff:
+                loss, diff = self.gen_loss(pred_patches=pred_patches, tar_patches=tar_ch_patches, mask_idx=mask_patch_idx, tar_unmaskch_patches=tar_anotherch_patches)
+            else:
+                loss = self.gen_loss(pred_patches=pred_patches, tar_patches=tar_ch_patches, mask_idx=mask_patch_idx)
+                diff = torch.zeros_like(loss).detach()
 
             # Additional visualized data
-            mask = mask_dense.clone().detach()
-            tar = vec_patch.clone().detach()
-            pred = vec_patch_pred.clone().detach()
             data_vis = {}
-            data_vis['mask'], data_vis['pred'], data_vis['tar'] = self.vis_results(mask_patches=mask, pred_patches=pred, tar_patches=tar)
+            if return_vis:
+                mask = mask_dense_expand[:, :, :, 0, :].expand(-1, -1, vec_patch.shape[2], -1).detach()  # (nbatch, npatch, dpatch, nmic)
+                tar = vec_patch.detach()
+                pred = vec_patch_pred.detach()
+                data_vis['mask'], data_vis['pred'], data_vis['tar'] = self.vis_results(mask_patches=mask, pred_patches=pred, tar_patches=tar)
             
             return loss, diff, data_vis
 
@@ -606,21 +623,22 @@ class SARSSL(nn.Module):
             vec_patch = self.patch_split(data)  # (nbatch, npatch, dpatch, nreim, nmic)
 
             ## Mask generation
-            mask_dense, mask_patch_dense, mask_ch_dense, mask_patch_idx, _ = self.patch_mask(data_shape=vec_patch.shape)  
-            # mask_dense/mask_patch_dense/mask_ch_dense: (nbatch, npatch, dpatch, nmic), mask_patch_idx: (nbatch, nmasked_patch)
+            if mask is None:
+                mask = self.patch_mask(data_shape=vec_patch.shape)
+            mask_patch, mask_ch, mask_patch_idx, mask_ch_idx = [m.to(x.device, non_blocking=True) for m in mask]
+            # mask_patch: (nbatch, npatch), mask_ch: (nbatch, nmic), mask_patch_idx: (nbatch, nmasked_patch)
 
-            ## Single-channel masking 
+            ## Single-channel masking (masks of 1 for kept and 0 for masked values, broadcast to (nbatch, npatch, dpatch, 2, nmic))
             npatch = vec_patch.shape[1]
-            mask_dense_expand = mask_dense[:, :, :, np.newaxis, :].expand(-1, -1, -1, 2, -1)
-            mask_patch_dense_expand = mask_patch_dense[:, :, :, np.newaxis, :].expand(-1, -1, -1, 2, -1)
-            mask_ch_dense_expand = mask_ch_dense[:, :, :, np.newaxis, :].expand(-1, -1, -1, 2, -1)
-            vec_patch_mask = vec_patch * mask_dense_expand  # (nbatch, npatch, dpatch, 2, nmic)
+            mask_patch_dense_expand = 1 - mask_patch[:, :, np.newaxis, np.newaxis, np.newaxis].to(vec_patch.dtype)  # (nbatch, npatch, 1, 1, 1)
+            mask_ch_dense_expand = 1 - mask_ch[:, np.newaxis, np.newaxis, np.newaxis, :].to(vec_patch.dtype)  # (nbatch, 1, 1, 1, nmic)
+            mask_dense_expand = 1 - (1 - mask_patch_dense_expand) * (1 - mask_ch_dense_expand)  # (nbatch, npatch, 1, 1, nmic)
 
             ## Embedding encoding
             if self.in_ver=='separate':
                 ## spectral information
                 # vec_patch_mask_reshape_spec = vec_patch * (1-mask_patch_dense_expand) * mask_ch_dense_expand + vec_patch * mask_patch_dense_expand * (1-mask_ch_dense_expand) # (nbatch, npatch, d_patch, 2, nmic)
-                vec_patch_mask_reshape_spec = vec_patch * (1-mask_patch_dense_expand) * mask_ch_dense_expand # only unmasked channel
+                vec_patch_mask_reshape_spec = vec_patch * ((1-mask_patch_dense_expand) * mask_ch_dense_expand) # only unmasked channel
                 # vec_patch_mask_reshape_spec = vec_patch * mask_patch_dense_expand * (1-mask_ch_dense_expand) # only masked channel
                 vec_patch_mask_reshape_spec = vec_patch_mask_reshape_spec.reshape(nbatch, npatch, -1)  # (nbatch, npatch, dpatch*2*nmic)
                 embed_spec = self.spec_encoder.forward(vec_patch_mask_reshape_spec)  # (nbatch, npatch, dembed)
@@ -635,8 +653,8 @@ class SARSSL(nn.Module):
 
             ## Loss calculation for masked part
             dpatch = vec_patch.shape[2]
-            tar_ch_patches = torch.sum(vec_patch * (1 - mask_ch_dense_expand), dim=-1).clone().detach()  # (nbatch, npatch, d_patch, 2)
-            tar_anotherch_patches = torch.sum(vec_patch * mask_ch_dense_expand, dim=-1).clone().detach()  # (nbatch, npatch, d_patch, 2)
+            tar_ch_patches = self.select_ch(vec_patch, mask_ch_idx).detach()  # (nbatch, npatch, d_patch, 2)
+            # tar_anotherch_patches = torch.sum(vec_patch * mask_ch_dense_expand, dim=-1).clone().detach()  # (nbatch, npatch, d_patch, 2)
             
             ## use spectral encoder
             # vec_patch_pred_spec = self.spec_decoder.forward(embed_spec)  # (nbatch, npatch, dpatch*nch+dembed) / (nbatch, npatch, dembed)
@@ -653,15 +671,16 @@ class SARSSL(nn.Module):
             ## use spatial & spectral encoders
             vec_patch_pred = self.spec_spat_decoder.forward(embed)  # (nbatch, npatch, dpatch*nch)
             vec_patch_pred = vec_patch_pred.reshape(nbatch, npatch, dpatch, 2, nmic)  # (nbatch, npatch, dpatch, 2, nmic)
-            pred_patches = torch.sum(vec_patch_pred * (1 - mask_ch_dense_expand), dim=-1)  # (nbatch, npatch, dpatch, 2)
-            loss = self.gen_loss_spec(pred_patches=pred_patches, tar_patches=tar_ch_patches, mask_idx=mask_patch_idx, tar_unmaskch_patches=tar_anotherch_patches, tar_maskch=True)
+            pred_patches = self.select_ch(vec_patch_pred, mask_ch_idx)  # (nbatch, npatch, dpatch, 2)
+            loss = self.gen_loss_spec(pred_patches=pred_patches, tar_patches=tar_ch_patches, mask_idx=mask_patch_idx, tar_maskch=True)
             
             ## Additional visualized data
-            mask = mask_dense.clone().detach()
-            tar = vec_patch.clone().detach()
-            pred = vec_patch_pred.clone().detach()
             data_vis = {}
-            data_vis['mask'], data_vis['pred'], data_vis['tar'] = self.vis_results(mask_patches=mask, pred_patches=pred, tar_patches=tar)
+            if return_vis:
+                mask = mask_dense_expand[:, :, :, 0, :].expand(-1, -1, vec_patch.shape[2], -1).detach()  # (nbatch, npatch, dpatch, nmic)
+                tar = vec_patch.detach()
+                pred = vec_patch_pred.detach()
+                data_vis['mask'], data_vis['pred'], data_vis['tar'] = self.vis_results(mask_patches=mask, pred_patches=pred, tar_patches=tar)
             
             return loss, loss*0.0, data_vis
         else:
@@ -673,9 +692,12 @@ class SARSSL(nn.Module):
             npatch = vec_patch.shape[1]
  
             if (self.in_ver == 'separate') | (self.in_ver == 'same'):
+                # only the encoders whose embeddings are used downstream are run
                 vec_patch_reshape = vec_patch.reshape(nbatch, npatch, -1) # (nbatch, npatch, dpatch*nch) 
-                embed_spec = self.spec_encoder.forward(vec_patch_reshape)  # (nbatch, npatch, dembed)
-                embed_spat = self.spat_encoder.forward(vec_patch_reshape, add_same_one=False)  # (nbatch, npatch, dembed)
+                if self.use_cls | (self.embed_use4ds != 'spat'):
+                    embed_spec = self.spec_encoder.forward(vec_patch_reshape)  # (nbatch, npatch, dembed)
+                if self.use_cls | (self.embed_use4ds == 'spec_spat') | (self.embed_use4ds == 'spat'):
+                    embed_spat = self.spat_encoder.forward(vec_patch_reshape, add_same_one=False)  # (nbatch, npatch, dembed)
 
             elif self.in_ver == 'single_ch_each_patch':
                 vec_patch_reshape = torch.cat([vec_patch[:,:,:,:,0], vec_patch[:,:,:,:,1]], dim=1) # (nbatch, npatch*nmic, dpatch, nreim)
@@ -718,57 +740,68 @@ class SARSSL(nn.Module):
                 pred = self.pred_head(x, pred)
             return pred, torch.mean(embed, dim=1)
 
+    def mask_collate(self, ch_mode='M'):
+        """ Collate function generating the patch masks of pre-training batches in DataLoader workers
+        """
+        return at_module.PatchMaskCollate(self.patch_mask, npatch=self.npatch, ch_mode=ch_mode)
+
+    def select_ch(self, patches, mask_ch_idx):
+        """ Select the masked channel of patches
+			Args:	patches     - (nbatch, npatch, dpatch, 2, nmic)
+                    mask_ch_idx - (nbatch, 1)
+			Return: (nbatch, npatch, dpatch, 2)
+		"""
+        idx = mask_ch_idx[:, np.newaxis, np.newaxis, np.newaxis, :].expand(patches.shape[:-1]+(1,))
+        return torch.gather(patches, 4, idx)[..., 0]
+
+    def gather_patches(self, patches, mask_idx):
+        """ Gather the masked patches of a batch
+			Args:	patches  - (nbatch, npatch, dpatch, 2)
+                    mask_idx - (nbatch, nmasked_patch)
+			Return: (nbatch, nmasked_patch, dpatch, 2)
+		"""
+        idx = mask_idx[:, :, np.newaxis, np.newaxis].expand((-1, -1)+patches.shape[2:])
+        return torch.gather(patches, 1, idx)
+
     def gen_loss(self, pred_patches, tar_patches, mask_idx, tar_unmaskch_patches=None):
         """ Calculate the generative loss from predited masked patches and target patches 
 			Args:	pred_patches - (nbatch, npatch, dpatch, 2)
 					tar_patches  - (nbatch, npatch, dpatch, 2)
                     mask_idx     - (nbatch, nmasked_patch)
-			Return: loss
+                    tar_unmaskch_patches - (nbatch, npatch, dpatch, 2), to also return the difference between channels
+			Return: loss (, diff)
 		"""
 
-        nmasked_patch = mask_idx.shape[-1]
-        nbatch, _, dpatch, nreim = tar_patches.shape
-        pred = torch.empty((nbatch, nmasked_patch, dpatch, nreim), device=self.device).float()  # (nbatch, nmaskedpatch, dpatch, 2)
-        tar = torch.empty((nbatch, nmasked_patch, dpatch, nreim), device=self.device).float()  # (nbatch, nmaskedpatch, dpatch, 2)
-        if tar_unmaskch_patches is not None:
-            tar_unmaskch = torch.empty((nbatch, nmasked_patch, dpatch, nreim), device=self.device).float()
-
-        for b_idx in range(nbatch):
-            pred[b_idx, ...] = pred_patches[b_idx, mask_idx[b_idx], :, :]  # (nbatch, npatch, dpatch, 2)
-            tar[b_idx, ...] = tar_patches[b_idx, mask_idx[b_idx], :, :]  # (nbatch, npatch, dpatch, 2)
-            if tar_unmaskch_patches is not None:
-                tar_unmaskch[b_idx, ...] = tar_unmaskch_patches[b_idx, mask_idx[b_idx], :, :]
+        pred = self.gather_patches(pred_patches, mask_idx)  # (nbatch, nmaskedpatch, dpatch, 2)
+        tar = self.gather_patches(tar_patches, mask_idx)  # (nbatch, nmaskedpatch, dpatch, 2)
 
         # Calculate the MSE loss
         loss = torch.mean((pred - tar)**2)
-        if tar_unmaskch_patches is not None:
-            diff = torch.mean((tar - tar_unmaskch)**2)
-         
-        return loss if tar_unmaskch_patches is None else loss, diff
+        if tar_unmaskch_patches is None:
+            return loss
+
+        tar_unmaskch = self.gather_patches(tar_unmaskch_patches, mask_idx)
+        diff = torch.mean((tar - tar_unmaskch)**2)
+
+        return loss, diff
     
     def gen_loss_spec(self, pred_patches, tar_patches, mask_idx, tar_unmaskch_patches=None, tar_maskch=True): 
         """ Calculate the generative loss from predited masked patches and target patches 
 			Args:	pred_patches - (nbatch, npatch, dpatch, 2)
 					tar_patches  - (nbatch, npatch, dpatch, 2)
                     mask_idx     - (nbatch, nmasked_patch)
+                    tar_unmaskch_patches - (nbatch, npatch, dpatch, 2), only needed when tar_maskch is False
 			Return: loss
 		"""
  
-        nmasked_patch = mask_idx.shape[-1]
-        nbatch, _, dpatch, nreim = tar_patches.shape
-        pred = torch.empty((nbatch, nmasked_patch, dpatch, nreim), device=self.device).float()  # (nbatch, nmaskedpatch, dpatch, 2)
-        tar = torch.empty((nbatch, nmasked_patch, dpatch, nreim), device=self.device).float()  # (nbatch, nmaskedpatch, dpatch, 2)
-        tar_unmaskch = torch.empty((nbatch, nmasked_patch, dpatch, nreim), device=self.device).float()
-
-        for b_idx in range(nbatch):
-            pred[b_idx, ...] = pred_patches[b_idx, mask_idx[b_idx], :, :]  # (nbatch, npatch, dpatch, 2)
-            tar[b_idx, ...] = tar_patches[b_idx, mask_idx[b_idx], :, :]  # (nbatch, npatch, dpatch, 2)
-            tar_unmaskch[b_idx, ...] = tar_unmaskch_patches[b_idx, mask_idx[b_idx], :, :]
+        pred = self.gather_patches(pred_patches, mask_idx)  # (nbatch, nmaskedpatch, dpatch, 2)
 
         # Calculate the MSE loss
         if tar_maskch:
+            tar = self.gather_patches(tar_patches, mask_idx)  # (nbatch, nmaskedpatch, dpatch, 2)
             loss = torch.mean((pred - tar)**2)
         else:
+            tar_unmaskch = self.gather_patches(tar_unmaskch_patches, mask_idx)
             loss = torch.mean((pred - tar_unmaskch)**2)
          
         return loss 
@@ -791,7 +824,12 @@ class SARSSL(nn.Module):
 
 
 class SARSSL_MultiCH(nn.Module): 
-    def __init__(self, sig_shape, nmic_pair, task, device): 
+    """ Multi-channel SARSSL, which encodes each pair of the reference channel and another channel by a single-pair SARSSL
+        Args:       nmic_pair   - number of microphone pairs (nmic-1)
+                    pair_chunk  - number of pairs of a sample encoded in one call for multi-channel inputs, bounding the copies of the
+                                  reference channel and, at inference, the activations to those of one chunk (default: 1)
+    """
+    def __init__(self, sig_shape, nmic_pair, task, device, pair_chunk=1): 
         super(SARSSL_MultiCH, self).__init__()
 
         self.model_sch = SARSSL(sig_shape=sig_shape, pretrain=False, device=device, downstream_token='all', downstream_head='', downstream_embed='spat', downstream_dlabel=1)
@@ -809,17 +847,41 @@ class SARSSL_MultiCH(nn.Module):
                     nn.Linear(dembed_ds*nmic_pair, factor)
                     )
         self.nmic_pair = nmic_pair
+        self.pair_chunk = pair_chunk
                  
     def forward(self, x):
-        nbatch_nmicpair, nmic, nf, nt, nreim = x.shape
-        nbatch = nbatch_nmicpair//self.nmic_pair
-        embed_sch, _ = self.model_sch(x) # (nb*nmic_pair, nembed)
+        """ Args:   x   - microphone pairs (nb*nmic_pair, 2, nf, nt, nreim) rebatched by the learner (ch_mode='M'),
+                          or microphone channels (nb, nmic_pair+1, nf, nt, nreim) of a learner with ch_mode='1', paired here
+        """
+        if x.shape[1] > 2:
+            embed_sch = self.pair_forward(x) # (nb*nmic_pair, nembed)
+        else:
+            embed_sch, _ = self.model_sch(x) # (nb*nmic_pair, nembed)
         nembed = embed_sch.shape[-1]
         embed_sch = embed_sch.reshape(-1, self.nmic_pair*nembed)
         pred = self.head_mch(embed_sch)
 
         return pred, embed_sch
 
+    def pair_forward(self, x):
+        """ Encode the pairs of the reference channel with the other channels of multi-channel inputs, without duplicating the
+            reference channel beyond the pairs of one chunk
+            Args:       x           - (nb, nmic_pair+1, nf, nt, nreim)
+            Returns:    embed_sch   - (nb*nmic_pair, nembed), ordered as the pairs rebatched by AddChToBatch
+        """
+        nbatch, nch = x.shape[:2]
+        assert nch == self.nmic_pair + 1, 'number of microphone pairs unmatched~'
+        pair_chunk = min(self.pair_chunk, self.nmic_pair)
+        embeds = []
+        for st in range(1, nch, pair_chunk):
+            ed = min(st + pair_chunk, nch)
+            x_ref = x[:, 0:1, ...].expand((-1, ed-st) + x.shape[2:]) # (nb, npair_chunk, nf, nt, nreim), a view of the reference channel
+            x_pair = torch.stack((x_ref, x[:, st:ed, ...]), dim=2).reshape((nbatch*(ed-st), 2) + x.shape[2:]) # (nb*npair_chunk, 2, nf, nt, nreim)
+            embed, _ = self.model_sch(x_pair) # (nb*npair_chunk, nembed)
+            embeds += [embed.reshape(nbatch, ed-st, -1)]
+
+        return torch.cat(embeds, dim=1).reshape(nbatch*self.nmic_pair, -1)
+
 
 class MCConformer(nn.Module): 
     """ 
@@ -35,6 +35,7 @@ class opt_pretrain():
         
         parser.add_argument('--checkpoint-start', action='store_true', default=False, help='train model from saved latest checkpoints (default: False)')
         parser.add_argument('--checkpoint-from-best-epoch', action='store_true', default=False, help='train model from saved best checkpoints (default: False)')
+        parser.add_argument('--checkpoint-every', type=int, default=0, metavar='CheckpointEvery', help='save a mid-epoch checkpoint every given number of batches, 0 for none (default: 0)')
         parser.add_argument('--time', type=str, default=self.time, metavar='Time', help='time flag')
         parser.add_argument('--work-dir', type=str, default=self.work_dir, metavar='WorkDir', help='work directory')
 
@@ -46,6 +47,8 @@ class opt_pretrain():
         parser.add_argument('--pretrain-frozen-encoder', action='store_true', default=False, help='change to pretrain stage (default: False)')
         parser.add_argument('--nepoch', type=int, default=30, metavar='Epoch', help='number of epochs to train (default: 30)')
         parser.add_argument('--lr', type=float, default=0.001, metavar='LR', help='learning rate (default:0.001)')
+        parser.add_argument('--lr-warmup-epochs', type=int, default=0, metavar='LRWarmup', help='epochs of linear learning rate warm-up from 0 for simulated data (default: 0)')
+        parser.add_argument('--mask-workers', action='store_true', default=False, help='generate patch masks in DataLoader workers (default: False)')
         
         parser.add_argument('--test', action='store_true', default=False, help='change to test stage of downstream tasks (default: False)')
         parser.add_argument('--test-mode', type=str, default='all', metavar='TestMode', help='test mode (default: all)')
@@ -152,6 +155,7 @@ class opt_downstream():
         parser.add_argument('--seed', type=int, default=1, metavar='Seed', help='random seed (default: 1)')
         
         parser.add_argument('--checkpoint-start', action='store_true', default=False, help='train model from saved checkpoints (default: False)')
+        parser.add_argument('--checkpoint-every', type=int, default=0, metavar='CheckpointEvery', help='save a mid-epoch checkpoint every given number of batches, 0 for none (default: 0)')
         parser.add_argument('--time', type=str, default=self.time, metavar='Time', help='time flag')
         parser.add_argument('--work-dir', type=str, default=self.work_dir, metavar='WorkDir', help='work directory')
 
@@ -167,6 +171,11 @@ class opt_downstream():
         parser.add_argument('--ds-embed', type=str, default='spat', metavar='DSEmbed', help='downstream embed (default: spat)') # ['spec_spat', 'spec', 'spat']
         parser.add_argument('--ds-nsimroom', type=int, default=0, metavar='DSSimRoom', help='number of simulated room used for downstream training (default: 0)') 
         parser.add_argument('--ds-real-sim-ratio', type=int, nargs='+', default=[1, 1], metavar='DSRealSimRatio', help='downstream number ratio between real data and simulated data (default: [1, 1])')
+        parser.add_argument('--ds-ch-mode', type=str, default='M', choices=['M', '1'], metavar='DSChMode', help="microphone channel mode, 'M' to rebatch the pairs of the reference channel and the others in the learner, '1' to feed all channels to a multi-channel model that encodes the pairs by chunks (default: M)")
+        parser.add_argument('--ds-pair-chunk', type=int, default=1, metavar='DSPairChunk', help="number of microphone pairs of a sample encoded in one call with --ds-ch-mode 1 (default: 1)")
+        parser.add_argument('--ds-nslot', type=int, default=1, metavar='DSNSlot', help='number of lr/bs/trial configurations trained concurrently, one process each (default: 1)')
+        parser.add_argument('--ds-sh-epoch', type=int, default=0, metavar='DSSHEpoch', help='epochs of the first rung of successive halving over lr/bs configurations, 0 to train all configurations to the end (default: 0)')
+        parser.add_argument('--ds-sh-eta', type=int, default=3, metavar='DSSHEta', help='reduction factor of successive halving, the top 1/eta configurations of a rung are promoted (default: 3)')
 
         parser.add_argument('--ds-test', action='store_true', default=False, help='change to test stage of downstream tasks (default: False)')
         parser.add_argument('--test-mode', type=str, default='cal_metric_wo_info', metavar='TestMode', help='test mode (default: cal_metric_wo_info)')
@@ -22,6 +22,15 @@
 		# --ds-real-sim-ratio = 1 1, 1 0 or 0 1
 		python run_downstream.py --ds-train --ds-trainmode finetune --ds-real-sim-ratio 1 0 --ds-task TDOA --time * --gpu-id 0, 
 		python run_downstream.py --ds-train --ds-trainmode scratchLOW --ds-real-sim-ratio 1 0 --ds-task TDOA --time * --gpu-id 0, 
+
+		# distributed training, one process per GPU (or per CPU worker with --no-cuda), batch sizes are the total of all processes
+		torchrun --nnodes 1 --nproc-per-node 4 run_downstream.py --ds-train --ds-trainmode finetune --simu-exp --ds-nsimroom 8 --ds-task TDOA --time * --gpu-id 0,1,2,3
+
+		# concurrent lr/bs/trial configurations, one process per slot with the GPUs assigned to slots in turn
+		python run_downstream.py --ds-train --ds-trainmode finetune --simu-exp --ds-nsimroom 8 --ds-task TDOA --time * --gpu-id 0,1 --ds-nslot 4
+
+		# successive halving (ASHA) over lr/bs configurations, with rungs at 10, 30, 90 epochs and the top 1/3 promoted at each rung
+		python run_downstream.py --ds-train --ds-trainmode finetune --simu-exp --ds-nsimroom 8 --ds-task TDOA --time * --gpu-id 0,1 --ds-nslot 4 --ds-sh-epoch 10 --ds-sh-eta 3
 """
 
 import os
@@ -37,6 +46,8 @@ opts = opt_downstream()
 args = opts.parse()
 dirs = opts.dir()
 os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu_id
+if args.ds_nslot > 1:
+	os.environ['PYTORCH_NVML_BASED_CUDA_CHECK'] = '1' # check CUDA availability without initializing CUDA, which cannot be used by forked processes otherwise
 
 import torch
 torch.backends.cuda.matmul.allow_tf32 = True  # The flag below controls whether to allow TF32 on matmul. This flag defaults to False in PyTorch 1.12 and later.
@@ -52,10 +63,16 @@ import dataset as at_dataset
 import learner as at_learner
 import model as at_model
 from common.utils import set_seed, set_random_seed, get_nparams, get_FLOPs, vis_TSNE, cross_validation_datadir 
+from common.utils import init_distributed, NullWriter, run_forked_jobs, savemat_atomic
 
 use_cuda = not args.no_cuda and torch.cuda.is_available()
 device = torch.device("cuda" if use_cuda else "cpu")
 
+# Distributed training when launched by torchrun, where only rank 0 writes logs, checkpoints and results
+rank, world_size, local_rank = init_distributed(backend='nccl' if use_cuda else 'gloo')
+Writer = SummaryWriter if rank == 0 else NullWriter
+assert (args.ds_nslot == 1) | (world_size == 1), 'Concurrent configurations (--ds-nslot) are not supported in distributed training'
+
 set_seed(args.seed)
 # Acoustic setting parameters
 assert args.source_state == 'static', 'Source state model unrecognized~'
@@ -86,15 +103,326 @@ print('nt, nf: ', nt, nf)
 
 # Network
 dlabel = 1
-net = at_model.SARSSL(sig_shape=(nf, nt, 2, 2), pretrain=False, device=device, 
-	downstream_token=args.ds_token, downstream_head=args.ds_head, downstream_embed = args.ds_embed, downstream_dlabel=dlabel)
+if args.ds_ch_mode == '1': # all channels are fed to the model, which pairs the reference channel with the others by chunks
+	assert (args.ds_task == ['TDOA']) | ('TDOA' not in args.ds_task), 'TDOA estimation of multiple microphone pairs can not be trained with other tasks~'
+	net = at_model.SARSSL_MultiCH(sig_shape=(nf, nt, 2, 2), nmic_pair=nmic-1, task=args.ds_task[0], device=device, pair_chunk=args.ds_pair_chunk)
+	pretrain_key = 'model_sch.'
+else:
+	net = at_model.SARSSL(sig_shape=(nf, nt, 2, 2), pretrain=False, device=device, 
+		downstream_token=args.ds_token, downstream_head=args.ds_head, downstream_embed = args.ds_embed, downstream_dlabel=dlabel)
+	pretrain_key = ''
 layer_keys = ['spec_encoder', 'spat_encoder', 'decoder', 'mlp_head','spec_encoder.patch_embed','spec_encoder.embed','spat_encoder.patch_embed','spat_encoder.embed']
 nparam, nparam_sum = get_nparams(net, param_key_list=layer_keys)
 print('# Parameters (M):', round(nparam_sum, 2), [key+': '+str(round(nparam[key], 2)) for key in nparam.keys()])
 nreim = 2
-flops_forward_eval, _ = get_FLOPs(net, input_shape=(1, nmic, nf, nt, nreim), duration=T)
+flops_forward_eval, _ = get_FLOPs(net, input_shape=(1, nmic, nf, nt, nreim), duration=T, device='cpu' if args.ds_nslot > 1 else device) # the main process stays off CUDA to fork configuration processes
 print(f"FLOPs_forward: {flops_forward_eval:.2f}G/s")
 
+
+def build_downstream_datasets(task, trial_idx):
+	""" Build the datasets of all stages for a trial (or cross-validation dataset) of the current task, shared by its lr/bs configurations
+		Returns:	datasets	- dict of datasets of stages
+	"""
+	set_seed(args.seed)
+
+	datasets = {}
+	if args.simu_exp: # simulated data, not on-the-fly (simulated data-all est tasks)
+		for stage in stages: 
+			if stage=='train':
+				data_dir = dirs['micsig_'+stage.split('_')[0]+'_simu'][trial_idx]
+			else:
+				data_dir = dirs['micsig_'+stage.split('_')[0]+'_simu'] 
+			datasets[stage] = at_dataset.FixMicSigDataset( 
+				data_dir=data_dir, 
+				load_anno=True, 
+				load_dp=False,
+				fs=fs,
+				dataset_sz=data_num[stage], 
+				transforms=[selecting]
+			)
+	else: # real-world data
+		if task!='TDOA': # real_world ACE- est tasks
+			for stage in stages:
+				real_rir_dir_list = room_dir_set[trial_idx][stage.split('_')[0]]
+				if stage=='train':
+					sim_rir_dir_list = dirs['rir_'+stage.split('_')[0]+'_simu']
+				else:
+					sim_rir_dir_list = []
+				datasets[stage] = at_dataset.RandomMicSigFromRIRDataset(
+					real_rir_dir_list=real_rir_dir_list, 
+					sim_rir_dir_list=sim_rir_dir_list, 
+					src_dir=dirs['srcsig_'+stage.split('_')[0]],
+					dataset_sz=data_num[stage], 
+					T=T, 
+					fs=fs, 
+					c=speed,
+					nmic=nmic, 
+					snr_range=snr_range, 
+					real_sim_ratio=real_sim_ratios[stage.split('_')[0]], 
+					transforms=[selecting],
+					seed=seeds[stage.split('_')[0]]
+				)
+		else: # real-world LOCATA-TDOA est task
+			for stage in stages:
+				real_sig_dir = dirs['micsig_real']
+				if stage=='train':
+					sim_sig_dir = dirs['micsig_'+stage.split('_')[0]+'_simu']
+				else:
+					sim_sig_dir = []
+
+				datasets[stage] = at_dataset.RandomMicSigDataset(
+					real_sig_dir=real_sig_dir, 
+					sim_sig_dir=sim_sig_dir, 
+					real_sim_ratio=real_sim_ratios[stage.split('_')[0]], 
+					fs = fs,
+					stage = stage.split('_')[0],
+					load_anno=True, 
+					dataset_sz=data_num[stage], 
+					transforms=[selecting]
+				)
+
+	return datasets
+
+
+def train_downstream(task, trial_idx, bs_idx, lr_idx, datasets, max_epoch=None, finish=True, resume=False, slot=0):
+	""" Train, ensemble and test the model of a lr/bs/trial configuration with the settings of the current task
+		Args:		datasets	- dict of datasets of stages, by build_downstream_datasets
+					max_epoch	- last epoch to train in this call, e.g. the epoch of a rung of successive halving (default: nepoch)
+					finish		- whether to ensemble and test the model after training, which is also done when training stops early
+					resume		- whether to continue training from the latest checkpoint and its history
+					slot		- index of the process slot when configurations are trained concurrently, selecting the GPU
+		Returns:	metric_val	- validation metric of the last trained epoch
+					result		- best_loss_val, best_metric_val, best_loss_test, best_metric_test, st_epoch, ed_epoch, None if not finished
+	"""
+	set_seed(args.seed)
+	lr_init = lr_set[lr_idx]
+	bs = bs_set[bs_idx]
+	print(task, ': nepoch=',nepoch, 'num=',num, 'lr=',lr_init, 'bs=',bs, 'trial(or cross_validation_dataset)_idx=',trial_idx, 'ntrial=',ntrials)
+	task_dir = dirs[log_dir].replace('TASK', task).replace('NUM', str(num)).replace('LR', str(lr_init)).replace('BAS', str(bs)).replace('TRI', str(trial_idx))
+	if (args.ds_nslot > 1) & use_cuda:
+		torch.cuda.set_device(slot % torch.cuda.device_count())
+
+	kwargs = {'num_workers': args.workers, 'pin_memory': True} if use_cuda else {}
+	if world_size > 1:
+		assert bs % world_size == 0, f'Training batch size {bs} is not divisible by the number of processes {world_size}'
+		# each process trains on a disjoint share of the data with bs/world_size samples per batch, in the same order in every epoch (no set_epoch), as the fixed seed below
+		sampler_train = torch.utils.data.DistributedSampler(datasets['train'], num_replicas=world_size, rank=rank, shuffle=True, seed=seeds['train'])
+		dataloader_train = torch.utils.data.DataLoader(dataset=datasets['train'], batch_size=bs//world_size, sampler=sampler_train, **kwargs)
+	else:
+		dataloader_train = torch.utils.data.DataLoader(dataset=datasets['train'], batch_size=bs, shuffle=True, **kwargs)
+	dataloader_val = torch.utils.data.DataLoader(dataset=datasets['val'], batch_size=test_bs, shuffle=False, **kwargs)
+	dataloader_test = torch.utils.data.DataLoader(dataset=datasets['test'], batch_size=test_bs, shuffle=False, **kwargs)
+	dataloader_test_large = torch.utils.data.DataLoader(dataset=datasets['test_large'], batch_size=test_bs, shuffle=False, **kwargs)
+
+	# Learner
+	net.load_state_dict(init_state_dict)
+	learner = at_learner.STFTLearner(net, win_len=win_len, win_shift_ratio=win_shift_ratio, nfft=nfft, fre_used_ratio=fre_used_ratio, fs=fs, task=task, ch_mode=args.ds_ch_mode)
+	if (len(args.gpu_id)>1) & (world_size == 1) & (args.ds_nslot == 1):
+		learner.mul_gpu()
+	if use_cuda:
+		learner.cuda()
+	else:
+		learner.cpu()
+	if world_size > 1:
+		learner.ddp(device_ids=[local_rank] if use_cuda else None, find_unused_parameters=True) # encoders unused by the downstream embedding get no gradient
+	if args.use_amp:
+		learner.amp()
+
+	if args.checkpoint_start | resume:
+		learner.resume_checkpoint(checkpoints_dir=task_dir, from_latest=True, as_all_state=True) # Train from latest checkpoints
+	else:
+		if args.ds_trainmode=='finetune':
+			learner.load_checkpoint_best(checkpoints_dir=dirs['log_pretrain'], as_all_state=False, param_frozen=False, ex_key=pretrain_key) # fine-tune pretrained networks
+		elif args.ds_trainmode=='lineareval':
+			learner.load_checkpoint_best(checkpoints_dir=dirs['log_pretrain'], as_all_state=False, param_frozen=True, ex_key=pretrain_key)
+
+	# Monitor parameters with tensorboard
+	train_writer = Writer(task_dir + '/train/', 'train')
+	val_writer = Writer(task_dir + '/val/', 'val')
+	val_sm_writer = Writer(task_dir + '/val-smooth/', 'val')
+	test_writer = Writer(task_dir + '/test/', 'test')
+	test_sm_writer = Writer(task_dir + '/test-smooth/', 'test')
+
+	# Model Training
+	loss_val_list = []
+	metric_val_list = []
+	lr = lr_init * 1
+	cnt_stop = 0
+	best_epoch = learner.start_epoch - 1
+	if learner.hist is not None: # continue a configuration trained to a rung of successive halving
+		loss_val_list, metric_val_list = learner.hist['loss_val_list'], learner.hist['metric_val_list']
+		lr, cnt_stop, best_epoch = learner.hist['lr'], learner.hist['cnt_stop'], learner.hist['best_epoch']
+	epoch = learner.start_epoch - 1
+	stop_training = False
+	for epoch in range(learner.start_epoch, (nepoch if max_epoch is None else min(max_epoch, nepoch))+1, 1):
+		print('\nEpoch {}/{}:'.format(epoch, nepoch))
+
+		# the training datasets draw mixtures from np.random regardless of the sampled indexes, so each process draws its own
+		set_random_seed(seeds['train'], rank=rank)
+		loss_train, metric_train = learner.train_epoch(dataloader_train, lr=lr, epoch=epoch, return_metric=True, checkpoints_dir=task_dir, checkpoint_every=args.checkpoint_every)
+		nmetric = 1
+
+		set_random_seed(seeds['val'])
+		loss_val, metric_val = learner.test_epoch(dataloader_val, return_metric=True)
+
+		set_random_seed(seeds['test'])
+		loss_test, metric_test = learner.test_epoch(dataloader_test, return_metric=True)
+
+		print('{} estimation, Val loss: {:.4f}, Val metric: {:.4f}'.format(task, loss_val, metric_val))
+		print('{} estimation, Test loss: {:.4f}, Test metric: {:.4f}'.format(task, loss_test, metric_test))
+
+		loss_val_list += [loss_val] 
+		metric_val_list += [metric_val]
+		loss_val_list_smooth = learner.smooth_data(data_list=loss_val_list, alpha=smooth_alpha)
+
+		# Save model
+		stop_flag, is_best_epoch = learner.early_stopping(current_score=loss_val_list_smooth[-1]*(-1), patience=early_stop_patience)
+		if is_best_epoch:
+			best_epoch = copy.deepcopy(epoch)
+
+		# Visualize parameters with tensorboardX
+		train_writer.add_scalar('loss', loss_train, epoch)
+		val_writer.add_scalar('loss', loss_val, epoch)
+		val_sm_writer.add_scalar('loss', loss_val_list_smooth[-1], epoch)
+		test_writer.add_scalar('loss', loss_test, epoch)
+
+		if nmetric == 1:
+			train_writer.add_scalar('metric', metric_train, epoch)
+			val_writer.add_scalar('metric', metric_val, epoch)
+			test_writer.add_scalar('metric', metric_test, epoch)
+		train_writer.add_scalar('lr', lr, epoch)
+		if epoch==1:
+			train_writer.add_scalar('nparam', nparam_sum, epoch)
+		if stop_flag: ## Inff plot: comment
+			cnt_stop += 1
+			if cnt_stop <= num_stop_th:
+				lr = lr / 10
+				print('lr decaing')
+				learner.early_stop_counter = 0
+			else:
+				stop_training = True
+
+		# checkpoint after the decisions of early stopping, with the history to continue training from
+		learner.hist = {'loss_val_list': loss_val_list, 'metric_val_list': metric_val_list, 'lr': lr, 'cnt_stop': cnt_stop, 'best_epoch': best_epoch}
+		learner.save_checkpoint(epoch=epoch, checkpoints_dir=task_dir, is_best_epoch=is_best_epoch, save_extra_hist=True)
+		if stop_training:
+			break 
+
+	if (not finish) & (not stop_training) & (epoch < nepoch):
+		return metric_val_list[-1], None
+
+	print('\nTraining finished\n')
+
+	# Ensemble model 
+	st_epoch = np.maximum(1, best_epoch-nepoch_ensemble+1)
+	ed_epoch = copy.deepcopy(best_epoch)
+	epochs = [i for i in range(st_epoch, ed_epoch+1, 1)]
+	learner.ensembling(checkpoints_dir=task_dir, epochs=epochs)
+
+	# Model validation
+	set_random_seed(seeds['test'])
+	best_loss_test, best_metric_test = learner.test_epoch(dataloader_test_large, return_metric=True)
+	set_random_seed(seeds['val'])
+	best_loss_val, best_metric_val = learner.test_epoch(dataloader_val, return_metric=True)
+	print('{} estimation, Test loss: {:.4f}, Test metric: {:.4f}'.format(task, best_loss_test, best_metric_test))
+	print('{} estimation, Val loss: {:.4f}, Val metric: {:.4f}'.format(task, best_loss_val, best_metric_val))
+	val_sm_writer.add_scalar('metric', best_metric_val, st_epoch)
+	val_sm_writer.add_scalar('metric', best_metric_val, ed_epoch)
+	test_sm_writer.add_scalar('metric', best_metric_test, st_epoch)
+	test_sm_writer.add_scalar('metric', best_metric_test, ed_epoch)
+	print('\nTest finished\n')	
+
+	# Remove some checkpoints
+	epochs_remove = [i for i in range(1, st_epoch, 1)] + [i for i in range(best_epoch+1, epoch+1, 1)] 
+	learner.remove_checkpoint_epochs(checkpoints_dir=task_dir, epochs=epochs_remove)
+	print('\nCheckpoints removed\n')	
+
+	return metric_val_list[-1], (best_loss_val, best_metric_val, best_loss_test, best_metric_test, st_epoch, ed_epoch)
+
+
+def prepare_downstream(cell):
+	""" Get the arguments of train_downstream for a (trial_idx, bs_idx, lr_idx, rung) configuration, building the datasets of each trial once
+		A configuration stopped by successive halving has rung None, whose trained epochs are only ensembled and tested
+	"""
+	trial_idx, bs_idx, lr_idx, rung = cell
+	if trial_idx not in trial_datasets:
+		trial_datasets[trial_idx] = build_downstream_datasets(task, trial_idx)
+	if rung is None:
+		max_epoch, finish, resume = 0, True, True
+	else:
+		max_epoch, finish, resume = rung_epochs[rung], (rung == nrung-1), (rung > 0)
+	return task, trial_idx, bs_idx, lr_idx, trial_datasets[trial_idx], max_epoch, finish, resume
+
+
+def promote_downstream(rung):
+	""" Promote the top 1/eta of the lr/bs configurations reaching a rung of successive halving to the next rung (asynchronous
+		successive halving, ASHA), by the validation metric averaged over trials, as soon as enough configurations reach the rung
+		Returns:	cells	- (trial_idx, bs_idx, lr_idx, rung) configurations to train to the next rung
+	"""
+	if rung >= nrung-1:
+		return []
+	# a rung is complete when the rung below is complete and all configurations promoted to it (all at rung 0) have reached it
+	complete = True
+	for k in range(rung+1):
+		eligible = np.ones((nlrs, nbss), dtype=bool) if k == 0 else (promoted[..., k-1] == 1)
+		reached = np.all(rung_metrics[..., k] != 0, axis=-1) & eligible
+		complete = complete & np.array_equal(reached, eligible)
+	metric = np.where(reached, np.mean(rung_metrics[..., rung], axis=-1), np.inf)
+	npromote = int(np.sum(reached)) // args.ds_sh_eta
+	if complete: # the best configuration always goes on
+		npromote = max(npromote, 1)
+	cells = []
+	for idx in np.argsort(metric, axis=None)[:npromote]:
+		lr_idx, bs_idx = np.unravel_index(idx, metric.shape)
+		if promoted[lr_idx, bs_idx, rung] == 0:
+			promoted[lr_idx, bs_idx, rung] = 1
+			cells += [(trial_idx, int(bs_idx), int(lr_idx), rung+1) for trial_idx in range(ntrials) if val_losses[lr_idx, bs_idx, trial_idx]==0]
+	return cells
+
+
+def save_downstream_result(cell, output):
+	""" Record the results of a (trial_idx, bs_idx, lr_idx, rung) configuration and save the temporal results of the current task
+		Returns:	cells	- configurations promoted to the next rung of successive halving
+	"""
+	trial_idx, bs_idx, lr_idx, rung = cell
+	metric_val, result = output
+	if rung is not None:
+		# a configuration finished before the last rung (early stopping) keeps its metric for the later rungs
+		rung_metrics[lr_idx, bs_idx, trial_idx, rung:(rung+1 if result is None else nrung)] = metric_val
+	if result is not None:
+		best_loss_val, best_metric_val, best_loss_test, best_metric_test, st_epoch, ed_epoch = result
+		val_losses[lr_idx, bs_idx, trial_idx] = best_loss_val
+		val_metrics[lr_idx, bs_idx, trial_idx] = best_metric_val
+		test_losses[lr_idx, bs_idx, trial_idx] = best_loss_test
+		test_metrics[lr_idx, bs_idx, trial_idx] = best_metric_test
+		ensemble_epochs[lr_idx, bs_idx, trial_idx, :] = [st_epoch, ed_epoch]
+	cells = []
+	if rung is not None:
+		for k in range(rung, nrung-1): # completing a rung may complete the rungs above
+			cells += promote_downstream(k)
+	if rank == 0:
+		savemat_atomic(task_time_dir+'/' + result_name_temporal, {
+							'val_losses':val_losses, 'val_metrics':val_metrics, 
+							'test_losses':test_losses, 'test_metrics':test_metrics, 
+							'lr_set':lr_set, 'bs_set':bs_set, 'ntrial': ntrials,
+							'ensemble_epoch':ensemble_epochs,
+							'rung_epochs':rung_epochs, 'rung_metrics':rung_metrics, 'promoted':promoted})
+	return cells
+
+
+def run_downstream_cells(cells):
+	""" Train (trial_idx, bs_idx, lr_idx, rung) configurations and the configurations they promote, in the main process or concurrently in forked processes
+	"""
+	if args.ds_nslot == 1:
+		while len(cells) > 0:
+			cell = cells.pop(0)
+			cells[:0] = save_downstream_result(cell, train_downstream(*prepare_downstream(cell)))
+	else:
+		# each configuration is trained in a forked process, sharing the datasets (file catalogs, memory-mapped RIR banks and speech pools) of its trial
+		failed_cells = run_forked_jobs(train_downstream, cells, args.ds_nslot, on_result=save_downstream_result, prepare=prepare_downstream)
+		assert len(failed_cells) == 0, f'Configurations (trial_idx, bs_idx, lr_idx, rung) {failed_cells} failed, rerun to resume them'
+
+
 # Training processing
 if (args.ds_train):
 
@@ -142,216 +470,62 @@ if (args.ds_train):
 		atts = dirs[log_dir].replace('TASK', task).replace('NUM', str(num)).replace(task_time_dir,'').split('-')
 		result_name = atts[0] + '-' + atts[1] + '-' + atts[2] + '-' + atts[3] +'-' + atts[-2] +'-' + atts[-1] +  '-lr_bs_tri_result.mat'
 		result_name_temporal = atts[0] + '-' + atts[1] + '-' + atts[2] + '-' + atts[3] +'-' + atts[-2] +'-' + atts[-1] +  '-lr_bs_tri_result_temporal.mat' 
+
+		# Rungs of successive halving at ds_sh_epoch*ds_sh_eta^k epochs, where the last rung trains to the end
+		rung_epochs = []
+		if args.ds_sh_epoch > 0:
+			rung_epoch = args.ds_sh_epoch
+			while rung_epoch < nepoch:
+				rung_epochs += [rung_epoch]
+				rung_epoch *= args.ds_sh_eta
+		rung_epochs += [nepoch]
+		nrung = len(rung_epochs)
+		rung_metrics = np.zeros((nlrs, nbss, ntrials, nrung))
+		promoted = np.zeros((nlrs, nbss, nrung))
+
 		if os.path.exists(task_time_dir+'/' + result_name_temporal):
 			print(result_name_temporal  + ' exist~')
-			msg = input('Sure to continue downstream training? (Enter for yes, otherwise delete temporal result for restart)')
+			if rank == 0:
+				msg = input('Sure to continue downstream training? (Enter for yes, otherwise delete temporal result for restart)')
 			data = scipy.io.loadmat(task_time_dir+'/' + result_name_temporal)
 			val_losses = data['val_losses']
 			test_losses = data['test_losses']
 			val_metrics = data['val_metrics']
 			test_metrics = data['test_metrics']
 			ensemble_epochs = data['ensemble_epoch']
+			if 'rung_metrics' in data:
+				assert np.array_equal(data['rung_epochs'].flatten(), rung_epochs), 'Rungs of successive halving differ from those of the temporal result'
+				rung_metrics = data['rung_metrics'].reshape(nlrs, nbss, ntrials, nrung)
+				promoted = data['promoted'].reshape(nlrs, nbss, nrung)
 		else:
 			if os.path.exists(task_time_dir+'/' + result_name):
 				print(result_name  + ' exist~')
-				msg = input('Sure to retart downstream training? (Enter for yes)')
+				if rank == 0:
+					msg = input('Sure to retart downstream training? (Enter for yes)')
 			val_losses = np.zeros((nlrs, nbss, ntrials))
 			test_losses = np.zeros((nlrs, nbss, ntrials))
 			val_metrics = np.zeros((nlrs, nbss, ntrials))
 			test_metrics = np.zeros((nlrs, nbss, ntrials))
 			ensemble_epochs = np.zeros((nlrs, nbss, ntrials, 2))
 
-		for trial_idx in range(ntrials): 
+		# Configurations without results, where those with results (val_losses!=0) are finished in previous runs,
+		# continuing from the rungs they are promoted to (including promotions missed when a previous run was interrupted)
+		for rung in range(nrung-1):
+			promote_downstream(rung)
+		cells = []
+		for trial_idx in range(ntrials):
 			for bs_idx in range(nbss):
 				for lr_idx in range(nlrs):
-
-					set_seed(args.seed)
-					lr_init = lr_set[lr_idx]
-					bs = bs_set[bs_idx]
-					print(task, ': nepoch=',nepoch, 'num=',num, 'lr=',lr_init, 'bs=',bs, 'trial(or cross_validation_dataset)_idx=',trial_idx, 'ntrial=',ntrials)
-					task_dir = dirs[log_dir].replace('TASK', task).replace('NUM', str(num)).replace('LR', str(lr_init)).replace('BAS', str(bs)).replace('TRI', str(trial_idx))
-					
-					if val_losses[lr_idx, bs_idx, trial_idx]==0:
-						# Dataset 
-						datasets = {}
-						if args.simu_exp: # simulated data, not on-the-fly (simulated data-all est tasks)
-							for stage in stages: 
-								if stage=='train':
-									data_dir = dirs['micsig_'+stage.split('_')[0]+'_simu'][trial_idx]
-								else:
-									data_dir = dirs['micsig_'+stage.split('_')[0]+'_simu'] 
-								datasets[stage] = at_dataset.FixMicSigDataset( 
-									data_dir=data_dir, 
-									load_anno=True, 
-									load_dp=False,
-									fs=fs,
-									dataset_sz=data_num[stage], 
-									transforms=[selecting]
-								)
-						else: # real-world data
-							if task!='TDOA': # real_world ACE- est tasks
-								for stage in stages:
-									real_rir_dir_list = room_dir_set[trial_idx][stage.split('_')[0]]
-									if stage=='train':
-										sim_rir_dir_list = dirs['rir_'+stage.split('_')[0]+'_simu']
-									else:
-										sim_rir_dir_list = []
-									datasets[stage] = at_dataset.RandomMicSigFromRIRDataset(
-										real_rir_dir_list=real_rir_dir_list, 
-										sim_rir_dir_list=sim_rir_dir_list, 
-										src_dir=dirs['srcsig_'+stage.split('_')[0]],
-										dataset_sz=data_num[stage], 
-										T=T, 
-										fs=fs, 
-										c=speed,
-										nmic=nmic, 
-										snr_range=snr_range, 
-										real_sim_ratio=real_sim_ratios[stage.split('_')[0]], 
-										transforms=[selecting],
-										seed=seeds[stage.split('_')[0]]
-									)
-							else: # real-world LOCATA-TDOA est task
-								for stage in stages:
-									real_sig_dir = dirs['micsig_real']
-									if stage=='train':
-										sim_sig_dir = dirs['micsig_'+stage.split('_')[0]+'_simu']
-									else:
-										sim_sig_dir = []
-
-									datasets[stage] = at_dataset.RandomMicSigDataset(
-										real_sig_dir=real_sig_dir, 
-										sim_sig_dir=sim_sig_dir, 
-										real_sim_ratio=real_sim_ratios[stage.split('_')[0]], 
-										fs = fs,
-										stage = stage.split('_')[0],
-										load_anno=True, 
-										dataset_sz=data_num[stage], 
-										transforms=[selecting]
-									)
- 
-						kwargs = {'num_workers': args.workers, 'pin_memory': True} if use_cuda else {}
-						dataloader_train = torch.utils.data.DataLoader(dataset=datasets['train'], batch_size=bs, shuffle=True, **kwargs)
-						dataloader_val = torch.utils.data.DataLoader(dataset=datasets['val'], batch_size=test_bs, shuffle=False, **kwargs)
-						dataloader_test = torch.utils.data.DataLoader(dataset=datasets['test'], batch_size=test_bs, shuffle=False, **kwargs)
-						dataloader_test_large = torch.utils.data.DataLoader(dataset=datasets['test_large'], batch_size=test_bs, shuffle=False, **kwargs)
-		
-						# Learner
-						net.load_state_dict(init_state_dict)
-						learner = at_learner.STFTLearner(net, win_len=win_len, win_shift_ratio=win_shift_ratio, nfft=nfft, fre_used_ratio=fre_used_ratio, fs=fs, task=task, ch_mode='M')
-						if len(args.gpu_id)>1:
-							learner.mul_gpu()
-						if use_cuda:
-							learner.cuda()
-						else:
-							learner.cpu()
-						if args.use_amp:
-							learner.amp()
-
-						if args.checkpoint_start:
-							learner.resume_checkpoint(checkpoints_dir=task_dir, from_latest=True, as_all_state=True) # Train from latest checkpoints
-						else:
-							if args.ds_trainmode=='finetune':
-								learner.load_checkpoint_best(checkpoints_dir=dirs['log_pretrain'], as_all_state=False, param_frozen=False) # fine-tune pretrained networks , ex_key='_orig_mod.'
-							elif args.ds_trainmode=='lineareval':
-								learner.load_checkpoint_best(checkpoints_dir=dirs['log_pretrain'], as_all_state=False, param_frozen=True)  # ex_key='_orig_mod.'
-							
-						# Monitor parameters with tensorboard
-						train_writer = SummaryWriter(task_dir + '/train/', 'train')
-						val_writer = SummaryWriter(task_dir + '/val/', 'val')
-						val_sm_writer = SummaryWriter(task_dir + '/val-smooth/', 'val')
-						test_writer = SummaryWriter(task_dir + '/test/', 'test')
-						test_sm_writer = SummaryWriter(task_dir + '/test-smooth/', 'test')
-
-						# Model Training
-						loss_val_list = []
-						loss_val_real_list = []
-						loss_val_sim_list = []
-						lr = lr_init * 1
-						cnt_stop = 0
-						for epoch in range(learner.start_epoch, nepoch+1, 1):
-							print('\nEpoch {}/{}:'.format(epoch, nepoch))
-
-							set_random_seed(seeds['train'])
-							loss_train, metric_train = learner.train_epoch(dataloader_train, lr=lr, epoch=epoch, return_metric=True)
-							nmetric = 1
-
-							set_random_seed(seeds['val'])
-							loss_val, metric_val = learner.test_epoch(dataloader_val, return_metric=True)
-
-							set_random_seed(seeds['test'])
-							loss_test, metric_test = learner.test_epoch(dataloader_test, return_metric=True)
-
-							print('{} estimation, Val loss: {:.4f}, Val metric: {:.4f}'.format(task, loss_val, metric_val))
-							print('{} estimation, Test loss: {:.4f}, Test metric: {:.4f}'.format(task, loss_test, metric_test))
-								
-							loss_val_list += [loss_val] 
-							loss_val_list_smooth = learner.smooth_data(data_list=loss_val_list, alpha=smooth_alpha)
-
-							# Save model
-							stop_flag, is_best_epoch = learner.early_stopping(current_score=loss_val_list_smooth[-1]*(-1), patience=early_stop_patience)
-							learner.save_checkpoint(epoch=epoch, checkpoints_dir=task_dir, is_best_epoch=is_best_epoch, save_extra_hist=True)
-							if is_best_epoch:
-								best_epoch = copy.deepcopy(epoch)
-							
-							# Visualize parameters with tensorboardX
-							train_writer.add_scalar('loss', loss_train, epoch)
-							val_writer.add_scalar('loss', loss_val, epoch)
-							val_sm_writer.add_scalar('loss', loss_val_list_smooth[-1], epoch)
-							test_writer.add_scalar('loss', loss_test, epoch)
-							
-							if nmetric == 1:
-								train_writer.add_scalar('metric', metric_train, epoch)
-								val_writer.add_scalar('metric', metric_val, epoch)
-								test_writer.add_scalar('metric', metric_test, epoch)
-							train_writer.add_scalar('lr', lr, epoch)
-							if epoch==1:
-								train_writer.add_scalar('nparam', nparam_sum, epoch)
-							if stop_flag: ## Inff plot: comment
-								cnt_stop += 1
-								if cnt_stop <= num_stop_th:
-									lr = lr / 10
-									print('lr decaing')
-									learner.early_stop_counter = 0
-								else:
-									break 
-
-						print('\nTraining finished\n')
-						
-						# Ensemble model 
-						st_epoch = np.maximum(1, best_epoch-nepoch_ensemble+1)
-						ed_epoch = copy.deepcopy(best_epoch)
-						epochs = [i for i in range(st_epoch, ed_epoch+1, 1)]
-						learner.ensembling(checkpoints_dir=task_dir, epochs=epochs)
-
-						# Model validation
-						set_random_seed(seeds['test'])
-						best_loss_test, best_metric_test = learner.test_epoch(dataloader_test_large, return_metric=True)
-						set_random_seed(seeds['val'])
-						best_loss_val, best_metric_val = learner.test_epoch(dataloader_val, return_metric=True)
-						print('{} estimation, Test loss: {:.4f}, Test metric: {:.4f}'.format(task, best_loss_test, best_metric_test))
-						print('{} estimation, Val loss: {:.4f}, Val metric: {:.4f}'.format(task, best_loss_val, best_metric_val))
-						val_sm_writer.add_scalar('metric', best_metric_val, st_epoch)
-						val_sm_writer.add_scalar('metric', best_metric_val, ed_epoch)
-						test_sm_writer.add_scalar('metric', best_metric_test, st_epoch)
-						test_sm_writer.add_scalar('metric', best_metric_test, ed_epoch)
-						print('\nTest finished\n')	
-
-						# Remove some checkpoints
-						epochs_remove = [i for i in range(1, st_epoch, 1)] + [i for i in range(best_epoch+1, epoch+1, 1)] 
-						learner.remove_checkpoint_epochs(checkpoints_dir=task_dir, epochs=epochs_remove)
-						print('\nCheckpoints removed\n')	
-
-						# Save temporal results
-						val_losses[lr_idx, bs_idx, trial_idx] = best_loss_val
-						val_metrics[lr_idx, bs_idx, trial_idx] = best_metric_val
-						test_losses[lr_idx, bs_idx, trial_idx] = best_loss_test
-						test_metrics[lr_idx, bs_idx, trial_idx] = best_metric_test
-						ensemble_epochs[lr_idx, bs_idx, trial_idx, :] = [st_epoch, ed_epoch]
-						scipy.io.savemat(task_time_dir+'/' + result_name_temporal, {
-											'val_losses':val_losses, 'val_metrics':val_metrics, 
-											'test_losses':test_losses, 'test_metrics':test_metrics, 
-											'lr_set':lr_set, 'bs_set':bs_set, 'ntrial': ntrials,
-											'ensemble_epoch':ensemble_epochs})
+					rung = int(np.sum(np.cumprod(promoted[lr_idx, bs_idx, :])))
+					if (val_losses[lr_idx, bs_idx, trial_idx]==0) & (rung_metrics[lr_idx, bs_idx, trial_idx, rung]==0):
+						cells += [(trial_idx, bs_idx, lr_idx, rung)]
+		cells.sort(key=lambda cell: -cell[3]) # promoted configurations first
+		trial_datasets = {}
+		run_downstream_cells(cells)
+
+		# Configurations stopped by successive halving, whose trained epochs are ensembled and tested to keep their partial results
+		cells = [(trial_idx, bs_idx, lr_idx, None) for trial_idx in range(ntrials) for bs_idx in range(nbss) for lr_idx in range(nlrs) if val_losses[lr_idx, bs_idx, trial_idx]==0]
+		run_downstream_cells(cells)
 		
 		# Find best model among searching learning rates and batch size
 		metric = np.mean(val_metrics, axis=-1)
@@ -366,15 +540,18 @@ if (args.ds_train):
 		print('\n{} estimation, BS: {}, LR: {}, best val MAE: {:.4f}, best test MAE: {:.4f}\n'.format(task, best_bs, best_lr, best_val_metric, best_test_metric))
 
 		# Save final results and remove temporal results
+		task_dir = dirs[log_dir].replace('TASK', task).replace('NUM', str(num)).replace('LR', str(lr_set[-1])).replace('BAS', str(bs_set[-1])).replace('TRI', str(ntrials-1))
 		atts = task_dir.replace(task_time_dir,'').split('-')
 		result_name = atts[0] + '-' + atts[1] + '-' + atts[2] + '-' + atts[3] +'-' + atts[-2] +'-' + atts[-1] +  '-lr_bs_tri_result.mat' 
-		scipy.io.savemat(task_time_dir+'/' + result_name, {
-							'val_losses':val_losses, 'val_metrics':val_metrics, 
-							'test_losses':test_losses, 'test_metrics':test_metrics, 
-							'lr_set':lr_set, 'bs_set':bs_set, 'ntrial': ntrials,
-							'best_lr_idx':best_lr_idx, 'best_bs_idx':best_bs_idx,
-							'ensemble_epoch':ensemble_epochs})
-		os.remove(task_time_dir+'/' + result_name_temporal)
+		if rank == 0:
+			savemat_atomic(task_time_dir+'/' + result_name, {
+								'val_losses':val_losses, 'val_metrics':val_metrics, 
+								'test_losses':test_losses, 'test_metrics':test_metrics, 
+								'lr_set':lr_set, 'bs_set':bs_set, 'ntrial': ntrials,
+								'best_lr_idx':best_lr_idx, 'best_bs_idx':best_bs_idx,
+								'ensemble_epoch':ensemble_epochs,
+								'rung_epochs':rung_epochs, 'rung_metrics':rung_metrics, 'promoted':promoted})
+			os.remove(task_time_dir+'/' + result_name_temporal)
 
 
 if (args.ds_test):
@@ -463,7 +640,7 @@ if (args.ds_test):
 			dataloader_train = torch.utils.data.DataLoader(dataset=datasets['train'], batch_size=test_bs, shuffle=False, **kwargs)
 			dataloader_test = torch.utils.data.DataLoader(dataset=datasets['test'], batch_size=test_bs, shuffle=False, **kwargs)
 
-			learner = at_learner.STFTLearner(net, win_len=win_len, win_shift_ratio=win_shift_ratio, nfft=nfft, fre_used_ratio=fre_used_ratio, fs=fs, task=task, ch_mode='M')
+			learner = at_learner.STFTLearner(net, win_len=win_len, win_shift_ratio=win_shift_ratio, nfft=nfft, fre_used_ratio=fre_used_ratio, fs=fs, task=task, ch_mode=args.ds_ch_mode)
 			if len(args.gpu_id)>1:
 				learner.mul_gpu()
 			if use_cuda:
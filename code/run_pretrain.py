@@ -13,6 +13,9 @@
 		python run_pretrain.py --test --simu-exp --time * --test-mode all --gpu-id 0, 
 
 		python run_pretrain.py --pretrain --gpu-id 0, 
+
+		# distributed pre-training, one process per GPU (or per CPU worker with --no-cuda), --bs gives the total batch size of all processes
+		torchrun --nnodes 1 --nproc-per-node 4 run_pretrain.py --pretrain --gpu-id 0,1,2,3
 """
 
 import os
@@ -42,14 +45,19 @@ import dataset as at_dataset
 import learner as at_learner
 import model as at_model
 from common.utils import set_seed, set_random_seed, create_learning_rate_schedule, get_nparams, get_FLOPs, save_config_to_file,vis_time_fre_data
+from common.utils import init_distributed, NullWriter
 
 use_cuda = not args.no_cuda and torch.cuda.is_available()
 device = torch.device("cuda" if use_cuda else "cpu")
 
+# Distributed training when launched by torchrun, where only rank 0 writes logs and checkpoints
+rank, world_size, local_rank = init_distributed(backend='nccl' if use_cuda else 'gloo')
+Writer = SummaryWriter if rank == 0 else NullWriter
+
 set_seed(args.seed)
 
 # Save config file
-if args.pretrain:
+if args.pretrain & (rank == 0):
 	os.makedirs(dirs['log_pretrain'], exist_ok=True)
 	file_path = os.path.join(dirs['log_pretrain'],"config.json")
 	save_config_to_file([args.__dict__, dirs], file_path)
@@ -189,25 +197,50 @@ if args.pretrain:
 			sound_speed = speed)
 
 	kwargs = {'num_workers': args.workers, 'pin_memory': True}  if use_cuda else {}
+	if args.mask_workers:
+		# patch masks are generated with batches by DataLoader workers and passed to the model by the learner
+		kwargs['collate_fn'] = net.mask_collate(ch_mode='M')
 
-	dataloader_pretrain = torch.utils.data.DataLoader(dataset=dataset_pretrain, batch_size=args.bs[0], shuffle=True, **kwargs)
+	assert args.bs[0] % world_size == 0, f'Training batch size {args.bs[0]} is not divisible by the number of processes {world_size}'
+	bs_pretrain = args.bs[0] // world_size # per process
 	if args.simu_exp:
+		# equal to shuffle=True, with batches that can be skipped when resuming from a mid-epoch checkpoint
+		if world_size > 1:
+			sampler = torch.utils.data.DistributedSampler(dataset_pretrain, num_replicas=world_size, rank=rank, shuffle=True, seed=seeds['train'], drop_last=True)
+		else:
+			sampler = torch.utils.data.RandomSampler(dataset_pretrain)
+		batch_sampler = torch.utils.data.BatchSampler(sampler, batch_size=bs_pretrain, drop_last=False)
+		dataloader_pretrain = torch.utils.data.DataLoader(dataset=dataset_pretrain, batch_sampler=at_dataset.ResumableBatchSampler(batch_sampler), **kwargs)
 		dataloader_preval_sim = torch.utils.data.DataLoader(dataset=dataset_preval, batch_size=args.bs[1], shuffle=False, **kwargs)
 	else:
-		dataloader_preval_real = torch.utils.data.DataLoader(dataset=dataset_preval_real, batch_size=args.bs[1], shuffle=False, **kwargs)
-		dataloader_pretest_locata = torch.utils.data.DataLoader(dataset=dataset_pretest_locata, batch_size=args.bs[2], shuffle=False, **kwargs)
-		dataloader_pretest_ace = torch.utils.data.DataLoader(dataset=dataset_pretest_ace, batch_size=args.bs[2], shuffle=False, **kwargs)
+		# corpora, items and crops are drawn in the main process (seeded by set_random_seed), not with the forked RNG states of workers,
+		# and each worker reads the crops of a whole batch together through its pool of open files; each process keeps a disjoint share of the draws
+		batch_sampler = dataset_pretrain.batch_sampler(bs_pretrain, num_replicas=world_size, rank=rank)
+		dataloader_pretrain = torch.utils.data.DataLoader(dataset=dataset_pretrain, batch_sampler=at_dataset.ResumableBatchSampler(batch_sampler), **kwargs)
+		dataloader_preval_real = torch.utils.data.DataLoader(dataset=dataset_preval_real, batch_sampler=dataset_preval_real.batch_sampler(args.bs[1]), **kwargs)
+		dataloader_pretest_locata = torch.utils.data.DataLoader(dataset=dataset_pretest_locata, batch_sampler=dataset_pretest_locata.batch_sampler(args.bs[2]), **kwargs)
+		dataloader_pretest_ace = torch.utils.data.DataLoader(dataset=dataset_pretest_ace, batch_sampler=dataset_pretest_ace.batch_sampler(args.bs[2]), **kwargs)
 
 	# Learner
 	learner = at_learner.STFTLearner(net, win_len=win_len, win_shift_ratio=win_shift_ratio, nfft=nfft, fre_used_ratio=fre_used_ratio, fs=fs, task=None, ch_mode='M')
 	if use_cuda:
-		if len(args.gpu_id)>1:
+		if (len(args.gpu_id)>1) & (world_size == 1):
 			learner.mul_gpu()
 		learner.cuda()
 	else:
 		learner.cpu()
+	if world_size > 1:
+		learner.ddp(device_ids=[local_rank] if use_cuda else None)
 	if args.use_amp:
 		learner.amp()
+
+	# Learning rate, scheduled by optimizer steps for simulated data and set before resuming its state, which takes the values of
+	# the per-epoch cosine schedule (base lr at epoch 1, no warm-up) at the start of each epoch unless a warm-up is given
+	if args.simu_exp:
+		nstep_epoch = len(dataloader_pretrain)
+		lr_schedule = create_learning_rate_schedule(total_steps=max(args.nepoch-1, 1)*nstep_epoch, base = args.lr, decay_type='cosine', warmup_steps=args.lr_warmup_epochs*nstep_epoch, linear_end=1e-6)
+		learner.set_lr_schedule(lr_schedule, lr=args.lr)
+
 	if args.checkpoint_start:
 		learner.resume_checkpoint(checkpoints_dir=dirs['log_pretrain'], from_latest=True, as_all_state=True) # Train from latest checkpoints
 	if args.checkpoint_from_best_epoch:
@@ -218,21 +251,18 @@ if args.pretrain:
 		for epoch in range(learner.start_epoch, learner.start_epoch+max_epoch):
 			old_name = dirs['log_pretrain'] + '/model' + str(epoch) + '.tar' 
 			new_name = dirs['log_pretrain'] + '/model' + str(epoch) + '_.tar' 
-			if os.path.exists(old_name):
+			if os.path.exists(old_name) & (rank == 0):
 				print(epoch)
 				os.rename(old_name, new_name)
 
-	# Learning rate
-	lr_schedule = create_learning_rate_schedule(total_steps=args.nepoch, base = args.lr, decay_type='cosine', warmup_steps=1, linear_end=1e-6)
-
 	# Tensorboard
-	train_writer = SummaryWriter(dirs['log_pretrain'] + '/train/', 'train')
+	train_writer = Writer(dirs['log_pretrain'] + '/train/', 'train')
 	if args.simu_exp:
-		val_sim_writer = SummaryWriter(dirs['log_pretrain'] + '/val_sim/', 'val')
+		val_sim_writer = Writer(dirs['log_pretrain'] + '/val_sim/', 'val')
 	else:
-		val_real_writer = SummaryWriter(dirs['log_pretrain'] + '/val_real/', 'val')
-		test_locata_writer = SummaryWriter(dirs['log_pretrain'] + '/test_locata/', 'test')
-		test_ace_writer = SummaryWriter(dirs['log_pretrain'] + '/test_ace/', 'test')
+		val_real_writer = Writer(dirs['log_pretrain'] + '/val_real/', 'val')
+		test_locata_writer = Writer(dirs['log_pretrain'] + '/test_locata/', 'test')
+		test_ace_writer = Writer(dirs['log_pretrain'] + '/test_ace/', 'test')
 
 	
 	# Network training
@@ -242,12 +272,14 @@ if args.pretrain:
  
 		# lr = set_learning_rate(epoch=epoch, lr_init=args.lr, step=100, gamma=0.6)
 		if args.simu_exp:
-			lr = lr_schedule(epoch)	
+			lr = learner.get_lr() # scheduled by steps, learning rate at the start of the epoch
 		else:
 			lr = 0.0001
 			
 		set_random_seed(seeds['train']+epoch)
-		loss_train, diff_train, data_vis_train = learner.pretrain_epoch(dataloader_pretrain, lr=lr, epoch=epoch, return_diff=True)
+		dataloader_pretrain.batch_sampler.set_epoch(epoch)
+		loss_train, diff_train, data_vis_train = learner.pretrain_epoch(dataloader_pretrain, lr=lr, epoch=epoch, return_diff=True, 
+			checkpoints_dir=dirs['log_pretrain'], checkpoint_every=args.checkpoint_every)
 		if args.simu_exp:
 			set_random_seed(seeds['val']) # can be fixed when there is one card, where therea are multiple cards, inputs are fix but network are not
 			loss_val_sim, diff_val_sim, data_vis_val_sim = learner.pretest_epoch(dataloader_preval_sim, return_diff=True)
@@ -298,7 +330,7 @@ if args.pretrain:
 
 		# Save 
 		nepoch_save_data = [5, 10, 15, 20, 25, 30, 35, 40]
-		if epoch in nepoch_save_data:
+		if (epoch in nepoch_save_data) & (rank == 0):
 			data_path = dirs['log_pretrain'] + '/result/'
 			exist_flag = os.path.exists(data_path)
 			if exist_flag==False:
@@ -370,8 +402,8 @@ if (args.pretrain_frozen_encoder):
 	print('# matched keys:', cnt)
 
 	# TensorboardX
-	train_writer = SummaryWriter(dirs['log_pretrain_frozen_encoder'] + '/train/', 'train')
-	val_sim_writer = SummaryWriter(dirs['log_pretrain_frozen_encoder'] + '/val_sim/', 'val')
+	train_writer = Writer(dirs['log_pretrain_frozen_encoder'] + '/train/', 'train')
+	val_sim_writer = Writer(dirs['log_pretrain_frozen_encoder'] + '/val_sim/', 'val')
 
 	# Network training
 	for epoch in range(learner.start_epoch, nepoch+1, 1):
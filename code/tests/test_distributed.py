@@ -0,0 +1,60 @@
+import os
+import sys
+import socket
+import tempfile
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.utils import init_distributed, set_random_seed
+
+
+class RandomDrawDataset(torch.utils.data.Dataset):
+    """ Draws each sample from np.random regardless of the index, as RandomMicSigDataset and RandomMicSigFromRIRDataset
+    """
+    def __len__(self):
+        return 64
+
+    def __getitem__(self, idx):
+        return np.random.randn(4).astype(np.float32)
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _first_batches(rank, world_size, port, num_workers, out_path):
+    os.environ.update({'RANK': str(rank), 'WORLD_SIZE': str(world_size), 'LOCAL_RANK': str(rank),
+                       'MASTER_ADDR': '127.0.0.1', 'MASTER_PORT': str(port)})
+    rank, world_size, _ = init_distributed(backend='gloo')
+    dataset = RandomDrawDataset()
+    sampler = torch.utils.data.DistributedSampler(dataset, num_replicas=world_size, rank=rank, shuffle=True, seed=1)
+    dataloader = torch.utils.data.DataLoader(dataset=dataset, batch_size=8, sampler=sampler, num_workers=num_workers)
+    set_random_seed(100, rank=rank) # as the training epochs of run_downstream
+    batch = next(iter(dataloader))
+    batches = [torch.zeros_like(batch) for _ in range(world_size)]
+    dist.all_gather(batches, batch)
+    if rank == 0:
+        torch.save(batches, out_path)
+    dist.destroy_process_group()
+
+
+def _gather_first_batches(num_workers):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        out_path = os.path.join(tmp_dir, 'batches.pt')
+        mp.spawn(_first_batches, args=(2, _free_port(), num_workers, out_path), nprocs=2, join=True)
+        return torch.load(out_path)
+
+
+def test_ranks_draw_different_batches():
+    batches = _gather_first_batches(num_workers=0)
+    assert not torch.equal(batches[0], batches[1])
+
+
+def test_ranks_draw_different_batches_in_workers():
+    batches = _gather_first_batches(num_workers=1)
+    assert not torch.equal(batches[0], batches[1])